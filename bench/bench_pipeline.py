@@ -0,0 +1,319 @@
+"""
+server.py を別プロセスで起動し, 録音から要約・検索までのパイプライン全体を計測するベンチマーク
+
+OpenAI と Google Custom Search はローカルの代替サーバー (bench/fake_services.py) に差し替える.
+音声は --audio-dir を指定しない場合は音声に似た合成音を使う.
+同時に録音するセッション数 (--concurrency) ごとに, 段階ごとのレイテンシの分位点, スループット,
+実時間係数 (RTF), サーバーのピーク RSS を JSON に保存する.
+
+    python bench/bench_pipeline.py --concurrency 1 4 --utterances 20 --model tiny --device cpu \\
+        --output bench_pipeline.json
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, List
+
+import numpy as np
+import requests
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from bench.fake_services import FakeOpenAIHandler, FakeSearchHandler, FakeServer  # noqa: E402
+from src.transcribe.audio import SAMPLE_RATE, encode_wav, load_audio_file  # noqa: E402
+
+REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+PERCENTILES = [50, 90, 99]
+
+
+def synthesize_utterance(seconds: float, seed: int) -> np.ndarray:
+    """
+    音声に似た合成音を作る. 基本周波数が揺らぐ調波音を音節程度の周期で振幅変調し, 子音に当たる雑音を混ぜる
+
+    :param seconds: float
+    :param seed: int
+    :return: np.ndarray  16 kHz の float32
+    """
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+    f0 = rng.uniform(110, 220) * (1 + 0.08 * np.sin(2 * np.pi * rng.uniform(0.5, 2) * t))
+    phase = 2 * np.pi * np.cumsum(f0) / SAMPLE_RATE
+    voiced = sum(np.sin(k * phase) / k for k in range(1, 8))
+    syllables = np.clip(np.sin(2 * np.pi * rng.uniform(3, 6) * t), 0, None) ** 2
+    noise = rng.standard_normal(len(t)) * (syllables < 0.05)
+    audio = 0.3 * voiced * syllables + 0.02 * noise
+    return (audio / max(np.abs(audio).max(), 1e-6) * 0.5).astype(np.float32)
+
+
+def load_utterances(args) -> List[np.ndarray]:
+    if args.audio_dir:
+        return [load_audio_file(os.path.join(args.audio_dir, file_name))
+                for file_name in sorted(os.listdir(args.audio_dir))
+                if file_name.rsplit(".", 1)[-1].lower() in {"wav", "m4a", "mp3"}]
+    rng = np.random.default_rng(0)
+    return [synthesize_utterance(rng.uniform(args.min_seconds, args.max_seconds), seed=i)
+            for i in range(args.utterances)]
+
+
+def percentiles(values: List[float]) -> dict:
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+    result = {"count": len(values), "mean": round(sum(values) / len(values), 4)}
+    for p in PERCENTILES:
+        # nearest-rank
+        result[f"p{p}"] = round(values[min(len(values) - 1, int(np.ceil(p / 100 * len(values))) - 1)], 4)
+    result["max"] = round(values[-1], 4)
+    return result
+
+
+def peak_rss_bytes(pid: int) -> int:
+    """
+    pid とその子孫プロセスのピーク RSS (VmHWM) の合計を返す. /proc が無い環境では 0
+
+    :param pid: int
+    :return: int
+    """
+    children: Dict[int, List[int]] = {}
+    for entry in os.listdir("/proc") if os.path.isdir("/proc") else []:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # comm に空白や括弧が含まれる場合があるので最後の ")" から後ろを使う
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+
+    total = 0
+    stack = [pid]
+    while stack:
+        current = stack.pop()
+        stack.extend(children.get(current, []))
+        try:
+            with open(f"/proc/{current}/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            continue
+    return total
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(args, work_dir: str, openai: FakeServer, search: FakeServer) -> subprocess.Popen:
+    # server.py は ./data と ./static を使うので, 作業ディレクトリから static を参照させる
+    os.symlink(os.path.join(REPO_DIR, "static"), os.path.join(work_dir, "static"))
+    env = dict(os.environ)
+    env.update({
+        "OPENAI_API_KEY": "fake",
+        "OPENAI_BASE_URL": openai.url + "/v1",
+        "GOOGLE_API_KEY": "fake",
+        "CUSTOM_SEARCH_ENGINE_ID": "fake",
+        "CUSTOM_SEARCH_ENDPOINT": search.url + "/customsearch/v1",
+        "LLM_BACKEND": "openai",
+        # 実行ごとに結果が変わらないよう, LLM の応答キャッシュは使わない
+        "LLM_CACHE_PATH": "",
+        "TRANSCRIBE_MODEL": args.model,
+        "TRANSCRIBE_DEVICE": args.device,
+        "TRANSCRIBE_BACKEND": args.backend,
+    })
+    return subprocess.Popen([sys.executable, "-m", "uvicorn", "server:app", "--app-dir", REPO_DIR,
+                             "--host", "127.0.0.1", "--port", str(args.port), "--log-level", "warning"],
+                            cwd=work_dir, env=env)
+
+
+def wait_ready(base_url: str, process: subprocess.Popen, timeout: float) -> float:
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        if process.poll() is not None:
+            raise RuntimeError("Server exited with code " + str(process.returncode))
+        try:
+            if requests.get(base_url + "/ready", timeout=1).status_code == 200:
+                return time.perf_counter() - start
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    raise TimeoutError("Server did not become ready")
+
+
+def stream_summary(client: requests.Session, base_url: str) -> Dict[str, float]:
+    """
+    /api/summarize/stream を最後まで読み, 最初の token / result が届くまでの時間と全体の時間を返す
+    """
+    started = time.perf_counter()
+    first_content = None
+    event = None
+    with client.get(base_url + "/api/summarize/stream", stream=True, timeout=600) as response:
+        response.raise_for_status()
+        for line in response.iter_lines(decode_unicode=True):
+            if line.startswith("event: "):
+                event = line[len("event: "):]
+            elif line.startswith("data: "):
+                if event in ("token", "result") and first_content is None:
+                    first_content = time.perf_counter() - started
+                if event == "failed":
+                    raise RuntimeError(json.loads(line[len("data: "):])["message"])
+    total = time.perf_counter() - started
+    return {"summarize_first_content": first_content if first_content is not None else total, "summarize": total}
+
+
+def run_session(base_url: str, index: int, utterances: List[bytes], durations: List[float],
+                stream: bool = False) -> dict:
+    """
+    1 セッション分の録音, 書きおこし, 要約, 検索を行い, 段階ごとの所要時間を返す
+    stream が True なら要約を /api/summarize/stream で受け取り, 最初の内容が届くまでの時間も測る
+    """
+    client = requests.Session()
+    client.headers["X-Session-ID"] = f"bench{index}"
+    client.post(base_url + "/api/set_dir", json={"dir": f"bench{index}"}).raise_for_status()
+    client.get(base_url + "/api/start_recording").raise_for_status()
+
+    stages: Dict[str, List[float]] = {"transcribe": [], "transcribe_rtf": []}
+    start = time.perf_counter()
+    for i, (data, duration) in enumerate(zip(utterances, durations)):
+        # フロントエンドと同じく, 発話ごとに投入して結果を待つ
+        submitted = time.perf_counter()
+        response = client.post(base_url + "/api/transcribe",
+                               files={"file": (f"{int(time.time() * 1000)}_{i}.wav", data, "audio/wav")})
+        response.raise_for_status()
+        job_id = response.json()["job_id"]
+        while True:
+            job = client.get(f"{base_url}/api/transcribe/{job_id}", params={"timeout": 30}).json()
+            if job["status"] in ("done", "failed"):
+                break
+        if job["status"] == "failed":
+            raise RuntimeError(job.get("message"))
+        elapsed = time.perf_counter() - submitted
+        stages["transcribe"].append(elapsed)
+        stages["transcribe_rtf"].append(elapsed / duration)
+    transcribe_seconds = time.perf_counter() - start
+
+    paths = [("summarize", "/api/summarize"), ("get_useful_info", "/api/get_useful_info")]
+    if stream:
+        for stage, seconds in stream_summary(client, base_url).items():
+            stages[stage] = [seconds]
+        paths = paths[1:]
+    for stage, path in paths:
+        started = time.perf_counter()
+        client.get(base_url + path, timeout=600).raise_for_status()
+        stages[stage] = [time.perf_counter() - started]
+    return {"stages": stages, "transcribe_seconds": transcribe_seconds,
+            "total_seconds": time.perf_counter() - start}
+
+
+def run(args, concurrency: int, utterances: List[np.ndarray]) -> dict:
+    openai = FakeServer(FakeOpenAIHandler, latency=args.llm_latency).start()
+    search = FakeServer(FakeSearchHandler, latency=args.search_latency).start()
+    with tempfile.TemporaryDirectory() as work_dir:
+        process = start_server(args, work_dir, openai, search)
+        base_url = f"http://127.0.0.1:{args.port}"
+        try:
+            ready_seconds = wait_ready(base_url, process, args.ready_timeout)
+            wav_files = [encode_wav(audio) for audio in utterances]
+            durations = [len(audio) / SAMPLE_RATE for audio in utterances]
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                sessions = list(executor.map(lambda i: run_session(base_url, i, wav_files, durations, args.stream_summary),
+                                             range(concurrency)))
+            wall_seconds = time.perf_counter() - start
+            rss = peak_rss_bytes(process.pid)
+        finally:
+            process.terminate()
+            process.wait(timeout=30)
+            openai.stop()
+            search.stop()
+
+    stages: Dict[str, List[float]] = {}
+    for session in sessions:
+        for stage, values in session["stages"].items():
+            stages.setdefault(stage, []).extend(values)
+    audio_seconds = sum(durations) * concurrency
+    transcribe_seconds = max(session["transcribe_seconds"] for session in sessions)
+    return {
+        "concurrency": concurrency,
+        "ready_seconds": round(ready_seconds, 3),
+        "wall_seconds": round(wall_seconds, 3),
+        "audio_seconds": round(audio_seconds, 3),
+        "stages": {stage: percentiles(values) for stage, values in stages.items()},
+        "throughput": {
+            "utterances_per_second": round(len(utterances) * concurrency / transcribe_seconds, 4),
+            "audio_seconds_per_second": round(audio_seconds / transcribe_seconds, 4),
+            "sessions_per_minute": round(concurrency / wall_seconds * 60, 4),
+        },
+        # 全セッションの書きおこしにかかった時間 / 書きおこした音声の長さ
+        "rtf": round(transcribe_seconds / audio_seconds, 4),
+        "peak_rss_bytes": rss,
+        "fake_openai": openai.to_dict(),
+        "fake_search": search.to_dict(),
+    }
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1], help="同時に録音するセッション数")
+    parser.add_argument("--utterances", type=int, default=20, help="1 セッションあたりの合成音声の発話数")
+    parser.add_argument("--min-seconds", type=float, default=1.0, help="合成音声の発話の最短秒数")
+    parser.add_argument("--max-seconds", type=float, default=5.0, help="合成音声の発話の最長秒数")
+    parser.add_argument("--audio-dir", help="合成音声の代わりに使う音声ファイルのディレクトリ")
+    parser.add_argument("--model", default="tiny")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--backend", default="whisper")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="代替の OpenAI API の応答時間 (秒)")
+    parser.add_argument("--search-latency", type=float, default=0.2, help="代替の検索 API の応答時間 (秒)")
+    parser.add_argument("--stream-summary", action="store_true",
+                        help="要約を /api/summarize/stream で受け取り, 最初の内容が届くまでの時間を測る")
+    parser.add_argument("--port", type=int, default=0, help="server.py のポート. 0 なら空いているポート")
+    parser.add_argument("--ready-timeout", type=float, default=600)
+    parser.add_argument("--output", help="結果を保存する JSON ファイル")
+    args = parser.parse_args()
+    if args.port == 0:
+        args.port = free_port()
+
+    utterances = load_utterances(args)
+    if not utterances:
+        parser.error("no utterances")
+
+    results = []
+    for concurrency in args.concurrency:
+        result = run(args, concurrency, utterances)
+        results.append(result)
+        print(json.dumps({"concurrency": concurrency, "rtf": result["rtf"],
+                          "stages": {stage: stats.get("p50") for stage, stats in result["stages"].items()},
+                          "peak_rss_mb": round(result["peak_rss_bytes"] / 2 ** 20, 1)}))
+
+    report = {
+        "created_at": datetime.now().isoformat(),
+        "git_revision": git_revision(),
+        "args": vars(args),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+"""
+書きおこしバックエンドの実時間係数 (RTF) と誤り率を比較するベンチマーク
+
+audio_dir (デフォルトは ./data/bench) には音声ファイル (wav, m4a, mp3) と, 同じ名前で拡張子が .txt の正解テキストを置く.
+初回の実行で audio_dir に各ファイルのハッシュを manifest.json として書き, 以降はファイルが manifest.json と
+一致しなければエラーにする. 結果の dataset (manifest のハッシュ) が同じなら同じ音声のセットで比較している.
+音声のセットを入れ替えたときは --update-manifest を付ける.
+
+    python bench/bench_transcribe.py \\
+        --config '{"backend": "whisper", "model_name": "small", "device": "cpu"}' \\
+        --config '{"backend": "faster-whisper", "model_name": "small", "device": "cpu", "compute_type": "int8"}' \\
+        --output bench_transcribe.json
+
+--batch-size を指定すると transcribe_batch でまとめて書きおこし, config の batch_mode ("pad" | "pack" | "trim") ごとに
+エンコーダに入れた音声の秒数 (encoder_input_seconds) も比較できる.
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+import unicodedata
+from typing import List, Tuple
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from src.metrics.metrics import ENCODER_INPUT_SECONDS  # noqa: E402
+from src.transcribe.audio import SAMPLE_RATE, load_audio_file  # noqa: E402
+from src.transcribe.transcribe import Transcriber  # noqa: E402
+
+AUDIO_EXTENSIONS = {"wav", "m4a", "mp3"}
+DEFAULT_AUDIO_DIR = "./data/bench"
+MANIFEST_FILE_NAME = "manifest.json"
+DEFAULT_CONFIGS = [
+    {"backend": "whisper", "model_name": "small", "device": "cpu"},
+    {"backend": "faster-whisper", "model_name": "small", "device": "cpu", "compute_type": "int8"},
+]
+
+
+def edit_distance(reference: List[str], hypothesis: List[str]) -> int:
+    """
+    レーベンシュタイン距離
+
+    :param reference: List[str]
+    :param hypothesis: List[str]
+    :return: int
+    """
+    previous = list(range(len(hypothesis) + 1))
+    for i, ref in enumerate(reference, 1):
+        current = [i] + [0] * len(hypothesis)
+        for j, hyp in enumerate(hypothesis, 1):
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ref != hyp))
+        previous = current
+    return previous[-1]
+
+
+def normalize(text: str) -> str:
+    # 句読点と空白の違いは誤りとして数えない
+    text = unicodedata.normalize("NFKC", text).lower()
+    return "".join(c for c in text if not unicodedata.category(c).startswith(("P", "Z")) or c == " ")
+
+
+def file_hash(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def load_dataset(audio_dir: str, update_manifest: bool = False) -> Tuple[List[dict], str]:
+    """
+    :param audio_dir: str
+    :param update_manifest: bool  manifest.json を今のファイルで書き直すか
+    :return: (List[dict], str)  音声と正解テキストのリストと, manifest のハッシュ. ファイルが manifest と異なれば ValueError
+    """
+    dataset = []
+    manifest = {}
+    for file_name in sorted(os.listdir(audio_dir)):
+        stem, _, extension = file_name.rpartition(".")
+        reference_path = os.path.join(audio_dir, stem + ".txt")
+        if extension.lower() not in AUDIO_EXTENSIONS or not os.path.exists(reference_path):
+            continue
+        with open(reference_path, "r", encoding="utf-8") as f:
+            reference = f.read().strip()
+        audio_path = os.path.join(audio_dir, file_name)
+        manifest[file_name] = {"audio": file_hash(audio_path), "reference": file_hash(reference_path)}
+        dataset.append({"file_name": file_name, "audio": load_audio_file(audio_path), "reference": reference})
+
+    manifest_path = os.path.join(audio_dir, MANIFEST_FILE_NAME)
+    if os.path.exists(manifest_path) and not update_manifest:
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            expected = json.load(f)
+        changed = sorted(name for name in set(expected) | set(manifest) if expected.get(name) != manifest.get(name))
+        if changed:
+            raise ValueError(f"{audio_dir} does not match {MANIFEST_FILE_NAME} "
+                             f"(run with --update-manifest to accept): {', '.join(changed)}")
+    else:
+        with open(manifest_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2, sort_keys=True)
+    fingerprint = hashlib.sha256(json.dumps(manifest, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+    return dataset, fingerprint
+
+
+def transcribe_all(transcriber: Transcriber, dataset: List[dict], batch_size: int) -> List[tuple]:
+    """
+    :return: List[(str, float)]  dataset と同じ順の書きおこし結果と, その書きおこしにかかった秒数.
+    バッチの場合はバッチの時間を音声の長さで按分する
+    """
+    outputs = []
+    for i in range(0, len(dataset), batch_size):
+        batch = dataset[i:i + batch_size]
+        start = time.perf_counter()
+        if batch_size == 1:
+            texts = [transcriber.transcribe(batch[0]["file_name"], audio=batch[0]["audio"])["text"]]
+        else:
+            results = transcriber.transcribe_batch([item["file_name"] for item in batch], [""] * len(batch),
+                                                   audios=[item["audio"] for item in batch])
+            texts = [result["text"] for result in results]
+        elapsed = time.perf_counter() - start
+        total = sum(len(item["audio"]) for item in batch)
+        outputs.extend((text, elapsed * len(item["audio"]) / total) for text, item in zip(texts, batch))
+    return outputs
+
+
+def run(config: dict, dataset: List[dict], batch_size: int = 1, fingerprint: str = "") -> dict:
+    transcriber = Transcriber(data_path="", save_path="", target_dir="", config=config)
+    start = time.perf_counter()
+    transcriber.make_model()
+    load_seconds = time.perf_counter() - start
+    # 初回の推論はカーネルの初期化などを含むので計測から除く
+    transcriber.transcribe("warmup", audio=dataset[0]["audio"])
+
+    audio_seconds = 0.0
+    decode_seconds = 0.0
+    char_errors = char_total = word_errors = word_total = 0
+    files = []
+    encoder_seconds = ENCODER_INPUT_SECONDS.total()
+    for item, (text, elapsed) in zip(dataset, transcribe_all(transcriber, dataset, batch_size)):
+        duration = len(item["audio"]) / SAMPLE_RATE
+        audio_seconds += duration
+        decode_seconds += elapsed
+
+        reference = normalize(item["reference"])
+        hypothesis = normalize(text)
+        chars = edit_distance(list(reference.replace(" ", "")), list(hypothesis.replace(" ", "")))
+        words = edit_distance(reference.split(), hypothesis.split())
+        char_errors += chars
+        char_total += len(reference.replace(" ", ""))
+        word_errors += words
+        word_total += len(reference.split())
+        files.append({"file_name": item["file_name"], "audio_seconds": round(duration, 3),
+                      "decode_seconds": round(elapsed, 3), "text": text})
+
+    return {
+        "config": config,
+        "dataset": fingerprint,
+        "load_seconds": round(load_seconds, 3),
+        "audio_seconds": round(audio_seconds, 3),
+        "decode_seconds": round(decode_seconds, 3),
+        "rtf": round(decode_seconds / audio_seconds, 4),
+        # バッチで書きおこした場合の, 発話 1 件あたりのエンコーダの入力の秒数
+        "encoder_input_seconds_per_utterance": round(
+            (ENCODER_INPUT_SECONDS.total() - encoder_seconds) / len(dataset), 3),
+        # 日本語は単語の区切りが無いので CER を主な指標にする
+        "cer": round(char_errors / max(char_total, 1), 4),
+        "wer": round(word_errors / max(word_total, 1), 4),
+        "files": files,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--audio-dir", default=DEFAULT_AUDIO_DIR, help="音声ファイルと正解テキストを置いたディレクトリ")
+    parser.add_argument("--update-manifest", action="store_true", help="manifest.json を今のファイルで書き直す")
+    parser.add_argument("--config", action="append", type=json.loads,
+                        help="Transcriber の config (JSON). 複数指定できる")
+    parser.add_argument("--batch-size", type=int, default=1, help="transcribe_batch にまとめる発話数")
+    parser.add_argument("--output", help="結果を保存する JSON ファイル")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.audio_dir):
+        parser.error("audio directory not found: " + args.audio_dir)
+    try:
+        dataset, fingerprint = load_dataset(args.audio_dir, update_manifest=args.update_manifest)
+    except ValueError as e:
+        parser.error(str(e))
+    if not dataset:
+        parser.error("no audio files with reference text in " + args.audio_dir)
+    print(f"dataset {fingerprint}: {len(dataset)} files")
+
+    results = []
+    for config in args.config or DEFAULT_CONFIGS:
+        result = run(config, dataset, batch_size=args.batch_size, fingerprint=fingerprint)
+        results.append(result)
+        print(f"{json.dumps(config)}: rtf={result['rtf']} cer={result['cer']} wer={result['wer']} "
+              f"load={result['load_seconds']}s")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""
+ベンチマーク用に OpenAI の chat completions API と Google Custom Search API の代わりをするローカルサーバー
+
+応答は入力から決定的に作り, latency 秒だけ待ってから返す.
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# ストリーミングの応答で 1 チャンクに入れる文字数
+STREAM_CHARS = 8
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    """
+    POST /v1/chat/completions に対してプロンプトの末尾を返す
+    """
+
+    server: "FakeServer"
+
+    def do_POST(self) -> None:
+        if not self.path.endswith("/chat/completions"):
+            self.send_error(404)
+            return
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        prompt = request["messages"][-1]["content"]
+        time.sleep(self.server.latency)
+        content = prompt[-self.server.max_chars:]
+        self.server.record(len(prompt), len(content))
+        if request.get("stream"):
+            self.send_stream(request, prompt, content)
+            return
+        body = json.dumps({
+            "id": "chatcmpl-fake",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request["model"],
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            # 日本語はおおよそ 1 文字 1 トークンとして数える
+            "usage": {"prompt_tokens": len(prompt), "completion_tokens": len(content),
+                      "total_tokens": len(prompt) + len(content)},
+        }, ensure_ascii=False).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_stream(self, request: dict, prompt: str, content: str) -> None:
+        """
+        stream: true のリクエストに chat.completion.chunk を STREAM_CHARS 文字ずつ Server-Sent Events で返す
+        """
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+
+        def chunk(choices: list, usage: dict = None) -> bytes:
+            data = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": int(time.time()),
+                    "model": request["model"], "choices": choices}
+            if usage is not None:
+                data["usage"] = usage
+            return f"data: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8")
+
+        for i in range(0, len(content), STREAM_CHARS):
+            self.wfile.write(chunk([{"index": 0, "delta": {"content": content[i:i + STREAM_CHARS]},
+                                     "finish_reason": None}]))
+        self.wfile.write(chunk([{"index": 0, "delta": {}, "finish_reason": "stop"}]))
+        if request.get("stream_options", {}).get("include_usage"):
+            self.wfile.write(chunk([], {"prompt_tokens": len(prompt), "completion_tokens": len(content),
+                                        "total_tokens": len(prompt) + len(content)}))
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+
+class FakeSearchHandler(BaseHTTPRequestHandler):
+    """
+    GET /customsearch/v1?q=...&num=... に対して num 件の検索結果を返す
+    """
+
+    server: "FakeServer"
+
+    def do_GET(self) -> None:
+        query = parse_qs(urlparse(self.path).query)
+        keyword = query.get("q", [""])[0]
+        num = int(query.get("num", ["3"])[0])
+        time.sleep(self.server.latency)
+        self.server.record(len(keyword), num)
+        body = json.dumps({"items": [{"title": f"{keyword} {i}", "link": f"https://example.com/{i}"}
+                                     for i in range(num)]}, ensure_ascii=False).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+
+class FakeServer(ThreadingHTTPServer):
+    """
+    別スレッドで動くローカルの HTTP サーバー. 受け取ったリクエストの数を数える
+    """
+
+    daemon_threads = True
+
+    def __init__(self, handler_class, latency: float = 0.0, max_chars: int = 200) -> None:
+        """
+        :param handler_class: FakeOpenAIHandler | FakeSearchHandler
+        :param latency: float  応答を返すまでに待つ秒数
+        :param max_chars: int  FakeOpenAIHandler が返す文字数の上限
+        """
+        super().__init__(("127.0.0.1", 0), handler_class)
+        self.latency = latency
+        self.max_chars = max_chars
+        self.requests = 0
+        self.units_in = 0
+        self.units_out = 0
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self) -> "FakeServer":
+        self._thread.start()
+        return self
+
+    def record(self, units_in: int, units_out: int) -> None:
+        with self._lock:
+            self.requests += 1
+            self.units_in += units_in
+            self.units_out += units_out
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {"requests": self.requests, "units_in": self.units_in, "units_out": self.units_out}
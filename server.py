@@ -1,19 +1,43 @@
+import asyncio
+import json
 import logging
 import os
+import time
 
 import uvicorn
-from fastapi import FastAPI, status
+from fastapi import Depends, FastAPI, WebSocket, WebSocketDisconnect, status
 from fastapi.datastructures import UploadFile
 from fastapi.exceptions import RequestValidationError
 from pydantic import BaseModel
+from starlette.concurrency import run_in_threadpool
 from starlette.requests import Request
-from starlette.responses import JSONResponse
+from starlette.responses import JSONResponse, Response, StreamingResponse
 from starlette.staticfiles import StaticFiles
 
-from src.revise.revise import Reviser
-from src.search.search import TextAnalyzer
-from src.summarize.summarize import Summarizer
-from src.transcribe.transcribe import Transcriber
+from src.custom_logging import setup_logging
+from src.startup.startup import StartupProfiler, WarmUp
+
+# ログはキューを経由して別スレッドでファイルに書き込む. src 以下のモジュールの basicConfig より先に設定する
+log_listener = setup_logging(os.environ.get("LOG_FILE", "api.log"),
+                             max_lines=int(os.environ.get("LOG_MAX_LINES", 1000)),
+                             json_format=os.environ.get("LOG_FORMAT", "text") == "json")
+
+# 起動の各段階にかかった時間を記録する. 詳細な import の内訳は python -X importtime server.py で確認できる
+startup_profiler = StartupProfiler()
+with startup_profiler.phase("import pipeline modules"):
+    from src.index.index import TextIndex
+    from src.metrics.metrics import ACTIVE_SESSIONS, HTTP_REQUEST_SECONDS, QUEUE_DEPTH, REGISTRY
+    from src.metrics.tracing import start_trace
+    from src.revise.revise import Reviser
+    from src.scheduler.scheduler import PipelineScheduler
+    from src.search.nlp import get_nlp
+    from src.search.search import TextAnalyzer
+    from src.session.session import Session, SessionManager, check_dir_name
+    from src.summarize.summarize import Summarizer
+    from src.transcribe.job_queue import QueueFullError, TranscriptionQueue
+    from src.transcribe.audio import decode_wav
+    from src.transcribe.streaming import StreamingSession
+    from src.transcribe.transcribe import Transcriber
 
 logger = logging.getLogger(__name__)
 
@@ -27,25 +51,146 @@ class SelectDir(BaseModel):
 
 
 ALLOWED_EXTENSIONS = {'m4a', 'mp3', 'wav'}
+# セッション ID はクッキーかヘッダーで受け取る. ヘッダーが優先される
+SESSION_COOKIE_NAME = "session_id"
+SESSION_HEADER_NAME = "X-Session-ID"
+# TRACE_REQUESTS=1 ですべてのリクエストを, それ以外はヘッダー X-Trace: 1 を付けたリクエストだけをトレースする
+TRACE_REQUESTS = os.environ.get("TRACE_REQUESTS", "0") == "1"
+TRACE_HEADER_NAME = "X-Trace"
+# 受け取った音声を data/recorded/<dir> のアーカイブに保存するか. 保存はレスポンスとは非同期に行う
+ARCHIVE_AUDIO = os.environ.get("ARCHIVE_AUDIO", "1") == "1"
+# 録音中に書きおこし結果が増えたら, 校正, 要約の map, キーワードの検索をバックグラウンドで先に進めるか
+EAGER_PIPELINE = os.environ.get("EAGER_PIPELINE", "1") == "1"
+text_index = TextIndex("./data/index.sqlite3")
 transcriber = Transcriber(data_path="./data/recorded",
                           save_path="./data/transcribed",
                           target_dir="dummy",
-                          config={"model_name": "small", "device": "cuda:0"})
-transcriber.make_model()
+                          config={"backend": os.environ.get("TRANSCRIBE_BACKEND", "whisper"),
+                                  "model_name": os.environ.get("TRANSCRIBE_MODEL", "small"),
+                                  "device": os.environ.get("TRANSCRIBE_DEVICE", "cuda:0"),
+                                  "compute_type": os.environ.get("TRANSCRIBE_COMPUTE_TYPE", "int8"),
+                                  "cpu_threads": int(os.environ.get("TRANSCRIBE_CPU_THREADS", 0)),
+                                  # バッチ推論でのエンコーダへの入れ方: pad | pack | trim
+                                  "batch_mode": os.environ.get("TRANSCRIBE_BATCH_MODE", "pad"),
+                                  # TRANSCRIBE_BACKEND=remote の場合に接続するモデルサーバー
+                                  "socket_path": os.environ.get("TRANSCRIBE_SOCKET", "./data/model_server.sock")},
+                          index=text_index)
+transcription_queue = TranscriptionQueue(transcriber,
+                                         num_workers=int(os.environ.get("TRANSCRIBE_WORKERS", 1)),
+                                         max_queue_size=int(os.environ.get("TRANSCRIBE_QUEUE_SIZE", 32)),
+                                         max_batch_size=int(os.environ.get("TRANSCRIBE_MAX_BATCH_SIZE", 8)),
+                                         max_batch_wait=float(os.environ.get("TRANSCRIBE_MAX_BATCH_WAIT", 0.05)))
 reviser = Reviser(data_path="./data/transcribed",
                   save_path="./data/revised",
-                  target_dir="dummy")
+                  target_dir="dummy",
+                  index=text_index)
 summarizer = Summarizer(data_path="./data/revised",
                         save_path="./data/summarized",
-                        target_dir="dummy")
+                        target_dir="dummy",
+                        index=text_index)
 searcher = TextAnalyzer(data_path="./data/summarized",
                         save_path="./data/searched",
                         target_dir="dummy")
+# 上の 4 つはモデルなどを共有するためのもので, リクエストはセッションごとのコピーで処理する
+sessions = SessionManager(transcriber, reviser, summarizer, searcher,
+                          ttl=float(os.environ.get("SESSION_TTL", 12 * 60 * 60)),
+                          max_sessions=int(os.environ.get("MAX_SESSIONS", 256)))
+eager_scheduler = PipelineScheduler(debounce=float(os.environ.get("EAGER_DEBOUNCE", 10)),
+                                    max_delay=float(os.environ.get("EAGER_MAX_DELAY", 60)),
+                                    max_workers=int(os.environ.get("EAGER_WORKERS", 2)))
+QUEUE_DEPTH.set_function(transcription_queue.qsize)
+ACTIVE_SESSIONS.set_function(lambda: len(sessions.sessions))
+startup_profiler.mark("pipeline objects created")
+
+# whisper などの重い import とモデルの読み込みはポートを開いてからバックグラウンドで行う
+warm_up = WarmUp(startup_profiler)
+for module_name in transcriber.backend_class.modules:
+    warm_up.add_import(module_name)
+warm_up.add_step("load transcription model", transcriber.make_model, ready=True)
+warm_up.add_step("load spacy model", lambda: get_nlp("ja"))
 
 app = FastAPI()
 app.mount("/static", StaticFiles(directory="./static", html=True), name="static")
 
 
+@app.middleware("http")
+async def attach_session(request: Request, call_next):
+    """
+    /api 以下のリクエストにセッションを割り当てる. 新しいセッションの場合はクッキーで ID を返す
+    :param request: Request
+    :param call_next:
+    :return: Response
+    """
+    if not request.url.path.startswith("/api/"):
+        return await call_next(request)
+    session_id = request.headers.get(SESSION_HEADER_NAME) or request.cookies.get(SESSION_COOKIE_NAME)
+    session, _ = sessions.get(session_id)
+    request.state.session = session
+    response = await call_next(request)
+    if request.cookies.get(SESSION_COOKIE_NAME) != session.session_id:
+        response.set_cookie(SESSION_COOKIE_NAME, session.session_id, httponly=True, samesite="lax")
+    response.headers[SESSION_HEADER_NAME] = session.session_id
+    return response
+
+
+@app.middleware("http")
+async def observe_request(request: Request, call_next):
+    """
+    リクエストの所要時間を記録する. トレースする場合は段階ごとの時間を Server-Timing ヘッダーで返し, ログに残す
+    :param request: Request
+    :param call_next:
+    :return: Response
+    """
+    start = time.perf_counter()
+    if TRACE_REQUESTS or request.headers.get(TRACE_HEADER_NAME) == "1":
+        with start_trace(request.method + " " + request.url.path) as trace:
+            response = await call_next(request)
+        response.headers["Server-Timing"] = trace.server_timing()
+        response.headers["X-Trace-ID"] = trace.trace_id
+        logger.info(json.dumps(trace.to_dict(), ensure_ascii=False))
+    else:
+        response = await call_next(request)
+    # パスパラメータごとに系列が増えないよう, ルートのパスをラベルにする
+    route = request.scope.get("route")
+    HTTP_REQUEST_SECONDS.observe(time.perf_counter() - start, method=request.method,
+                                 route=route.path if route is not None else "unmatched",
+                                 status=str(response.status_code))
+    return response
+
+
+def current_session(request: Request) -> Session:
+    """
+    attach_session で割り当てたセッションを返す
+    :param request: Request
+    :return: Session
+    """
+    return request.state.session
+
+
+@app.on_event("startup")
+async def startup():
+    """
+    モデルの読み込みと書きおこしのワーカーを起動する
+    :return:
+    """
+    warm_up.start()
+    transcription_queue.start()
+    if EAGER_PIPELINE:
+        eager_scheduler.start()
+    startup_profiler.mark("server started")
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    """
+    書きおこしのワーカーを停止し, 残っているログを書き出す
+    :return:
+    """
+    transcription_queue.stop()
+    eager_scheduler.stop()
+    log_listener.stop()
+
+
 @app.get("/")
 async def root():
     """
@@ -58,6 +203,42 @@ async def root():
     )
 
 
+@app.get("/health")
+async def health():
+    """
+    プロセスが応答できるかを返す (liveness)
+    :return: JSONResponse
+    """
+    return JSONResponse(
+        status_code=status.HTTP_200_OK,
+        content={"status": "ok"}
+    )
+
+
+@app.get("/ready")
+async def ready():
+    """
+    書き起こしのモデルが使えるかを返す (readiness). 起動の各段階にかかった時間も返す
+    :return: JSONResponse  準備ができていなければ 503
+    """
+    content = {"ready": warm_up.ready.is_set(), "startup": startup_profiler.to_dict()}
+    if warm_up.error is not None:
+        content["message"] = warm_up.error
+    return JSONResponse(
+        status_code=status.HTTP_200_OK if warm_up.ready.is_set() else status.HTTP_503_SERVICE_UNAVAILABLE,
+        content=content
+    )
+
+
+@app.get("/metrics")
+async def metrics():
+    """
+    Prometheus 形式のメトリクスを返す
+    :return: Response
+    """
+    return Response(content=REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 @app.get("/api/get_dir_list")
 async def get_dir_list() -> JSONResponse:
     """
@@ -80,17 +261,33 @@ async def get_dir_list() -> JSONResponse:
         )
 
 
+@app.get("/api/session")
+async def get_session(session: Session = Depends(current_session)):
+    """
+    セッション ID と現在のディレクトリを返す
+    :param session: Session
+    :return: JSONResponse
+    """
+    return JSONResponse(
+        status_code=status.HTTP_200_OK,
+        content=session.to_dict()
+    )
+
+
 @app.get("/api/start_recording")
-async def start_recording():
+async def start_recording(session: Session = Depends(current_session)):
     """
     録音を開始する
+    :param session: Session
     :return: JSONResponse
     """
     try:
-        if len(os.listdir(os.path.join(transcriber.data_path, transcriber.target_dir))) > 0:
-            # target_dir にファイルが存在する場合は削除する
-            for file_name in os.listdir(os.path.join(transcriber.data_path, transcriber.target_dir)):
-                os.remove(os.path.join(transcriber.data_path, transcriber.target_dir, file_name))
+        # target_dir にファイルが存在する場合は録音と書きおこし結果を削除する
+        eager_scheduler.cancel(session)
+        target_dir = session.target_dir
+        transcriber.delete_audio(target_dir)
+        transcriber.delete_transcripts(target_dir)
+        text_index.delete(target_dir, kind="transcript")
         return JSONResponse(
             status_code=status.HTTP_200_OK,
             content={"message": "OK"}
@@ -104,17 +301,35 @@ async def start_recording():
         )
 
 
+def run_summarize(session: Session, listener=None) -> tuple:
+    """
+    セッションの書き起こしを統合, 校正, 要約する
+    :param session: Session
+    :param listener: Listener | None  途中経過を受け取る関数
+    :return: (str, str)  校正されたテキストと要約されたテキスト
+    """
+    with session.lock:
+        if listener is not None:
+            listener("stage", {"stage": "integrate"})
+        session.transcriber.integrate_texts()
+        revised_text = session.reviser.revise("integrated.json", listener=listener)
+        summarized_text = session.summarizer.summarize("revised_integrated.json", listener=listener)
+        session.summarizer.save_text("summarized.json")
+    return revised_text, summarized_text
+
+
 @app.get("/api/summarize")
-async def summarize():
+async def summarize(session: Session = Depends(current_session)):
     """
     書き起こしたテキストを要約する
+    :param session: Session
     :return: JSONResponse  要約されたテキスト
     """
     try:
-        transcriber.integrate_texts()
-        revised_text = reviser.revise("integrated.json")
-        summarized_text = summarizer.summarize("revised_integrated.json")
-        summarizer.save_text("summarized.json")
+        # 先に進めている処理は段落・チャンクの区切りで止まり, 結果はキャッシュから使われる
+        eager_scheduler.cancel(session)
+        # LLM の呼び出しを待つ間も他のセッションのリクエストを処理できるようにする
+        revised_text, summarized_text = await run_in_threadpool(run_summarize, session)
         # revised_text = {"text": "revised text"}
         # summarized_text = {"text": "summarized text"}
         return JSONResponse(
@@ -133,27 +348,152 @@ async def summarize():
         )
 
 
+# 接続が切れても最後まで実行して保存する要約のタスク. 実行中に GC されないように参照を持つ
+summarize_tasks = set()
+
+
+def format_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@app.get("/api/summarize/stream")
+async def summarize_stream(session: Session = Depends(current_session)):
+    """
+    /api/summarize と同じ処理の途中経過を Server-Sent Events で送る
+
+    event は stage (段階の開始), token (生成中のトークン), result (段落・チャンクごとの結果),
+    done (校正されたテキストと要約されたテキスト), failed (エラー) の順に届く.
+    token と result の data は stage ("revise", "summarize_map", "summarize_collapse", "summarize_reduce") と
+    段落・チャンクの index を持つ. 結果の保存は最後に行い, 途中で接続が切れても続ける.
+    :param session: Session
+    :return: StreamingResponse  text/event-stream
+    """
+    loop = asyncio.get_running_loop()
+    events: asyncio.Queue = asyncio.Queue()
+
+    def listener(event: str, data: dict) -> None:
+        # スレッドプールから呼ばれる
+        loop.call_soon_threadsafe(events.put_nowait, (event, data))
+
+    async def run() -> None:
+        try:
+            revised_text, summarized_text = await run_in_threadpool(run_summarize, session, listener)
+            events.put_nowait(("done", {"revised_text": revised_text, "summarized_text": summarized_text}))
+        except Exception as e:
+            logger.error(e)
+            events.put_nowait(("failed", {"message": str(e)}))
+        events.put_nowait(None)
+
+    eager_scheduler.cancel(session)
+    task = asyncio.create_task(run())
+    summarize_tasks.add(task)
+    task.add_done_callback(summarize_tasks.discard)
+
+    async def stream():
+        while True:
+            item = await events.get()
+            if item is None:
+                break
+            yield format_event(*item)
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+def read_text_file(path: str) -> str:
+    """
+    校正結果・要約の JSON ファイルからテキストを読む
+    :param path: str
+    :return: str  ファイルが無い場合は空文字
+    """
+    if not os.path.exists(path):
+        return ""
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)["text"]
+
+
+def load_session_text(session: Session, cursor: str, limit: int) -> dict:
+    """
+    セッションの書き起こしを limit 件読む. 先頭のページには校正結果と要約も含める
+    :param session: Session
+    :param cursor: str | None
+    :param limit: int
+    :return: dict
+    """
+    # まだ何も書きおこしていないセッションのために store のファイルを作らない
+    store = session.transcriber.store(create=False)
+    segments, next_cursor = store.page(cursor, limit=limit) if store is not None else ([], None)
+    content = {
+        "text": "\n".join(segment["text"] for segment in segments),
+        "segments": segments,
+        "next_cursor": next_cursor,
+    }
+    if cursor is None:
+        target_dir = session.target_dir
+        content["revised_text"] = read_text_file(
+            os.path.join(session.reviser.save_path, target_dir, "revised_integrated.json"))
+        content["summarized_text"] = read_text_file(
+            os.path.join(session.summarizer.save_path, target_dir, "summarized.json"))
+    return content
+
+
 @app.get("/api/load_all_text")
-async def load_all_text():
+async def load_all_text(cursor: str = None, limit: int = 100, session: Session = Depends(current_session)):
     """
-    書き起こしたテキストを全て読み込む
-    :return:
+    書き起こしたテキストをタイムスタンプ順に limit 件ずつ読み込む
+    next_cursor を cursor に指定すると続きを返す. next_cursor が null なら最後のページ
+    :param cursor: str | None  前のページの next_cursor
+    :param limit: int  1 ページの件数
+    :param session: Session
+    :return: JSONResponse  text, segments, next_cursor. 先頭のページは revised_text, summarized_text も含む
     """
     try:
-        # todo: ファイルの読み込みでtext 定義ができるようにする
-        text = "transcribed text"
-        revised_text = "revised text"
-        summarized_text = "summarized text"
-        content = {
-            "text": text,
-            "revised_text": revised_text,
-            "summarized_text": summarized_text
-        }
+        if not 0 < limit <= 1000:
+            return JSONResponse(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                content={"message": "limit must be between 1 and 1000"}
+            )
+        content = await run_in_threadpool(load_session_text, session, cursor, limit)
         return JSONResponse(
             status_code=status.HTTP_200_OK,
             content=content
         )
 
+    except ValueError as e:
+        return JSONResponse(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            content={"message": str(e)}
+        )
+
+    except Exception as e:
+        logger.error(e)
+        return JSONResponse(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            content={"message": str(e)}
+        )
+
+
+@app.get("/api/transcript_detail")
+async def transcript_detail(file_name: str, session: Session = Depends(current_session)):
+    """
+    発話の whisper の結果 (tokens, avg_logprob など) をすべて返す
+    :param file_name: str  発話のファイル名
+    :param session: Session
+    :return: JSONResponse
+    """
+    try:
+        store = await run_in_threadpool(session.transcriber.store, None, False)
+        detail = await run_in_threadpool(store.detail, file_name) if store is not None else None
+        if detail is None:
+            return JSONResponse(
+                status_code=status.HTTP_404_NOT_FOUND,
+                content={"message": "Segment not found"}
+            )
+        return JSONResponse(
+            status_code=status.HTTP_200_OK,
+            content=detail
+        )
+
     except Exception as e:
         logger.error(e)
         return JSONResponse(
@@ -163,13 +503,14 @@ async def load_all_text():
 
 
 @app.get("/api/get_useful_info")
-async def get_useful_info():
+async def get_useful_info(session: Session = Depends(current_session)):
     """
     有益な情報のリストdict形式で返す
+    :param session: Session
     :return: JSONResponse
     """
     try:
-        content = searcher.analyze_text("summarized.json", lang='ja')
+        content = await run_in_threadpool(session.searcher.analyze_text, "summarized.json", lang='ja')
         useful_info = {
             "useful_info": content
         }
@@ -186,6 +527,34 @@ async def get_useful_info():
         )
 
 
+@app.get("/api/search_text")
+async def search_text(q: str, limit: int = 20):
+    """
+    過去のセッションの書き起こし・校正結果・要約を全文検索する
+    :param q: str  検索語
+    :param limit: int  返す件数の上限
+    :return: JSONResponse  スコア順のセッション・セグメント・タイムスタンプ・抜粋のリスト
+    """
+    try:
+        if not 0 < limit <= 100:
+            return JSONResponse(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                content={"message": "limit must be between 1 and 100"}
+            )
+        hits = await run_in_threadpool(text_index.search, q, limit)
+        return JSONResponse(
+            status_code=status.HTTP_200_OK,
+            content={"hits": hits}
+        )
+
+    except Exception as e:
+        logger.error(e)
+        return JSONResponse(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            content={"message": str(e)}
+        )
+
+
 @app.post("/api/create_dir")
 async def create_dir(request: SelectDir, status_code=status.HTTP_200_OK):
     """
@@ -195,7 +564,7 @@ async def create_dir(request: SelectDir, status_code=status.HTTP_200_OK):
     :return: JSONResponse
     """
     try:
-        dir_name = request.dir
+        dir_name = check_dir_name(request.dir)
         if not os.path.exists(os.path.join(transcriber.data_path, dir_name)):
             os.mkdir(os.path.join(transcriber.data_path, dir_name))
         else:
@@ -208,6 +577,12 @@ async def create_dir(request: SelectDir, status_code=status.HTTP_200_OK):
             content={"message": "OK"}
         )
 
+    except ValueError as e:
+        return JSONResponse(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            content={"message": str(e)}
+        )
+
     except Exception as e:
         logger.error(e)
         return JSONResponse(
@@ -216,44 +591,125 @@ async def create_dir(request: SelectDir, status_code=status.HTTP_200_OK):
         )
 
 
+def schedule_eager_pipeline(session: Session, texts: list) -> None:
+    """
+    書きおこし結果が保存されたセッションの校正, 要約の map などをバックグラウンドで進めるよう予約する
+    :param session: Session
+    :param texts: list  保存された書きおこし結果のテキスト
+    :return: None
+    """
+    if EAGER_PIPELINE and any(text.strip() for text in texts):
+        eager_scheduler.notify(session)
+
+
+def archive_audio(target_dir: str, file_name: str, content: bytes) -> None:
+    """
+    受け取った音声を target_dir のアーカイブに追記する. WAV は圧縮して保存する
+    :param target_dir: str
+    :param file_name: str
+    :param content: bytes  音声ファイルの中身
+    :return: None
+    """
+    try:
+        audio = decode_wav(content)
+        if audio is not None:
+            transcriber.archive(target_dir).append(file_name, audio=audio)
+        else:
+            transcriber.archive(target_dir).append(file_name, data=content)
+    except Exception as e:
+        logger.error(e)
+
+
 @app.post("/api/transcribe")
-async def transcribe(request: Request, status_code=status.HTTP_200_OK):
+async def transcribe(request: Request, session: Session = Depends(current_session),
+                     status_code=status.HTTP_202_ACCEPTED):
     """
-    音声ファイルを受け取り、書き起こしを行う
+    音声ファイルを受け取り、セッションのディレクトリへの書き起こしジョブを投入する
+    結果は /api/transcribe/{job_id} で取得する
     :param request: Request  リクエスト
+    :param session: Session
     :param status_code: int  ステータスコード
-    :return: JSONResponse
+    :return: JSONResponse  ジョブ ID
     """
     try:
+        if not warm_up.ready.is_set():
+            return JSONResponse(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                headers={"Retry-After": "5"},
+                content={"message": "Model is loading"}
+            )
         form_data = await request.form()
         uploaded_file = form_data['file']
 
-        # ファイルをサーバー上に保存
         file_name = uploaded_file.filename
-        file_path = os.path.join(transcriber.data_path, transcriber.target_dir, file_name)
+        if file_name.rsplit('.', 1)[-1].lower() not in ALLOWED_EXTENSIONS:
+            return JSONResponse(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                content={"message": "Unsupported file type"}
+            )
+        target_dir = session.target_dir
+        content = await uploaded_file.read()
 
-        with open(file_path, "wb") as file:
-            file.write(uploaded_file.file.read())
+        # 書きおこしはメモリ上の音声から行い, ファイルの保存は裏で行う
+        job = transcription_queue.submit(file_name, target_dir=target_dir, data=content)
 
-        # レスポンスに保存したファイルのパスを含めることもできます
-        file_info = {
-            "filename": file_name,
-            "content_type": uploaded_file.content_type,
-            "file_size": len(uploaded_file.file.read()),
-            "saved_path": file_path  # ファイルの保存パス
-        }
+        def on_done(future) -> None:
+            # ワーカースレッドで呼ばれる
+            if future.exception() is None:
+                schedule_eager_pipeline(session, [future.result()])
 
-        text = transcriber.save_text(file_name=file_name)
-        # todo: リアルタイムで校正する場合revised text も変数として定義する
-        # revised_text = reviser.revise(text) みたいな感じで実装
+        job.future.add_done_callback(on_done)
+        if ARCHIVE_AUDIO:
+            asyncio.get_running_loop().run_in_executor(None, archive_audio, target_dir, file_name, content)
+        return JSONResponse(
+            status_code=status.HTTP_202_ACCEPTED,
+            content={"job_id": job.job_id, "status": job.status}
+        )
+
+    except QueueFullError as e:
+        logger.warning(e)
+        return JSONResponse(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            headers={"Retry-After": "1"},
+            content={"message": str(e)}
+        )
 
-        # WAVファイルの処理を行うことができます
-        # この例ではファイルを受け取り、その情報をJSONレスポンスで返します
+    except Exception as e:
+        logger.error(e)
+        return JSONResponse(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            content={"message": str(e)}
+        )
+
+
+@app.get("/api/transcribe/{job_id}")
+async def get_transcribe_result(job_id: str, timeout: float = 0.0):
+    """
+    書き起こしジョブの状態と結果を返す
+    timeout を指定した場合は完了するまで最大 timeout 秒待つ (long polling)
+    :param job_id: str  ジョブ ID
+    :param timeout: float  待機する秒数
+    :return: JSONResponse  ジョブの状態. 完了していれば text を含む
+    """
+    try:
+        job = transcription_queue.get(job_id)
+        if job is None:
+            return JSONResponse(
+                status_code=status.HTTP_404_NOT_FOUND,
+                content={"message": "Job not found"}
+            )
+        if timeout > 0 and not job.future.done():
+            try:
+                await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(job.future)), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+            except Exception:
+                # ジョブの失敗は to_dict の message で返す
+                pass
         return JSONResponse(
             status_code=status.HTTP_200_OK,
-            content={"text": text}
+            content=job.to_dict()
         )
-        # return JSONResponse(status_code=status.HTTP_200_OK, content={"text": text, "revised_text": revised_text})
 
     except Exception as e:
         logger.error(e)
@@ -263,25 +719,79 @@ async def transcribe(request: Request, status_code=status.HTTP_200_OK):
         )
 
 
+@app.websocket("/ws/transcribe")
+async def transcribe_stream(websocket: WebSocket):
+    """
+    16 kHz モノラル float32 の PCM をバイナリフレームで受け取り、逐次書き起こしを行う
+    途中結果は {"type": "partial", "text": ...}、確定結果は {"type": "final", "text": ...} で返す
+    テキストフレームで {"type": "stop"} を送ると残りの音声を確定させて終了する
+    セッションは HTTP の API と同じくクッキーかヘッダーで指定する
+    :param websocket: WebSocket
+    :return: None
+    """
+    await websocket.accept()
+    if not warm_up.ready.is_set():
+        # 1013: Try Again Later
+        await websocket.close(code=1013)
+        return
+    session_id = websocket.headers.get(SESSION_HEADER_NAME) or websocket.cookies.get(SESSION_COOKIE_NAME)
+    user_session, _ = sessions.get(session_id)
+    session = StreamingSession(transcriber, target_dir=user_session.target_dir, archive=ARCHIVE_AUDIO)
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            if message.get("bytes") is not None:
+                session.feed(message["bytes"])
+                if session.ready():
+                    events = await run_in_threadpool(session.process)
+                    for event in events:
+                        await websocket.send_json(event)
+                    schedule_eager_pipeline(user_session, [event["text"] for event in events
+                                                           if event["type"] == "final"])
+            elif message.get("text") is not None:
+                if json.loads(message["text"]).get("type") == "stop":
+                    for event in await run_in_threadpool(session.flush):
+                        await websocket.send_json(event)
+                    await websocket.close()
+                    return
+        # 切断された場合も受け取った音声は確定させて保存する
+        await run_in_threadpool(session.flush)
+
+    except WebSocketDisconnect:
+        await run_in_threadpool(session.flush)
+
+    except Exception as e:
+        logger.error(e)
+        await websocket.close(code=1011)
+
+
 @app.post("/api/set_dir")
-async def set_dir(request: SelectDir, status_code=status.HTTP_200_OK):
+async def set_dir(request: SelectDir, session: Session = Depends(current_session),
+                  status_code=status.HTTP_200_OK):
     """
-    音声ファイルが保存されているディレクトリを設定する
+    セッションで使う, 音声ファイルが保存されているディレクトリを設定する
     :param request: Request  リクエスト
+    :param session: Session
     :param status_code: int  ステータスコード
     :return: JSONResponse
     """
     try:
-        target_dir = request.dir
-        transcriber.target_dir = target_dir
-        reviser.target_dir = target_dir
-        summarizer.target_dir = target_dir
-        searcher.target_dir = target_dir
+        check_dir_name(request.dir)
+        eager_scheduler.cancel(session)
+        session.set_dir(request.dir)
         return JSONResponse(
             status_code=status.HTTP_200_OK,
             content={"message": "OK"}
         )
 
+    except ValueError as e:
+        return JSONResponse(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            content={"message": str(e)}
+        )
+
     except Exception as e:
         logger.error(e)
         return JSONResponse(
@@ -307,5 +817,5 @@ async def handler(request: Request, exc: RequestValidationError):
 
 if __name__ == '__main__':
     print(os.environ["OPENAI_API_KEY"])
-    logging.basicConfig(filename='api.log', level=logging.INFO)
+    # セッション, 書きおこしのジョブ, 先行処理の予約はプロセスのメモリに持つので, ワーカーは 1 つで動かす
     uvicorn.run(app, host="127.0.0.1", port=8000)
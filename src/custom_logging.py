@@ -1,26 +1,160 @@
+import contextlib
+import fcntl
+import json
 import logging
 import os
+import queue
+from logging.handlers import QueueHandler, QueueListener
+from typing import Iterator
+
+# LogRecord が標準で持つ属性. これ以外は extra で渡された項目として JSON に含める
+STANDARD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+DEFAULT_FORMAT = "%(asctime)s %(levelname)s:%(name)s:%(message)s"
 
 
 class CustomHandler(logging.FileHandler):
-    def emit(self, record):
-        # ログメッセージをファイルに書き込む前に行数をチェック
-        if self.should_trim_file():
-            self.trim_file()
-        logging.FileHandler.emit(self, record)
-
-    def should_trim_file(self):
-        # ファイルが存在しない場合はトリム不要
-        if not os.path.exists(self.baseFilename):
-            return False
-        # ファイルの行数をチェック
-        with open(self.baseFilename, 'r') as f:
-            lines = f.readlines()
-        return len(lines) > 1000
-
-    def trim_file(self):
-        # ファイルの行数が1000行を超えていたら、最新の1000行だけを残す
-        with open(self.baseFilename, 'r') as f:
-            lines = f.readlines()
-        with open(self.baseFilename, 'w') as f:
-            f.writelines(lines[-1000:])
\ No newline at end of file
+    """
+    max_lines 行を超えたらファイルを <filename>.1 に移して新しいファイルに書き込むハンドラー
+
+    行数はメモリ上で数え, 前回の書き込みの後に他のプロセスが書き足した分だけを読んで足すので,
+    1 レコードあたりのコストはファイルの大きさによらない.
+    複数のプロセスが同じファイルに書き込む場合も, 書き込みとローテーションは <filename>.lock の flock で直列にする.
+    直近 max_lines 行以上のログが <filename> と <filename>.1 に残る.
+    """
+
+    def __init__(self, filename: str, max_lines: int = 1000, mode: str = 'a', encoding: str = 'utf-8',
+                 delay: bool = False) -> None:
+        """
+        :param filename: str
+        :param max_lines: int  1 ファイルあたりの行数の上限
+        """
+        super().__init__(filename, mode=mode, encoding=encoding, delay=delay)
+        self.max_lines = max_lines
+        self.lock_fd = os.open(self.baseFilename + '.lock', os.O_WRONLY | os.O_CREAT, 0o644)
+        # 行数を数え終えたファイルの位置 (バイト数) と, そこまでの行数
+        self.counted_size = 0
+        self.line_count = 0
+        self.inode = os.fstat(self.stream.fileno()).st_ino if self.stream is not None else None
+        with self.file_lock():
+            self.sync()
+
+    @contextlib.contextmanager
+    def file_lock(self) -> Iterator[None]:
+        """
+        同じファイルに書き込む他のプロセスとの排他ロック
+
+        :return: Iterator[None]
+        """
+        fcntl.flock(self.lock_fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
+
+    def sync(self) -> None:
+        """
+        他のプロセスのローテーションと書き込みを line_count に反映する. file_lock を取って呼ぶ
+
+        :return: None
+        """
+        try:
+            stat = os.stat(self.baseFilename)
+        except FileNotFoundError:
+            stat = None
+        if stat is None or stat.st_ino != self.inode or stat.st_size < self.counted_size:
+            # 他のプロセスがローテーションした. 開いているのは <filename>.1 なので開き直す
+            if self.stream is not None:
+                self.stream.close()
+                self.stream = None
+            self.inode = stat.st_ino if stat is not None else None
+            self.counted_size = 0
+            self.line_count = 0
+        if stat is not None and stat.st_size > self.counted_size:
+            with open(self.baseFilename, 'rb') as f:
+                f.seek(self.counted_size)
+                self.line_count += sum(chunk.count(b'\n') for chunk in iter(lambda: f.read(1 << 20), b''))
+                self.counted_size = f.tell()
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            msg = self.format(record)
+            with self.file_lock():
+                self.sync()
+                if self.line_count >= self.max_lines:
+                    self.rotate()
+                if self.stream is None:
+                    self.stream = self._open()
+                    self.inode = os.fstat(self.stream.fileno()).st_ino
+                self.stream.write(msg + self.terminator)
+                self.flush()
+                self.line_count += msg.count('\n') + 1
+                self.counted_size = os.fstat(self.stream.fileno()).st_size
+        except RecursionError:
+            raise
+        except Exception:
+            self.handleError(record)
+
+    def rotate(self) -> None:
+        """
+        今のファイルを <filename>.1 に置き換えて, 次の書き込みで新しいファイルを開く. file_lock を取って呼ぶ
+
+        :return: None
+        """
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+        if os.path.exists(self.baseFilename):
+            os.replace(self.baseFilename, self.baseFilename + '.1')
+        self.inode = None
+        self.counted_size = 0
+        self.line_count = 0
+
+    def close(self) -> None:
+        super().close()
+        if self.lock_fd is not None:
+            os.close(self.lock_fd)
+            self.lock_fd = None
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    1 レコードを 1 行の JSON にするフォーマッター. extra で渡した項目もそのまま含める
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in STANDARD_ATTRIBUTES and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def setup_logging(filename: str, level: int = logging.INFO, max_lines: int = 1000,
+                  json_format: bool = False) -> QueueListener:
+    """
+    ルートロガーのレコードをキューに積み, ファイルへの書き込みは QueueListener のスレッドで行う
+
+    リクエストを処理するスレッドはキューに積むだけで, ディスクの I/O を待たない.
+
+    :param filename: str  ログファイル
+    :param level: int
+    :param max_lines: int  CustomHandler の行数の上限
+    :param json_format: bool  1 行 1 レコードの JSON で出力するか
+    :return: QueueListener  終了時に stop を呼ぶ
+    """
+    handler = CustomHandler(filename, max_lines=max_lines)
+    handler.setFormatter(JsonFormatter() if json_format else logging.Formatter(DEFAULT_FORMAT))
+    log_queue: queue.Queue = queue.Queue()
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(QueueHandler(log_queue))
+    listener = QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    return listener
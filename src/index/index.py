@@ -0,0 +1,248 @@
+import math
+import os
+import sqlite3
+import threading
+import unicodedata
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+# BM25 のパラメータ
+BM25_K1 = 1.2
+BM25_B = 0.75
+# 検索語をそのまま含む文書に足すスコア
+PHRASE_BONUS = 10.0
+# 検索結果に含める本文の文字数
+SNIPPET_CHARS = 200
+# BM25 で順位付けする文書数の上限. これより多くの文書が当たる場合は新しい文書から数える
+MAX_CANDIDATES = 200
+# 文書の末尾に付ける文字. 末尾の文字も bigram の先頭に現れるようにして, 1 文字の検索語を前方一致で引く
+TERMINATOR = "\x00"
+# インデックスの形式. 古い形式のファイルは開くときに作り直す
+INDEX_VERSION = 1
+
+
+def normalize(text: str) -> str:
+    """
+    全角・半角や大文字・小文字の揺れを吸収する
+
+    :param text: str
+    :return: str
+    """
+    return unicodedata.normalize("NFKC", text).lower()
+
+
+def bigrams(text: str) -> Counter:
+    """
+    空白を除いた文字 bigram の出現回数を返す. 1 文字だけの場合はその文字を返す
+
+    :param text: str  normalize 済みの文字列
+    :return: Counter
+    """
+    chars = "".join(text.split())
+    if len(chars) == 1:
+        return Counter([chars])
+    return Counter(chars[i:i + 2] for i in range(len(chars) - 1))
+
+
+class TextIndex:
+    """
+    書きおこし・校正結果・要約を横断して検索するための文字 bigram の転置インデックス
+
+    日本語は単語の区切りが無いので形態素解析をせずに文字 bigram で引き, BM25 で順位付けする.
+    文書は (kind, session, segment) ごとに登録し, 追加・置き換えはその文書の長さに比例する時間で済む.
+    検索は文書頻度の最も小さい bigram の転置リストから始め, 残りの bigram は主キーで確かめる.
+    """
+
+    def __init__(self, path: str) -> None:
+        """
+        :param path: str  sqlite ファイルのパス
+        """
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript(
+            "PRAGMA journal_mode=WAL;"
+            "CREATE TABLE IF NOT EXISTS docs ("
+            "id INTEGER PRIMARY KEY, kind TEXT NOT NULL, session TEXT NOT NULL, segment TEXT NOT NULL, "
+            "timestamp TEXT, text TEXT NOT NULL, length INTEGER NOT NULL, UNIQUE (kind, session, segment));"
+            "CREATE INDEX IF NOT EXISTS docs_session ON docs (session, kind);"
+            "CREATE TABLE IF NOT EXISTS postings ("
+            "gram TEXT NOT NULL, doc_id INTEGER NOT NULL, tf INTEGER NOT NULL, "
+            "PRIMARY KEY (gram, doc_id)) WITHOUT ROWID;"
+            "CREATE INDEX IF NOT EXISTS postings_doc ON postings (doc_id);"
+            # BM25 に使う文書数と合計長は検索のたびに数えずにトリガーで保持する
+            "CREATE TABLE IF NOT EXISTS stats (id INTEGER PRIMARY KEY CHECK (id = 0), "
+            "num_docs INTEGER NOT NULL, total_length INTEGER NOT NULL);"
+            "INSERT OR IGNORE INTO stats (id, num_docs, total_length) VALUES (0, 0, 0);"
+            "CREATE TRIGGER IF NOT EXISTS docs_insert AFTER INSERT ON docs BEGIN "
+            "UPDATE stats SET num_docs = num_docs + 1, total_length = total_length + NEW.length WHERE id = 0; END;"
+            "CREATE TRIGGER IF NOT EXISTS docs_delete AFTER DELETE ON docs BEGIN "
+            "UPDATE stats SET num_docs = num_docs - 1, total_length = total_length - OLD.length WHERE id = 0; END;"
+            # bigram ごとの文書頻度も転置リストを数えずにトリガーで保持する
+            "CREATE TABLE IF NOT EXISTS grams (gram TEXT PRIMARY KEY, df INTEGER NOT NULL) WITHOUT ROWID;"
+            "CREATE TRIGGER IF NOT EXISTS postings_insert AFTER INSERT ON postings BEGIN "
+            "INSERT INTO grams (gram, df) VALUES (NEW.gram, 1) ON CONFLICT (gram) DO UPDATE SET df = df + 1; END;"
+            "CREATE TRIGGER IF NOT EXISTS postings_delete AFTER DELETE ON postings BEGIN "
+            "UPDATE grams SET df = df - 1 WHERE gram = OLD.gram; END;"
+        )
+        if self._conn.execute("PRAGMA user_version").fetchone()[0] < INDEX_VERSION:
+            self._rebuild()
+        self._conn.commit()
+
+    def add(self, kind: str, session: str, segment: str, timestamp: Optional[str], text: str) -> None:
+        """
+        文書を登録する. 同じ (kind, session, segment) の文書は置き換える
+
+        :param kind: str  "transcript" | "revised" | "summary"
+        :param session: str  セッションのディレクトリ名
+        :param segment: str  セッション内での文書の識別子
+        :param timestamp: str | None
+        :param text: str
+        :return: None
+        """
+        with self._lock:
+            self._add(kind, session, segment, timestamp, text)
+            self._conn.commit()
+
+    def replace(self, kind: str, session: str, documents: List[Tuple[str, Optional[str], str]]) -> None:
+        """
+        セッションの kind の文書をすべて置き換える
+
+        :param kind: str
+        :param session: str
+        :param documents: List[Tuple[str, str | None, str]]  (segment, timestamp, text) のリスト
+        :return: None
+        """
+        with self._lock:
+            self._delete(session, kind)
+            for segment, timestamp, text in documents:
+                self._add(kind, session, segment, timestamp, text)
+            self._conn.commit()
+
+    def delete(self, session: str, kind: Optional[str] = None) -> None:
+        """
+        セッションの文書を削除する
+
+        :param session: str
+        :param kind: str | None  指定しない場合はすべての種類を削除する
+        :return: None
+        """
+        with self._lock:
+            self._delete(session, kind)
+            self._conn.commit()
+
+    def search(self, query: str, limit: int = 20) -> List[dict]:
+        """
+        query のすべての bigram を含む文書を BM25 のスコア順に返す. 1 文字の検索語はその文字を含む文書を返す
+
+        当たる文書が MAX_CANDIDATES 件を超える場合は, 新しい MAX_CANDIDATES 件の中で順位付けする.
+
+        :param query: str
+        :param limit: int
+        :return: List[dict]  {"kind", "session", "segment", "timestamp", "score", "text"} のリスト. text は該当箇所の抜粋
+        """
+        normalized_query = normalize(query)
+        terms = list(bigrams(normalized_query))
+        if not terms:
+            return []
+        with self._lock:
+            num_docs, total_length = self._conn.execute("SELECT num_docs, total_length FROM stats").fetchone()
+            if num_docs == 0:
+                return []
+            average_length = total_length / num_docs
+            doc_freqs = {term: self._doc_freq(term, num_docs) for term in terms}
+            if not all(doc_freqs.values()):
+                return []
+
+            # 文書頻度の最も小さい bigram の転置リストを新しい文書から順に読み, 残りの bigram を含むものだけを残す
+            terms.sort(key=doc_freqs.get)
+            condition, params = self._term_condition("p", terms[0])
+            for term in terms[1:]:
+                term_condition, term_params = self._term_condition("q", term)
+                condition += " AND EXISTS (SELECT 1 FROM postings q WHERE q.doc_id = p.doc_id AND " + term_condition + ")"
+                params += term_params
+            doc_ids = [row[0] for row in self._conn.execute(
+                "SELECT DISTINCT p.doc_id FROM postings p WHERE " + condition + " ORDER BY p.doc_id DESC LIMIT ?",
+                params + [MAX_CANDIDATES])]
+            if not doc_ids:
+                return []
+
+            placeholders = ",".join("?" * len(doc_ids))
+            docs = {row[0]: row for row in self._conn.execute(
+                "SELECT id, kind, session, segment, timestamp, text, length FROM docs "
+                "WHERE id IN (" + placeholders + ")", doc_ids)}
+            scores = {doc_id: 0.0 for doc_id in doc_ids}
+            for term in terms:
+                term_condition, term_params = self._term_condition("p", term)
+                idf = math.log(1 + (num_docs - doc_freqs[term] + 0.5) / (doc_freqs[term] + 0.5))
+                for doc_id, tf in self._conn.execute(
+                        "SELECT p.doc_id, SUM(p.tf) FROM postings p WHERE " + term_condition + " "
+                        "AND p.doc_id IN (" + placeholders + ") GROUP BY p.doc_id", term_params + doc_ids):
+                    norm = tf + BM25_K1 * (1 - BM25_B + BM25_B * docs[doc_id][6] / average_length)
+                    scores[doc_id] += idf * tf * (BM25_K1 + 1) / norm
+
+        hits = []
+        for doc_id, score in scores.items():
+            _, kind, session, segment, timestamp, text, _ = docs[doc_id]
+            # bigram がばらばらに含まれるだけの文書より, 検索語をそのまま含む文書を上位にする
+            position = normalize(text).find(normalized_query)
+            if position >= 0:
+                score += PHRASE_BONUS
+            start = max(0, position - SNIPPET_CHARS // 2)
+            hits.append({"kind": kind, "session": session, "segment": segment,
+                         "timestamp": timestamp, "score": score, "text": text[start:start + SNIPPET_CHARS]})
+        hits.sort(key=lambda hit: hit["score"], reverse=True)
+        return hits[:limit]
+
+    @staticmethod
+    def _term_condition(alias: str, term: str) -> Tuple[str, list]:
+        # 1 文字の検索語は, その文字で始まる bigram (TERMINATOR で終わるものを含む) の前方一致にする
+        if len(term) == 1:
+            return f"{alias}.gram >= ? AND {alias}.gram < ?", [term, chr(ord(term) + 1)]
+        return f"{alias}.gram = ?", [term]
+
+    def _doc_freq(self, term: str, num_docs: int) -> int:
+        # 呼び出し側で _lock を取っていること. 1 文字の検索語は bigram ごとの文書頻度の和で近似する
+        if len(term) == 1:
+            df = self._conn.execute("SELECT SUM(df) FROM grams WHERE gram >= ? AND gram < ?",
+                                    (term, chr(ord(term) + 1))).fetchone()[0]
+            return min(df or 0, num_docs)
+        row = self._conn.execute("SELECT df FROM grams WHERE gram = ?", (term,)).fetchone()
+        return row[0] if row is not None else 0
+
+    def _add(self, kind: str, session: str, segment: str, timestamp: Optional[str], text: str) -> None:
+        # 呼び出し側で _lock を取っていること
+        grams = bigrams(normalize(text) + TERMINATOR)
+        row = self._conn.execute("SELECT id FROM docs WHERE kind = ? AND session = ? AND segment = ?",
+                                 (kind, session, segment)).fetchone()
+        if row is not None:
+            self._conn.execute("DELETE FROM postings WHERE doc_id = ?", (row[0],))
+            self._conn.execute("DELETE FROM docs WHERE id = ?", (row[0],))
+        doc_id = self._conn.execute(
+            "INSERT INTO docs (kind, session, segment, timestamp, text, length) VALUES (?, ?, ?, ?, ?, ?)",
+            (kind, session, segment, timestamp, text, sum(grams.values()))
+        ).lastrowid
+        self._conn.executemany("INSERT INTO postings (gram, doc_id, tf) VALUES (?, ?, ?)",
+                               [(gram, doc_id, tf) for gram, tf in grams.items()])
+
+    def _delete(self, session: str, kind: Optional[str]) -> None:
+        # 呼び出し側で _lock を取っていること
+        if kind is None:
+            doc_ids = self._conn.execute("SELECT id FROM docs WHERE session = ?", (session,)).fetchall()
+        else:
+            doc_ids = self._conn.execute("SELECT id FROM docs WHERE session = ? AND kind = ?",
+                                         (session, kind)).fetchall()
+        self._conn.executemany("DELETE FROM postings WHERE doc_id = ?", doc_ids)
+        self._conn.executemany("DELETE FROM docs WHERE id = ?", doc_ids)
+
+    def _rebuild(self) -> None:
+        # 登録済みの文書の転置リストを今の形式で作り直す. 呼び出し側で commit すること
+        documents = self._conn.execute("SELECT kind, session, segment, timestamp, text FROM docs").fetchall()
+        self._conn.execute("DELETE FROM postings")
+        self._conn.execute("DELETE FROM docs")
+        self._conn.execute("DELETE FROM grams")
+        for document in documents:
+            self._add(*document)
+        self._conn.execute(f"PRAGMA user_version = {INDEX_VERSION}")
@@ -0,0 +1,331 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Callable, Iterator, Optional, Tuple
+
+from src.llm.rate_limit import TokenBucketLimiter
+from src.metrics.metrics import LLM_REQUEST_SECONDS, LLM_TOKENS, record_cache
+from src.metrics.tracing import span
+
+# 生成の途中経過を受け取る関数. listener(event, data) の形で呼ばれ, 別スレッドから呼ばれることもある
+Listener = Callable[[str, dict], None]
+
+
+class ResponseCache:
+    """
+    LLM の応答をディスクに保存する LRU キャッシュ
+
+    sqlite に保存し, 合計サイズが max_bytes を超えたら最後に参照された時刻が古いものから削除する.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 256 * 1024 * 1024) -> None:
+        """
+        :param path: str  sqlite ファイルのパス
+        :param max_bytes: int  保存する応答の合計サイズの上限
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self._conn.commit()
+        self._total_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        :param key: str
+        :return: str | None  キャッシュにない場合は None
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            return row[0]
+
+    def put(self, key: str, value: str) -> None:
+        """
+        :param key: str
+        :param value: str
+        :return: None
+        """
+        size = len(value.encode("utf-8"))
+        with self._lock:
+            row = self._conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self._total_bytes -= row[0]
+            self._conn.execute("INSERT OR REPLACE INTO responses (key, value, size, accessed) VALUES (?, ?, ?, ?)",
+                               (key, value, size, time.time()))
+            self._total_bytes += size
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self) -> None:
+        # 呼び出し側で _lock を取っていること
+        while self._total_bytes > self.max_bytes:
+            row = self._conn.execute("SELECT key, size FROM responses ORDER BY accessed LIMIT 1").fetchone()
+            if row is None:
+                break
+            self._conn.execute("DELETE FROM responses WHERE key = ?", (row[0],))
+            self._total_bytes -= row[1]
+
+
+class OpenAIBackend:
+    """
+    OpenAI の chat completions API を使うバックエンド
+
+    1 つの HTTP クライアントを使い回し, コネクションをプールする.
+    """
+
+    name = "openai"
+
+    def __init__(self, max_connections: int = 20, max_retries: int = 3, timeout: float = 120.0) -> None:
+        """
+        :param max_connections: int  プールするコネクション数の上限
+        :param max_retries: int  レート制限や一時的なエラーの際の, SDK による再試行回数
+        :param timeout: float  1 リクエストのタイムアウト秒数
+        """
+        self.api_key = os.environ["OPENAI_API_KEY"]
+        self.max_connections = max_connections
+        self.max_retries = max_retries
+        self.timeout = timeout
+        # openai の import は重いので, 最初に呼び出すときにクライアントを作る
+        self.client = None
+        # 再試行回数 -> HTTP クライアントを共有する, 再試行回数だけを変えたクライアント
+        self.clients_with_retries = {}
+        self._client_lock = threading.Lock()
+
+    def get_client(self, max_retries: Optional[int] = None):
+        """
+        :param max_retries: int | None  SDK による再試行回数. None の場合は self.max_retries
+        :return: openai.OpenAI
+        """
+        with self._client_lock:
+            if self.client is None:
+                import httpx
+                from openai import OpenAI
+
+                self.client = OpenAI(
+                    api_key=self.api_key,
+                    max_retries=self.max_retries,
+                    timeout=self.timeout,
+                    http_client=httpx.Client(limits=httpx.Limits(max_connections=self.max_connections,
+                                                                 max_keepalive_connections=self.max_connections)),
+                )
+            if max_retries is None or max_retries == self.max_retries:
+                return self.client
+            if max_retries not in self.clients_with_retries:
+                self.clients_with_retries[max_retries] = self.client.with_options(max_retries=max_retries)
+            return self.clients_with_retries[max_retries]
+
+    def complete(self, prompt: str, model: str, temperature: float = 0, max_retries: Optional[int] = None) -> str:
+        response = self.get_client(max_retries).chat.completions.create(
+            messages=[
+                {
+                    "role": "user",
+                    "content": prompt,
+                }
+            ],
+            model=model,
+            temperature=temperature
+        )
+        if response.usage is not None:
+            LLM_TOKENS.inc(response.usage.prompt_tokens, backend=self.name, model=model, direction="in")
+            LLM_TOKENS.inc(response.usage.completion_tokens, backend=self.name, model=model, direction="out")
+        return response.choices[0].message.content
+
+    def stream(self, prompt: str, model: str, temperature: float = 0,
+               max_retries: Optional[int] = None) -> Iterator[str]:
+        response = self.get_client(max_retries).chat.completions.create(
+            messages=[
+                {
+                    "role": "user",
+                    "content": prompt,
+                }
+            ],
+            model=model,
+            temperature=temperature,
+            stream=True,
+            # 最後のチャンクで usage を受け取る
+            stream_options={"include_usage": True},
+        )
+        for chunk in response:
+            if chunk.usage is not None:
+                LLM_TOKENS.inc(chunk.usage.prompt_tokens, backend=self.name, model=model, direction="in")
+                LLM_TOKENS.inc(chunk.usage.completion_tokens, backend=self.name, model=model, direction="out")
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+
+class StubBackend:
+    """
+    ネットワークを使わない決定的なバックエンド. テストやベンチマーク用
+
+    プロンプトの末尾 max_chars 文字をそのまま返す.
+    """
+
+    name = "stub"
+
+    def __init__(self, max_chars: int = 200, stream_chars: int = 8) -> None:
+        """
+        :param max_chars: int  返す文字数の上限
+        :param stream_chars: int  stream で 1 回に返す文字数
+        """
+        self.max_chars = max_chars
+        self.stream_chars = stream_chars
+
+    def complete(self, prompt: str, model: str, temperature: float = 0, max_retries: Optional[int] = None) -> str:
+        # 失敗しないので max_retries は使わない
+        response = prompt[-self.max_chars:]
+        # トークン数の代わりに文字数を数える
+        LLM_TOKENS.inc(len(prompt), backend=self.name, model=model, direction="in")
+        LLM_TOKENS.inc(len(response), backend=self.name, model=model, direction="out")
+        return response
+
+    def stream(self, prompt: str, model: str, temperature: float = 0,
+               max_retries: Optional[int] = None) -> Iterator[str]:
+        response = self.complete(prompt, model=model, temperature=temperature)
+        for i in range(0, len(response), self.stream_chars):
+            yield response[i:i + self.stream_chars]
+
+
+class LLMClient:
+    """
+    Reviser と Summarizer が共有する LLM クライアント
+
+    temperature が 0 の呼び出しは応答が決定的とみなして ResponseCache に保存する.
+    キャッシュに無い呼び出しは limiter のリクエスト数・トークン数の枠が空くまで待つ.
+    """
+
+    def __init__(self, backend, cache: Optional[ResponseCache] = None,
+                 limiter: Optional[TokenBucketLimiter] = None) -> None:
+        """
+        :param backend: OpenAIBackend | StubBackend
+        :param cache: ResponseCache | None  None の場合はキャッシュしない
+        :param limiter: TokenBucketLimiter | None  None の場合は呼び出しを制限しない
+        """
+        self.backend = backend
+        self.cache = cache
+        self.limiter = limiter
+
+        self.logger = logging.getLogger('LLMClient')
+        self.logger.addHandler(logging.StreamHandler())
+
+    def complete(self, prompt: str, model: str, temperature: float = 0, max_retries: Optional[int] = None) -> str:
+        """
+        プロンプトに対する応答を返す
+
+        :param prompt: str
+        :param model: str
+        :param temperature: float
+        :param max_retries: int | None  バックエンドの SDK による再試行回数. None の場合はバックエンドの設定のまま.
+        呼び出し側で再試行する場合は 0 にする
+        :return: str
+        """
+        key, cached = self.lookup(prompt, model, temperature)
+        if cached is not None:
+            return cached
+        self.wait_for_limit(prompt)
+        self.logger.info(f"Calling {self.backend.name}/{model}")
+        with span("llm_request"), LLM_REQUEST_SECONDS.time(backend=self.backend.name, model=model):
+            response = self.backend.complete(prompt, model=model, temperature=temperature, max_retries=max_retries)
+        if key is not None:
+            self.cache.put(key, response)
+        return response
+
+    def stream(self, prompt: str, model: str, temperature: float = 0,
+               max_retries: Optional[int] = None) -> Iterator[str]:
+        """
+        プロンプトに対する応答を生成された順に少しずつ返す
+
+        キャッシュにある場合は応答全体を 1 度に返す. 最後まで受け取った応答だけをキャッシュに保存する.
+
+        :param prompt: str
+        :param model: str
+        :param temperature: float
+        :param max_retries: int | None  complete と同じ
+        :return: Iterator[str]  応答の断片
+        """
+        key, cached = self.lookup(prompt, model, temperature)
+        if cached is not None:
+            yield cached
+            return
+        self.wait_for_limit(prompt)
+        self.logger.info(f"Streaming {self.backend.name}/{model}")
+        deltas = []
+        with span("llm_request"), LLM_REQUEST_SECONDS.time(backend=self.backend.name, model=model):
+            for delta in self.backend.stream(prompt, model=model, temperature=temperature, max_retries=max_retries):
+                deltas.append(delta)
+                yield delta
+        if key is not None:
+            self.cache.put(key, "".join(deltas))
+
+    def lookup(self, prompt: str, model: str, temperature: float) -> Tuple[Optional[str], Optional[str]]:
+        """
+        :return: (str | None, str | None)  キャッシュのキーとキャッシュされた応答. キャッシュしない呼び出しのキーは None
+        """
+        if self.cache is None or temperature != 0:
+            return None, None
+        key = self.cache_key(prompt, model)
+        cached = self.cache.get(key)
+        record_cache("llm", cached is not None)
+        return key, cached
+
+    def wait_for_limit(self, prompt: str) -> None:
+        if self.limiter is not None:
+            # 日本語はおおよそ 1 文字 1 トークンなので文字数で見積もる
+            with span("llm_rate_limit"):
+                self.limiter.acquire(len(prompt))
+
+    def cache_key(self, prompt: str, model: str) -> str:
+        source = "\0".join([self.backend.name, model, prompt])
+        return hashlib.sha256(source.encode("utf-8")).hexdigest()
+
+
+_default_client: Optional[LLMClient] = None
+_default_client_lock = threading.Lock()
+
+
+def get_default_client() -> LLMClient:
+    """
+    環境変数の設定からプロセスで共有する LLMClient を作って返す
+
+    LLM_BACKEND: "openai" (デフォルト) | "stub"
+    LLM_CACHE_PATH: 応答キャッシュの sqlite ファイル. 空文字ならキャッシュしない
+    LLM_CACHE_MAX_BYTES: 応答キャッシュの合計サイズの上限
+    LLM_REQUESTS_PER_MINUTE, LLM_TOKENS_PER_MINUTE: 呼び出しの上限. 指定しない場合は制限しない
+
+    :return: LLMClient
+    """
+    global _default_client
+    with _default_client_lock:
+        if _default_client is None:
+            if os.environ.get("LLM_BACKEND", "openai") == "stub":
+                backend = StubBackend()
+            else:
+                backend = OpenAIBackend()
+            cache_path = os.environ.get("LLM_CACHE_PATH", "./data/llm_cache.sqlite3")
+            cache = None
+            if cache_path:
+                cache = ResponseCache(cache_path,
+                                      max_bytes=int(os.environ.get("LLM_CACHE_MAX_BYTES", 256 * 1024 * 1024)))
+            limiter = None
+            requests_per_minute = os.environ.get("LLM_REQUESTS_PER_MINUTE")
+            tokens_per_minute = os.environ.get("LLM_TOKENS_PER_MINUTE")
+            if requests_per_minute or tokens_per_minute:
+                limiter = TokenBucketLimiter(
+                    requests_per_minute=float(requests_per_minute) if requests_per_minute else None,
+                    tokens_per_minute=float(tokens_per_minute) if tokens_per_minute else None,
+                )
+            _default_client = LLMClient(backend, cache=cache, limiter=limiter)
+        return _default_client
@@ -0,0 +1,63 @@
+import threading
+import time
+from typing import Optional
+
+
+class TokenBucketLimiter:
+    """
+    リクエスト数とトークン数の 2 つのトークンバケットで LLM の呼び出しを制限する
+
+    どちらのバケットも 1 分あたりの上限まで溜まり, 連続的に補充される.
+    複数スレッドから呼ばれてもよい.
+    """
+
+    def __init__(self, requests_per_minute: Optional[float] = None,
+                 tokens_per_minute: Optional[float] = None) -> None:
+        """
+        :param requests_per_minute: float | None  None の場合はリクエスト数を制限しない
+        :param tokens_per_minute: float | None  None の場合はトークン数を制限しない
+        """
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._requests = requests_per_minute or 0.0
+        self._tokens = tokens_per_minute or 0.0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: int = 0) -> None:
+        """
+        1 リクエストと tokens トークン分の枠が空くまで待つ
+
+        :param tokens: int  このリクエストで消費するトークン数の見積もり
+        :return: None
+        """
+        if self.tokens_per_minute is not None:
+            # バケットの容量を超えるリクエストは満杯になるまで待てば通す
+            tokens = min(tokens, self.tokens_per_minute)
+        while True:
+            with self._lock:
+                self._refill()
+                wait = 0.0
+                if self.requests_per_minute is not None and self._requests < 1:
+                    wait = max(wait, (1 - self._requests) * 60 / self.requests_per_minute)
+                if self.tokens_per_minute is not None and self._tokens < tokens:
+                    wait = max(wait, (tokens - self._tokens) * 60 / self.tokens_per_minute)
+                if wait == 0.0:
+                    if self.requests_per_minute is not None:
+                        self._requests -= 1
+                    if self.tokens_per_minute is not None:
+                        self._tokens -= tokens
+                    return
+            time.sleep(wait)
+
+    def _refill(self) -> None:
+        # 呼び出し側で _lock を取っていること
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        if self.requests_per_minute is not None:
+            self._requests = min(self.requests_per_minute,
+                                 self._requests + elapsed * self.requests_per_minute / 60)
+        if self.tokens_per_minute is not None:
+            self._tokens = min(self.tokens_per_minute,
+                               self._tokens + elapsed * self.tokens_per_minute / 60)
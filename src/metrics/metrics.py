@@ -0,0 +1,258 @@
+"""
+Prometheus のテキスト形式で出力できる Counter, Gauge, Histogram
+
+prometheus_client には依存せず, 必要な分だけを実装する.
+メトリクスはプロセスごとに集計される (uvicorn を複数ワーカーで動かす場合はワーカーごと).
+"""
+import abc
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from src.metrics.tracing import span
+
+# LLM の呼び出しを含む段階は数十秒かかることがあるので, Prometheus のデフォルトより上まで取る
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+LabelValues = Tuple[str, ...]
+
+
+class Metric(abc.ABC):
+    """
+    ラベルの組ごとに値を持つメトリクスの基底クラス. サブクラスは type_name と samples を定義する
+    """
+
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        """
+        :param name: str  メトリクス名
+        :param documentation: str  # HELP に出力する説明
+        :param labelnames: Sequence[str]  ラベル名
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _label_values(self, labels: Dict[str, str]) -> LabelValues:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _format_labels(self, values: LabelValues, extra: Sequence[Tuple[str, str]] = ()) -> str:
+        pairs = list(zip(self.labelnames, values)) + list(extra)
+        if not pairs:
+            return ""
+        escaped = [(name, value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+                   for name, value in pairs]
+        return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+    @abc.abstractmethod
+    def samples(self) -> List[str]:
+        """
+        :return: List[str]  # HELP, # TYPE の後に続くサンプルの行
+        """
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        return "\n".join(lines + self.samples())
+
+
+class Counter(Metric):
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        """
+        :param amount: float  0 以上の増分
+        :param labels: str  labelnames のすべてのラベル
+        :return: None
+        """
+        if amount < 0:
+            raise ValueError("Counter can only increase")
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def total(self) -> float:
+        """
+        :return: float  すべてのラベルの組の値の合計
+        """
+        with self._lock:
+            return sum(self._values.values())
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f"{self.name}{self._format_labels(key)} {format_value(value)}" for key, value in values]
+
+
+class Gauge(Metric):
+    type_name = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+        self._function: Optional[Callable[[], float]] = None
+
+    def set(self, value: float, **labels: str) -> None:
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        """
+        出力するときに function を呼んで値を取る. ラベルの無い Gauge でだけ使える
+
+        :param function: Callable[[], float]
+        :return: None
+        """
+        self._function = function
+
+    def samples(self) -> List[str]:
+        if self._function is not None:
+            return [f"{self.name} {format_value(self._function())}"]
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f"{self.name}{self._format_labels(key)} {format_value(value)}" for key, value in values]
+
+
+class Histogram(Metric):
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # ラベルの組 -> (バケットごとの件数, 合計, 件数)
+        self._values: Dict[LabelValues, list] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        """
+        :param value: float  観測値 (秒など)
+        :param labels: str  labelnames のすべてのラベル
+        :return: None
+        """
+        key = self._label_values(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = [[0] * len(self.buckets), 0.0, 0]
+                self._values[key] = state
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels: str):
+        """
+        with ブロックにかかった秒数を観測する
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = sorted((key, (list(state[0]), state[1], state[2])) for key, state in self._values.items())
+        lines = []
+        for key, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{self._format_labels(key, [('le', format_value(bound))])} "
+                             f"{cumulative}")
+            lines.append(f"{self.name}_bucket{self._format_labels(key, [('le', '+Inf')])} {count}")
+            lines.append(f"{self.name}_sum{self._format_labels(key)} {format_value(total)}")
+            lines.append(f"{self.name}_count{self._format_labels(key)} {count}")
+        return lines
+
+
+class Registry:
+    """
+    /metrics で出力するメトリクスの集まり
+    """
+
+    def __init__(self) -> None:
+        self.metrics: List[Metric] = []
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        with self._lock:
+            self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """
+        :return: str  Prometheus のテキスト形式 (version 0.0.4)
+        """
+        with self._lock:
+            metrics = list(self.metrics)
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+def format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    "pipeline_stage_seconds", "Time spent in each pipeline stage", ["stage"]))
+INFERENCE_SECONDS = REGISTRY.register(Histogram(
+    "transcribe_inference_seconds", "Time spent in transcription model inference", ["backend", "mode"]))
+ENCODER_INPUT_SECONDS = REGISTRY.register(Counter(
+    "transcribe_encoder_input_seconds_total", "Seconds of (padded) audio fed to the encoder in batch decoding",
+    ["mode"]))
+AUDIO_SECONDS = REGISTRY.register(Counter(
+    "transcribe_audio_seconds_total", "Seconds of audio transcribed"))
+LLM_REQUEST_SECONDS = REGISTRY.register(Histogram(
+    "llm_request_seconds", "Latency of LLM calls that missed the response cache", ["backend", "model"]))
+LLM_TOKENS = REGISTRY.register(Counter(
+    "llm_tokens_total", "LLM tokens sent and received", ["backend", "model", "direction"]))
+CACHE_REQUESTS = REGISTRY.register(Counter(
+    "cache_requests_total", "Cache lookups by result", ["cache", "result"]))
+QUEUE_DEPTH = REGISTRY.register(Gauge(
+    "transcription_queue_depth", "Transcription jobs waiting in the queue"))
+ACTIVE_SESSIONS = REGISTRY.register(Gauge(
+    "active_sessions", "Sessions held by the server"))
+EAGER_RUNS = REGISTRY.register(Counter(
+    "eager_pipeline_runs_total", "Background pipeline runs by result", ["result"]))
+HTTP_REQUEST_SECONDS = REGISTRY.register(Histogram(
+    "http_request_seconds", "HTTP request latency", ["method", "route", "status"]))
+
+
+@contextmanager
+def stage(name: str):
+    """
+    パイプラインの段階の時間を pipeline_stage_seconds に記録する. トレース中であればスパンも記録する
+
+    :param name: str  段階の名前
+    """
+    with span(name):
+        with STAGE_SECONDS.time(stage=name):
+            yield
+
+
+def record_cache(cache: str, hit: bool) -> None:
+    """
+    :param cache: str  キャッシュの名前
+    :param hit: bool
+    :return: None
+    """
+    CACHE_REQUESTS.inc(cache=cache, result="hit" if hit else "miss")
@@ -0,0 +1,110 @@
+"""
+リクエスト単位のトレース
+
+start_trace の中で span を使うと, 段階ごとの開始時刻と所要時間が Trace に記録される.
+トレースは contextvars で受け渡すので, 別スレッドで実行する処理は bind_context で包む.
+"""
+import contextvars
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Callable, List, Optional
+
+_current_trace: contextvars.ContextVar[Optional["Trace"]] = contextvars.ContextVar("trace", default=None)
+_current_span: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("span", default=None)
+
+
+class Trace:
+    """
+    1 リクエスト分のスパンの記録
+    """
+
+    def __init__(self, name: str) -> None:
+        """
+        :param name: str  トレースの名前 (リクエストのパスなど)
+        """
+        self.trace_id = uuid.uuid4().hex
+        self.name = name
+        self.started_at = time.perf_counter()
+        self.spans: List[dict] = []
+        self._lock = threading.Lock()
+
+    def add(self, name: str, start: float, duration: float, parent: Optional[str]) -> None:
+        with self._lock:
+            self.spans.append({
+                "name": name,
+                "parent": parent,
+                "start_ms": round((start - self.started_at) * 1000, 3),
+                "duration_ms": round(duration * 1000, 3),
+                "thread": threading.current_thread().name,
+            })
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            spans = sorted(self.spans, key=lambda s: s["start_ms"])
+        return {"trace_id": self.trace_id, "name": self.name,
+                "duration_ms": round((time.perf_counter() - self.started_at) * 1000, 3), "spans": spans}
+
+    def server_timing(self) -> str:
+        """
+        同じ名前のスパンの合計時間を Server-Timing ヘッダーの形式で返す
+
+        :return: str  例: "revise;dur=812.5, summarize_map;dur=1530.2"
+        """
+        totals = {}
+        with self._lock:
+            for s in self.spans:
+                totals[s["name"]] = totals.get(s["name"], 0.0) + s["duration_ms"]
+        return ", ".join(f"{name};dur={duration:.1f}" for name, duration in totals.items())
+
+
+@contextmanager
+def start_trace(name: str):
+    """
+    with ブロックの中の span を記録する Trace を開始する
+
+    :param name: str
+    :return: Trace
+    """
+    trace = Trace(name)
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+
+
+@contextmanager
+def span(name: str):
+    """
+    トレース中であれば with ブロックをスパンとして記録する. トレース中でなければ何もしない
+
+    :param name: str
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    parent = _current_span.get()
+    token = _current_span.set(name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, start, time.perf_counter() - start, parent)
+        _current_span.reset(token)
+
+
+def bind_context(func: Callable) -> Callable:
+    """
+    呼び出した時点のトレースを引き継いで func を実行する関数を返す. ThreadPoolExecutor に渡す処理に使う
+
+    Context は同時に 1 つのスレッドでしか run できないので, 実行のたびにコピーする.
+    そのため返した関数を executor.map などで並行に実行してもよい.
+
+    :param func: Callable
+    :return: Callable
+    """
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.copy().run(func, *args, **kwargs)
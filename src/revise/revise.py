@@ -1,11 +1,21 @@
 import os
+import hashlib
 import logging
 import json
+import threading
+from concurrent.futures import CancelledError
 from datetime import datetime
-from openai import OpenAI
+from typing import Callable, List, Optional
+
+from src.index.index import TextIndex
+from src.llm.llm import LLMClient, Listener, get_default_client
+from src.metrics.metrics import record_cache, stage
 
 logging.basicConfig(filename='reviser.log', level=logging.INFO)
 
+PROMPT_TEMPLATE = '以下の文章の文法をチェックして、見やすくして適宜に改行入れて出力してください。\n{text}\n出力:'
+CACHE_FILE_NAME = "revise_cache.json"
+
 
 class Reviser:
     """
@@ -17,56 +27,167 @@ class Reviser:
             data_path: str,
             save_path: str,
             target_dir: str,
+            model: str = "gpt-3.5-turbo",
+            paragraph_chars: int = 400,
+            llm: Optional[LLMClient] = None,
+            index: Optional[TextIndex] = None,
     ) -> None:
         """
         :param data_path: str
         :param save_path: str
+        :param model: str  校正に使う chat model
+        :param paragraph_chars: int  1 回の校正にまとめる文字数の目安
+        :param llm: LLMClient | None  指定しない場合はプロセスで共有するクライアント
+        :param index: TextIndex | None  校正結果を登録する全文検索インデックス
         """
 
         self.data_path = data_path
         self.save_path = save_path
         self.target_dir = target_dir
-        self.client = OpenAI(api_key=os.environ["OPENAI_API_KEY"])
-       
+        self.model = model
+        self.paragraph_chars = paragraph_chars
+        self.llm = llm if llm is not None else get_default_client()
+        self.index = index
+
         self.logger = logging.getLogger('Reviser')
         self.logger.addHandler(logging.StreamHandler())
 
-    def revise(self, file_name: str) -> dict:
+    def revise(self, file_name: str, listener: Optional[Listener] = None) -> str:
         """
         revise text
+
+        segments are grouped into paragraphs and each paragraph is revised separately.
+        results are cached per session by hash of model, prompt and paragraph,
+        so only new or changed paragraphs are sent to the chat API.
+        if listener is given, generated tokens ("token") and revised paragraphs ("result") are passed to it in order.
         """
         self.logger.info("Revising: " + file_name)
 
         with open(os.path.join(self.data_path, self.target_dir, file_name), 'r', encoding='UTF-8') as json_file:
             data = json.load(json_file)
-            
-        # extract integrated data
-        fulltext = ''
-        for datum in data:
-            fulltext += datum.get('text')+'。'
 
-        if fulltext is None:
-            raise ValueError('JSONファイルに"test"フィールドが存在しません。')
+        paragraphs = self.split_paragraphs(data)
+        cache = self.load_cache()
+        if listener is not None:
+            listener("stage", {"stage": "revise", "count": len(paragraphs)})
+        with stage("revise"):
+            revised_paragraphs = self.revise_paragraphs(paragraphs, cache, listener=listener)
+        self.logger.info(f"Revised {len(paragraphs)} paragraphs")
 
-        # gpt apiに投げるprompt用意
-        prompt = '以下の文章の文法をチェックして、見やすくして適宜に改行入れて出力してください。\n' + fulltext + '\n出力:'
-
-        response = self.client.chat.completions.create(
-            messages=[
-                {
-                    "role": "user",
-                    "content": prompt,
-                }
-            ],
-            model="gpt-3.5-turbo",
-            temperature=0
-        )
-            
-        revised_text = response.choices[0].message.content
+        # 伸びる前の最後の段落など, もう使われない結果は捨てる
+        used_keys = {self.cache_key(paragraph) for paragraph in paragraphs}
+        if used_keys != set(cache):
+            self.save_cache({key: cache[key] for key in used_keys})
+
+        revised_text = '\n'.join(revised_paragraphs)
 
         self.save_revised_text(revised_text)  # save revised text as "revised_integrated.json"
         return revised_text
 
+    def prepare(self, file_name: str, cancelled: Optional[threading.Event] = None) -> str:
+        """
+        revise paragraphs in advance while recording
+
+        the last paragraph is skipped because it still grows, and revised_integrated.json is not written.
+        revisions are cached, so the next revise only sends the last paragraph to the chat API.
+        if cancelled is set, stops before the next paragraph with CancelledError.
+        returns revised text of the complete paragraphs.
+        """
+        with open(os.path.join(self.data_path, self.target_dir, file_name), 'r', encoding='UTF-8') as json_file:
+            data = json.load(json_file)
+
+        paragraphs = self.split_paragraphs(data)[:-1]
+        with stage("revise_prepare"):
+            revised_paragraphs = self.revise_paragraphs(paragraphs, self.load_cache(), cancelled=cancelled)
+        return '\n'.join(revised_paragraphs)
+
+    def revise_paragraphs(self, paragraphs: List[str], cache: dict, listener: Optional[Listener] = None,
+                          cancelled: Optional[threading.Event] = None) -> List[str]:
+        """
+        revise paragraphs in order, using and updating cache
+        """
+        revised_paragraphs = []
+        for i, paragraph in enumerate(paragraphs):
+            key = self.cache_key(paragraph)
+            record_cache("revise", key in cache)
+            if key not in cache:
+                if cancelled is not None and cancelled.is_set():
+                    raise CancelledError()
+                on_delta = None
+                if listener is not None:
+                    on_delta = lambda delta, i=i: listener("token", {"stage": "revise", "index": i, "delta": delta})
+                cache[key] = self.revise_paragraph(paragraph, on_delta=on_delta)
+                # 途中で失敗しても校正済みの段落は再利用できるように都度保存する
+                self.save_cache(cache)
+            revised_paragraphs.append(cache[key])
+            if listener is not None:
+                listener("result", {"stage": "revise", "index": i, "text": cache[key]})
+        return revised_paragraphs
+
+    def split_paragraphs(self, data: List[dict]) -> List[str]:
+        """
+        split integrated data into paragraphs of about paragraph_chars characters
+
+        paragraphs are packed from the beginning, so appending segments only changes the last paragraph.
+        """
+        paragraphs = []
+        paragraph = ''
+        for datum in data:
+            text = datum.get('text')
+            if text is None:
+                raise ValueError('JSONファイルに"text"フィールドが存在しません。')
+            paragraph += text + '。'
+            if len(paragraph) >= self.paragraph_chars:
+                paragraphs.append(paragraph)
+                paragraph = ''
+        if paragraph:
+            paragraphs.append(paragraph)
+        return paragraphs
+
+    def revise_paragraph(self, paragraph: str, on_delta: Optional[Callable[[str], None]] = None) -> str:
+        """
+        revise one paragraph with the chat API
+
+        if on_delta is given, the response is streamed and each generated piece is passed to it.
+        """
+        # gpt apiに投げるprompt用意
+        prompt = PROMPT_TEMPLATE.format(text=paragraph)
+
+        if on_delta is None:
+            return self.llm.complete(prompt, model=self.model, temperature=0)
+        deltas = []
+        for delta in self.llm.stream(prompt, model=self.model, temperature=0):
+            deltas.append(delta)
+            on_delta(delta)
+        return ''.join(deltas)
+
+    def cache_key(self, paragraph: str) -> str:
+        """
+        hash of model, prompt and paragraph
+        """
+        source = '\0'.join([self.model, PROMPT_TEMPLATE, paragraph])
+        return hashlib.sha256(source.encode('UTF-8')).hexdigest()
+
+    def load_cache(self) -> dict:
+        """
+        load revision cache of target_dir
+        """
+        cache_path = os.path.join(self.save_path, self.target_dir, CACHE_FILE_NAME)
+        if not os.path.exists(cache_path):
+            return {}
+        with open(cache_path, 'r', encoding='UTF-8') as f:
+            return json.load(f)
+
+    def save_cache(self, cache: dict) -> None:
+        """
+        save revision cache of target_dir
+        """
+        os.makedirs(os.path.join(self.save_path, self.target_dir), exist_ok=True)
+        cache_path = os.path.join(self.save_path, self.target_dir, CACHE_FILE_NAME)
+        with open(cache_path + '.tmp', 'w', encoding='UTF-8') as f:
+            json.dump(cache, f, ensure_ascii=False)
+        os.replace(cache_path + '.tmp', cache_path)
+
     def save_revised_text(self, revised_text) -> None:
         """
         save revised integrated text
@@ -79,3 +200,10 @@ class Reviser:
         with open(os.path.join(self.save_path, self.target_dir, "revised_integrated.json"), "w") as f:
             json.dump({"text": revised_text}, f, ensure_ascii=False)
 
+        if self.index is not None:
+            # 行ごとに登録して, 検索結果から該当箇所を示せるようにする
+            timestamp = datetime.now().isoformat()
+            self.index.replace("revised", self.target_dir,
+                               [(str(i), timestamp, line) for i, line in enumerate(revised_text.split('\n'))
+                                if line.strip()])
+
@@ -0,0 +1,192 @@
+import logging
+import threading
+import time
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+from typing import Callable, Dict, Optional
+
+from src.metrics.metrics import EAGER_RUNS, stage
+from src.session.session import Session
+
+
+def run_eager_pipeline(session: Session, cancelled: threading.Event) -> None:
+    """
+    録音中のセッションの校正, map, キーワードの検索を先に進めておく
+
+    まだ伸びる最後の段落とチャンクは飛ばす. 結果はそれぞれのキャッシュに残るので,
+    録音が終わった後の /api/summarize は最後の段落の校正, 最後のチャンクの map と reduce だけで済む.
+    cancelled がセットされるか, ディレクトリが変わると CancelledError で止まる.
+
+    :param session: Session
+    :param cancelled: threading.Event
+    :return: None
+    """
+    with session.lock:
+        target_dir = session.target_dir
+
+        def check() -> None:
+            if cancelled.is_set() or session.target_dir != target_dir:
+                raise CancelledError()
+
+        with stage("eager_pipeline"):
+            check()
+            session.transcriber.integrate_texts()
+            check()
+            revised_text = session.reviser.prepare("integrated.json", cancelled=cancelled)
+            check()
+            summaries = session.summarizer.prepare(revised_text, cancelled=cancelled)
+            check()
+            if summaries:
+                session.searcher.prefetch(summaries, lang="ja")
+
+
+class ScheduledRun:
+    """
+    1 セッション分の予約と実行の状態
+    """
+
+    def __init__(self, session: Session) -> None:
+        self.session = session
+        # 次に実行する時刻 (time.monotonic). None なら予約されていない
+        self.due: Optional[float] = None
+        # 前回の実行の後に最初に notify された時刻
+        self.first_notified: Optional[float] = None
+        self.running = False
+        self.cancelled = threading.Event()
+
+
+class PipelineScheduler:
+    """
+    書きおこし結果が増えたセッションの function をバックグラウンドで実行するスケジューラー
+
+    notify から debounce 秒の間 notify が無ければ実行する. notify が続く場合も最初の notify から max_delay 秒で実行する.
+    同じセッションの function は同時に 1 つしか実行せず, 実行中の notify は終わった後の実行に回す.
+    全体で max_workers 個までしか並列に実行しない.
+    cancel は予約を取り消し, 実行中であれば function に渡した cancelled をセットする.
+    """
+
+    def __init__(
+            self,
+            function: Callable[[Session, threading.Event], None] = run_eager_pipeline,
+            debounce: float = 10.0,
+            max_delay: float = 60.0,
+            max_workers: int = 2,
+    ) -> None:
+        """
+        :param function: Callable[[Session, threading.Event], None]  実行する処理
+        :param debounce: float  最後の notify から実行するまでの秒数
+        :param max_delay: float  最初の notify から実行するまでの秒数の上限
+        :param max_workers: int  同時に実行するセッション数の上限
+        """
+        self.function = function
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.max_workers = max_workers
+
+        self._runs: Dict[str, ScheduledRun] = {}
+        self._condition = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="eager-pipeline")
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = False
+
+        self.logger = logging.getLogger('PipelineScheduler')
+        self.logger.addHandler(logging.StreamHandler())
+
+    def start(self) -> None:
+        """
+        予約を見張るスレッドを起動する
+
+        :return: None
+        """
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._loop, name="pipeline-scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        予約を取り消し, 実行中の処理に cancelled をセットして停止する
+
+        :return: None
+        """
+        with self._condition:
+            self._stopped = True
+            for run in self._runs.values():
+                run.cancelled.set()
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def notify(self, session: Session) -> None:
+        """
+        セッションの書きおこし結果が増えたことを知らせる
+
+        :param session: Session
+        :return: None
+        """
+        now = time.monotonic()
+        with self._condition:
+            run = self._runs.get(session.session_id)
+            if run is None:
+                run = ScheduledRun(session)
+                self._runs[session.session_id] = run
+            run.session = session
+            if run.first_notified is None:
+                run.first_notified = now
+            run.due = min(now + self.debounce, run.first_notified + self.max_delay)
+            self._condition.notify()
+
+    def cancel(self, session: Session) -> None:
+        """
+        セッションの予約を取り消し, 実行中であれば止める. 要約の開始やディレクトリの変更の前に呼ぶ
+
+        :param session: Session
+        :return: None
+        """
+        with self._condition:
+            run = self._runs.get(session.session_id)
+            if run is None:
+                return
+            run.due = None
+            run.first_notified = None
+            run.cancelled.set()
+            if not run.running:
+                del self._runs[session.session_id]
+
+    def _loop(self) -> None:
+        with self._condition:
+            while not self._stopped:
+                now = time.monotonic()
+                waiting = [run for run in self._runs.values() if run.due is not None and not run.running]
+                ready = [run for run in waiting if run.due <= now]
+                if not ready:
+                    self._condition.wait(min(run.due for run in waiting) - now if waiting else None)
+                    continue
+                for run in ready:
+                    run.due = None
+                    run.first_notified = None
+                    run.running = True
+                    # 前回の cancel の影響を受けないように, 実行ごとに新しいイベントを渡す
+                    run.cancelled = threading.Event()
+                    self._executor.submit(self._run, run, run.cancelled)
+
+    def _run(self, run: ScheduledRun, cancelled: threading.Event) -> None:
+        result = "done"
+        try:
+            if cancelled.is_set():
+                raise CancelledError()
+            self.function(run.session, cancelled)
+        except CancelledError:
+            result = "cancelled"
+        except Exception as e:
+            result = "failed"
+            self.logger.error(e)
+        finally:
+            EAGER_RUNS.inc(result=result)
+            with self._condition:
+                run.running = False
+                session_id = run.session.session_id
+                if run.due is None and self._runs.get(session_id) is run:
+                    del self._runs[session_id]
+                self._condition.notify()
@@ -0,0 +1,57 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+
+class SearchCache:
+    """
+    (キーワード, 件数) ごとの検索結果を TTL 付きで sqlite に保存するキャッシュ
+    """
+
+    def __init__(self, path: str, ttl: float = 24 * 60 * 60) -> None:
+        """
+        :param path: str  sqlite ファイルのパス
+        :param ttl: float  結果を有効とみなす秒数
+        """
+        self.path = path
+        self.ttl = ttl
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS search_results ("
+            "keyword TEXT NOT NULL, num INTEGER NOT NULL, results TEXT NOT NULL, expires REAL NOT NULL, "
+            "PRIMARY KEY (keyword, num))"
+        )
+        self._conn.commit()
+
+    def get(self, keyword: str, num: int) -> Optional[list]:
+        """
+        :param keyword: str
+        :param num: int
+        :return: list | None  保存されていないか期限切れの場合は None
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT results, expires FROM search_results WHERE keyword = ? AND num = ?",
+                                     (keyword, num)).fetchone()
+        if row is None or row[1] < time.time():
+            return None
+        return json.loads(row[0])
+
+    def put(self, keyword: str, num: int, results: list) -> None:
+        """
+        :param keyword: str
+        :param num: int
+        :param results: list
+        :return: None
+        """
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO search_results (keyword, num, results, expires) "
+                               "VALUES (?, ?, ?, ?)",
+                               (keyword, num, json.dumps(results, ensure_ascii=False), time.time() + self.ttl))
+            self._conn.execute("DELETE FROM search_results WHERE expires < ?", (time.time(),))
+            self._conn.commit()
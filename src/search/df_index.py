@@ -0,0 +1,81 @@
+import math
+import os
+import sqlite3
+import threading
+from typing import Dict, Iterable
+
+
+class DocumentFrequencyIndex:
+    """
+    全セッションを通した単語の文書頻度 (document frequency) を sqlite に保存するインデックス
+
+    セッションごとに含まれる単語を記録しておき, 同じセッションを更新したときは差分だけを反映する.
+    更新も参照も対象の文書の単語数に比例する時間で済む.
+    """
+
+    def __init__(self, path: str) -> None:
+        """
+        :param path: str  sqlite ファイルのパス
+        """
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS df (term TEXT PRIMARY KEY, count INTEGER NOT NULL) WITHOUT ROWID;"
+            "CREATE TABLE IF NOT EXISTS doc_terms (session TEXT NOT NULL, term TEXT NOT NULL, "
+            "PRIMARY KEY (session, term)) WITHOUT ROWID;"
+            "CREATE TABLE IF NOT EXISTS sessions (session TEXT PRIMARY KEY) WITHOUT ROWID;"
+        )
+        self._conn.commit()
+
+    def num_docs(self) -> int:
+        """
+        :return: int  登録されているセッション数
+        """
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    def update(self, session: str, terms: Iterable[str]) -> None:
+        """
+        セッションに含まれる単語を登録する. 登録済みのセッションは置き換える
+
+        :param session: str  セッションのディレクトリ名
+        :param terms: Iterable[str]  セッションに含まれる単語
+        :return: None
+        """
+        new_terms = set(terms)
+        with self._lock:
+            old_terms = {row[0] for row in
+                         self._conn.execute("SELECT term FROM doc_terms WHERE session = ?", (session,))}
+            removed = old_terms - new_terms
+            added = new_terms - old_terms
+            self._conn.executemany("UPDATE df SET count = count - 1 WHERE term = ?", [(t,) for t in removed])
+            self._conn.executemany("DELETE FROM doc_terms WHERE session = ? AND term = ?",
+                                   [(session, t) for t in removed])
+            self._conn.executemany("INSERT INTO df (term, count) VALUES (?, 1) "
+                                   "ON CONFLICT (term) DO UPDATE SET count = count + 1", [(t,) for t in added])
+            self._conn.executemany("INSERT INTO doc_terms (session, term) VALUES (?, ?)",
+                                   [(session, t) for t in added])
+            self._conn.executemany("DELETE FROM df WHERE term = ? AND count <= 0", [(t,) for t in removed])
+            self._conn.execute("INSERT OR IGNORE INTO sessions (session) VALUES (?)", (session,))
+            self._conn.commit()
+
+    def idf(self, terms: Iterable[str]) -> Dict[str, float]:
+        """
+        scikit-learn の TfidfVectorizer (smooth_idf=True) と同じ式で idf を返す
+
+        :param terms: Iterable[str]
+        :return: Dict[str, float]
+        """
+        terms = list(set(terms))
+        num_docs = self.num_docs()
+        counts = {}
+        with self._lock:
+            # sqlite のプレースホルダ数の上限を超えないように分けて引く
+            for i in range(0, len(terms), 500):
+                batch = terms[i:i + 500]
+                query = "SELECT term, count FROM df WHERE term IN (" + ",".join("?" * len(batch)) + ")"
+                counts.update(self._conn.execute(query, batch).fetchall())
+        return {term: math.log((1 + num_docs) / (1 + counts.get(term, 0))) + 1 for term in terms}
@@ -0,0 +1,52 @@
+import threading
+from typing import TYPE_CHECKING, Dict, List
+
+if TYPE_CHECKING:
+    from spacy.language import Language
+
+MODEL_NAMES = {
+    "ja": "ja_ginza",  # 日本語のモデル
+    "en": "en_core_web_sm",  # 英語のモデル
+}
+# 名詞句の抽出 (parser と品詞) に不要なコンポーネント
+UNUSED_COMPONENTS = ["ner", "lemmatizer", "textcat", "bunsetu_recognizer"]
+
+_models: Dict[str, "Language"] = {}
+_models_lock = threading.Lock()
+
+
+def get_nlp(lang: str) -> "Language":
+    """
+    言語ごとの spaCy のパイプラインを返す. 初回の呼び出しでだけ読み込み, 以降はプロセス内で使い回す
+
+    :param lang: str  "ja" 以外は英語のモデルを使う
+    :return: Language
+    """
+    model_name = MODEL_NAMES["ja"] if lang == "ja" else MODEL_NAMES["en"]
+    nlp = _models.get(model_name)
+    if nlp is not None:
+        return nlp
+    with _models_lock:
+        if model_name not in _models:
+            # spaCy の import は重いので, 最初にモデルを使うときまで遅らせる
+            import spacy
+
+            nlp = spacy.load(model_name)
+            for name in UNUSED_COMPONENTS:
+                if name in nlp.pipe_names:
+                    nlp.disable_pipe(name)
+            _models[model_name] = nlp
+        return _models[model_name]
+
+
+def extract_noun_chunks(texts: List[str], lang: str, batch_size: int = 32) -> List[List[str]]:
+    """
+    複数の文書から名詞句をまとめて抽出する
+
+    :param texts: List[str]
+    :param lang: str
+    :param batch_size: int  nlp.pipe のバッチサイズ
+    :return: List[List[str]]  texts と同じ順の名詞句のリスト
+    """
+    nlp = get_nlp(lang)
+    return [[chunk.text for chunk in doc.noun_chunks] for doc in nlp.pipe(texts, batch_size=batch_size)]
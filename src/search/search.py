@@ -5,16 +5,33 @@ Created on Thu Dec  7 11:12:11 2023
 @author: pinyo
 """
 
+import hashlib
 import json
 import os
+import re
 import requests
-import spacy
-from sklearn.feature_extraction.text import TfidfVectorizer
-from typing import List
+import threading
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from typing import Dict, List, Optional
+
+from src.metrics.metrics import record_cache, stage
+from src.metrics.tracing import bind_context, span
+from src.search.cache import SearchCache
+from src.search.df_index import DocumentFrequencyIndex
+from src.search.nlp import extract_noun_chunks
+
+DEFAULT_SEARCH_ENDPOINT = "https://www.googleapis.com/customsearch/v1"
+# scikit-learn の TfidfVectorizer のデフォルトと同じ単語の区切り方
+TOKEN_PATTERN = re.compile(r"(?u)\b\w\w+\b")
+# 検索するキーワードの数
+KEYWORD_COUNT = 3
 
 
 class TextAnalyzer:
-    def __init__(self, data_path: str, save_path: str, target_dir: str, threshold: float = 0.8):
+    def __init__(self, data_path: str, save_path: str, target_dir: str, threshold: float = 0.8,
+                 search_endpoint: Optional[str] = None, cache_ttl: float = 24 * 60 * 60, max_workers: int = 4):
         self.data_path = data_path
         self.save_path = save_path
         self.threshold = threshold
@@ -22,25 +39,96 @@ class TextAnalyzer:
         self.config = {
             "GOOGLE_API_KEY": os.environ["GOOGLE_API_KEY"],
             "CUSTOM_SEARCH_ENGINE_ID": os.environ["CUSTOM_SEARCH_ENGINE_ID"],
+            # テストやベンチマークではローカルの代替サーバーに差し替えられる
+            "SEARCH_ENDPOINT": search_endpoint or os.environ.get("CUSTOM_SEARCH_ENDPOINT", DEFAULT_SEARCH_ENDPOINT),
         }
+        self.max_workers = max_workers
+        # コネクションを使い回すため, 検索は 1 つのセッションから投げる
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=max_workers))
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=max_workers))
+        self.cache = SearchCache(os.path.join(save_path, "search_cache.sqlite3"), ttl=cache_ttl)
+        # 全セッションの文書頻度. data_path (要約の保存先) 直下に置く
+        self.df_index = DocumentFrequencyIndex(os.path.join(data_path, "df_index.sqlite3"))
+        # 文書のハッシュ -> 名詞句. prefetch で抽出した結果を使い回す. セッションのコピーでも共有する
+        self.noun_cache: "OrderedDict[str, List[str]]" = OrderedDict()
+        self.noun_cache_size = 1024
+        self.noun_cache_lock = threading.Lock()
 
     @staticmethod
     def extract_nouns(text, lang):
+        # モデルはプロセス内で一度だけ読み込まれる (src/search/nlp.py)
+        return TextAnalyzer.extract_nouns_batch([text], lang)[0]
+
+    @staticmethod
+    def extract_nouns_batch(texts, lang) -> List[List[str]]:
         try:
-            if lang == 'ja':
-                nlp = spacy.load('ja_ginza')  # 日本語のモデル
-            else:
-                nlp = spacy.load('en_core_web_sm')  # 英語のモデル
+            return extract_noun_chunks(texts, lang)  # 名詞句を抽出
         except Exception as e:
             print(f"Error in NLP processing: {str(e)}")
-            return []
+            return [[] for _ in texts]
 
-        doc = nlp(text)
-        nouns = [chunk.text for chunk in doc.noun_chunks]  # 名詞句を抽出
-        # print(nouns)
-        return nouns
+    def extract_nouns_cached(self, texts: List[str], lang) -> List[List[str]]:
+        """
+        noun_cache に無い文書だけをまとめて解析し, texts と同じ順の名詞句のリストを返す
+        """
+        keys = [hashlib.sha256((lang + "\0" + text).encode("utf-8")).hexdigest() for text in texts]
+        with self.noun_cache_lock:
+            found: Dict[str, List[str]] = {key: self.noun_cache[key] for key in keys if key in self.noun_cache}
+        missing = {key: text for key, text in zip(keys, texts) if key not in found}
+        for key in keys:
+            record_cache("nouns", key not in missing)
+        if missing:
+            found.update(zip(missing, self.extract_nouns_batch(list(missing.values()), lang)))
+        with self.noun_cache_lock:
+            for key in keys:
+                self.noun_cache[key] = found[key]
+                self.noun_cache.move_to_end(key)
+            while len(self.noun_cache) > self.noun_cache_size:
+                self.noun_cache.popitem(last=False)
+        return [found[key] for key in keys]
+
+    def prefetch(self, texts: List[str], lang) -> List[str]:
+        """
+        録音中に, map の要約などからキーワードを選んで検索結果を先に取得しておく
+
+        要約のキーワードは要約する前の内容のキーワードと重なることが多いので, analyze_text での検索はキャッシュに当たる.
+        文書頻度は analyze_text でだけ更新する.
+
+        :param texts: List[str]  チャンクごとの要約など
+        :param lang: str
+        :return: List[str]  検索したキーワード
+        """
+        with stage("prefetch_keywords"):
+            nouns = [noun for text_nouns in self.extract_nouns_cached(texts, lang) for noun in text_nouns]
+            keywords = self.select_keywords(nouns, update_df=False)
+        with stage("prefetch_search"), ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(bind_context(self.get_search_results), keyword) for keyword in keywords]
+            for future in futures:
+                future.result()
+        return keywords
+
+    def select_keywords(self, nouns: List[str], update_df: bool = True) -> List[str]:
+        """
+        TF-IDF の高い順に KEYWORD_COUNT 個の単語を選ぶ
+
+        idf は全セッションの文書頻度から求める. update_df なら このセッションの単語で文書頻度を更新する
+        """
+        term_counts = Counter(TOKEN_PATTERN.findall(' '.join(nouns).lower()))
+        if update_df:
+            self.df_index.update(self.target_dir, term_counts.keys())
+        idf = self.df_index.idf(term_counts.keys())
+        tfidf_scores = {word: count * idf[word] for word, count in term_counts.items()}
+
+        # TF-IDFスコアに基づいて単語をソートし、上位を選択
+        sorted_nouns = sorted(tfidf_scores.items(), key=lambda item: item[1], reverse=True)[:KEYWORD_COUNT]
+        return [noun for noun, score in sorted_nouns]
 
     def get_search_results(self, keyword, number=3):
+        cached = self.cache.get(keyword, number)
+        record_cache("search", cached is not None)
+        if cached is not None:
+            return cached
         try:
             params = {
                 "key": self.config["GOOGLE_API_KEY"],
@@ -48,7 +136,8 @@ class TextAnalyzer:
                 "q": keyword,
                 "num": number
             }
-            response = requests.get("https://www.googleapis.com/customsearch/v1", params=params)
+            with span("search_request"):
+                response = self.session.get(self.config["SEARCH_ENDPOINT"], params=params, timeout=10)
             response.raise_for_status()
             search_results = response.json()
 
@@ -57,6 +146,7 @@ class TextAnalyzer:
                 title = item.get("title")
                 link = item.get("link")
                 results.append({"keyword": keyword, "title": title, "url": link})
+            self.cache.put(keyword, number, results)
             return results
 
         except requests.RequestException as e:
@@ -74,24 +164,16 @@ class TextAnalyzer:
         except json.JSONDecodeError:
             raise ValueError(f"Invalid JSON format in {file_name}")
 
-        nouns = self.extract_nouns(text, lang)
-        # TF-IDFを使用して単語の重要度を計算
-        vectorizer = TfidfVectorizer()
-        tfidf_matrix = vectorizer.fit_transform([' '.join(nouns)])
-        tfidf_scores = {word: tfidf_matrix[0, idx] for word, idx in vectorizer.vocabulary_.items()}
-
-        # TF-IDFスコアに基づいて単語をソートし、上位を選択
-        sorted_nouns = sorted(tfidf_scores.items(), key=lambda item: item[1], reverse=True)[:3]
-        """
-        print("Top 3 TF-IDF Scores:")
-        for noun, score in sorted_nouns:
-            print(f"{noun}: {score}")
-        """
-
-        selected_nouns = [noun for noun, score in sorted_nouns]
+        with stage("extract_keywords"):
+            nouns = self.extract_nouns_cached([text], lang)[0]
+            # TF-IDFを使用して単語の重要度を計算
+            selected_nouns = self.select_keywords(nouns)
         search_results = []
-        for noun in selected_nouns:
-            search_results.extend(self.get_search_results(noun))
+        # キーワードごとの検索は並列に投げ, 結果は順番通りにまとめる
+        with stage("keyword_search"), ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(bind_context(self.get_search_results), noun) for noun in selected_nouns]
+            for future in futures:
+                search_results.extend(future.result())
 
         if not os.path.exists(self.save_path):
             os.makedirs(self.save_path)
@@ -0,0 +1,188 @@
+import copy
+import logging
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from src.revise.revise import Reviser
+from src.search.search import TextAnalyzer
+from src.summarize.summarize import Summarizer
+from src.transcribe.transcribe import Transcriber
+
+# クライアントから受け取ったセッション ID として受け付ける形式
+SESSION_ID_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,64}")
+# クライアントから受け取ったディレクトリ名として受け付ける形式.
+# data_path などの直下の 1 階層だけを指すよう, 区切り文字と制御文字を含まず, "." で始まらない (".", ".." にならない)
+DIR_NAME_PATTERN = re.compile(r"[^./\\\x00-\x1f][^/\\\x00-\x1f]{0,127}")
+
+# ディレクトリ名 -> そのディレクトリの要約などを直列にするロック
+_directory_locks: Dict[str, threading.Lock] = {}
+_directory_locks_lock = threading.Lock()
+
+
+def directory_lock(target_dir: str) -> threading.Lock:
+    """
+    target_dir の校正・要約のキャッシュや結果のファイルへの書き込みが同時に走らないようにするロックを返す
+
+    :param target_dir: str
+    :return: threading.Lock  同じ target_dir には同じロックを返す
+    """
+    with _directory_locks_lock:
+        lock = _directory_locks.get(target_dir)
+        if lock is None:
+            lock = _directory_locks[target_dir] = threading.Lock()
+        return lock
+
+
+def check_dir_name(dir_name: str) -> str:
+    """
+    クライアントから受け取ったディレクトリ名を確かめる
+
+    :param dir_name: str
+    :return: str | raise ValueError  DIR_NAME_PATTERN に合わない場合
+    """
+    if not isinstance(dir_name, str) or not DIR_NAME_PATTERN.fullmatch(dir_name):
+        raise ValueError(f"Invalid directory name: {dir_name!r}")
+    return dir_name
+
+
+class Session:
+    """
+    利用者 1 人分のパイプラインの状態
+
+    transcriber, reviser, summarizer, searcher はサーバーで共有するものの浅いコピーで,
+    target_dir だけをセッションごとに持つ. モデル, LLM クライアント, インデックスなどは共有される.
+    """
+
+    def __init__(
+            self,
+            session_id: str,
+            target_dir: str,
+            transcriber: Transcriber,
+            reviser: Reviser,
+            summarizer: Summarizer,
+            searcher: TextAnalyzer,
+    ) -> None:
+        """
+        :param session_id: str
+        :param target_dir: str  最初に使うディレクトリ
+        :param transcriber: Transcriber  モデルを持つ共有のインスタンス
+        :param reviser: Reviser
+        :param summarizer: Summarizer
+        :param searcher: TextAnalyzer
+        """
+        self.session_id = session_id
+        self.transcriber = copy.copy(transcriber)
+        self.reviser = copy.copy(reviser)
+        self.summarizer = copy.copy(summarizer)
+        self.searcher = copy.copy(searcher)
+        self.last_access = time.time()
+        self.target_dir = target_dir
+        self.set_dir(target_dir)
+
+    @property
+    def lock(self) -> threading.Lock:
+        """
+        今のディレクトリのロック. 同じディレクトリを set_dir した別のセッションとも要約などが同時に走らないようにする
+
+        :return: threading.Lock
+        """
+        return directory_lock(self.target_dir)
+
+    def set_dir(self, target_dir: str) -> None:
+        """
+        このセッションの音声と処理結果を置くディレクトリを設定する
+
+        :param target_dir: str
+        :return: None | raise ValueError  ディレクトリ名が不正な場合
+        """
+        check_dir_name(target_dir)
+        self.target_dir = target_dir
+        for pipeline in [self.transcriber, self.reviser, self.summarizer, self.searcher]:
+            pipeline.target_dir = target_dir
+
+    def to_dict(self) -> dict:
+        """
+        :return: dict
+        """
+        return {"session_id": self.session_id, "target_dir": self.target_dir}
+
+
+class SessionManager:
+    """
+    セッション ID ごとの Session を管理する
+
+    最後のアクセスから ttl 秒経ったセッションと, max_sessions を超えた分の古いセッションは破棄する.
+    破棄されてもディレクトリの中身は残るので, 同じディレクトリを set_dir すれば続きから使える.
+    """
+
+    def __init__(
+            self,
+            transcriber: Transcriber,
+            reviser: Reviser,
+            summarizer: Summarizer,
+            searcher: TextAnalyzer,
+            ttl: float = 12 * 60 * 60,
+            max_sessions: int = 256,
+    ) -> None:
+        """
+        :param transcriber: Transcriber  全セッションで共有するインスタンス
+        :param reviser: Reviser
+        :param summarizer: Summarizer
+        :param searcher: TextAnalyzer
+        :param ttl: float  アクセスが無いセッションを破棄するまでの秒数
+        :param max_sessions: int  同時に保持するセッション数の上限
+        """
+        self.transcriber = transcriber
+        self.reviser = reviser
+        self.summarizer = summarizer
+        self.searcher = searcher
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.sessions: "OrderedDict[str, Session]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.logger = logging.getLogger('SessionManager')
+        self.logger.addHandler(logging.StreamHandler())
+
+    def get(self, session_id: Optional[str]) -> Tuple[Session, bool]:
+        """
+        session_id のセッションを返す. 存在しない場合は作る
+
+        :param session_id: str | None  None または不正な形式の場合は新しい ID を振る
+        :return: (Session, bool)  セッションと, 新しく作ったかどうか
+        """
+        if session_id is None or not SESSION_ID_PATTERN.fullmatch(session_id):
+            session_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            session = self.sessions.get(session_id)
+            if session is not None:
+                session.last_access = now
+                self.sessions.move_to_end(session_id)
+                return session, False
+
+            self._evict(now)
+            # set_dir されるまでは他のセッションと混ざらないよう, セッション ID のディレクトリを使う
+            session = Session(session_id, session_id,
+                              self.transcriber, self.reviser, self.summarizer, self.searcher)
+            self.sessions[session_id] = session
+            self.logger.info("Session created: " + session_id)
+            return session, True
+
+    def _evict(self, now: float) -> None:
+        # sessions は最後のアクセス順に並んでいる
+        dropped = set()
+        while self.sessions:
+            session_id, session = next(iter(self.sessions.items()))
+            if now - session.last_access < self.ttl and len(self.sessions) < self.max_sessions:
+                break
+            del self.sessions[session_id]
+            dropped.add(session.target_dir)
+            self.logger.info("Session expired: " + session_id)
+        # 残っているセッションが使っていないディレクトリの音声のアーカイブを閉じる
+        for target_dir in dropped - {session.target_dir for session in self.sessions.values()}:
+            self.transcriber.close_archive(target_dir)
@@ -0,0 +1,124 @@
+import importlib
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, List, Optional, Tuple
+
+
+class StartupProfiler:
+    """
+    サーバー起動時の各段階 (import, モデルの読み込みなど) にかかった時間を記録する
+    """
+
+    def __init__(self) -> None:
+        self.started_at = time.perf_counter()
+        self.phases: List[Tuple[str, float]] = []
+        self._lock = threading.Lock()
+
+        self.logger = logging.getLogger('StartupProfiler')
+        self.logger.addHandler(logging.StreamHandler())
+
+    @contextmanager
+    def phase(self, name: str):
+        """
+        with ブロックにかかった時間を name として記録する
+
+        :param name: str
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.phases.append((name, elapsed))
+            self.logger.info(f"Startup phase {name}: {elapsed:.3f}s")
+
+    def mark(self, name: str) -> None:
+        """
+        起動してから今までの時間を name として記録する
+
+        :param name: str
+        :return: None
+        """
+        elapsed = time.perf_counter() - self.started_at
+        with self._lock:
+            self.phases.append((name, elapsed))
+        self.logger.info(f"Startup mark {name}: {elapsed:.3f}s since start")
+
+    def to_dict(self) -> dict:
+        """
+        :return: dict  {"phases": [{"name", "seconds"}], "uptime": float}
+        """
+        with self._lock:
+            phases = [{"name": name, "seconds": round(seconds, 4)} for name, seconds in self.phases]
+        return {"phases": phases, "uptime": round(time.perf_counter() - self.started_at, 4)}
+
+
+class WarmUp:
+    """
+    重い import とモデルの読み込みをバックグラウンドのスレッドで行う
+
+    steps は順に実行され, ready_after に指定した段階が終わった時点で ready になる.
+    """
+
+    def __init__(self, profiler: StartupProfiler) -> None:
+        """
+        :param profiler: StartupProfiler  各段階の時間を記録する先
+        """
+        self.profiler = profiler
+        self.steps: List[Tuple[str, Callable[[], None]]] = []
+        self.ready_after: Optional[str] = None
+        self.ready = threading.Event()
+        self.error: Optional[str] = None
+        self._thread: Optional[threading.Thread] = None
+
+        self.logger = logging.getLogger('WarmUp')
+        self.logger.addHandler(logging.StreamHandler())
+
+    def add_import(self, module_name: str) -> None:
+        """
+        module_name の import を段階として追加する
+
+        :param module_name: str
+        :return: None
+        """
+        self.add_step("import " + module_name, lambda: importlib.import_module(module_name))
+
+    def add_step(self, name: str, func: Callable[[], None], ready: bool = False) -> None:
+        """
+        :param name: str  段階の名前
+        :param func: Callable[[], None]
+        :param ready: bool  この段階が終わったら ready にするか
+        :return: None
+        """
+        self.steps.append((name, func))
+        if ready:
+            self.ready_after = name
+
+    def start(self) -> None:
+        """
+        バックグラウンドで各段階を実行する
+
+        :return: None
+        """
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="warm-up", daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        for name, func in self.steps:
+            try:
+                with self.profiler.phase(name):
+                    func()
+            except Exception as e:
+                self.logger.error(f"Warm up failed at {name}: {e}")
+                self.error = f"{name}: {e}"
+                return
+            if name == self.ready_after:
+                self.ready.set()
+        if self.ready_after is None:
+            self.ready.set()
+        self.profiler.mark("warm up finished")
@@ -1,62 +1,266 @@
-from langchain.prompts import PromptTemplate
-from langchain.chat_models import ChatOpenAI
-from langchain.chains.summarize import load_summarize_chain
-from langchain.text_splitter import CharacterTextSplitter
-from langchain.docstore.document import Document
-
+import hashlib
 import os
 import json
+import threading
+import time
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable, List, Optional
+
+from src.index.index import TextIndex
+from src.llm.llm import LLMClient, Listener, get_default_client
+from src.metrics.metrics import record_cache, stage
+from src.metrics.tracing import bind_context
+
+MAP_PROMPT_TEMPLATE = """以下の文章の概要をまとめて下さい。
+        ------
+        {text}
+        ------
+        """
+
+COMBINE_PROMPT_TEMPLATE = """
+        ------
+        {text}
+        ------
+        """
+
+CACHE_FILE_NAME = "map_cache.json"
 
 
 class Summarizer:
-    def __init__(self, data_path: str, save_path: str, target_dir: str):
+    def __init__(self, data_path: str, save_path: str, target_dir: str,
+                 map_model: str = "gpt-3.5-turbo", reduce_model: str = "gpt-4",
+                 chunk_size: int = 1000, token_max: int = 5000, llm: Optional[LLMClient] = None,
+                 max_concurrency: int = 8, max_retries: int = 3, index: Optional[TextIndex] = None):
         self.data_path = data_path
         self.save_path = save_path
         self.target_dir = target_dir
+        self.map_model = map_model
+        self.reduce_model = reduce_model
+        self.chunk_size = chunk_size
+        self.token_max = token_max
+        # map と collapse はチャンクごとに並列に投げる. レート制限は LLMClient の limiter で行う
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
         self.summarized_text = ""
+        self.llm = llm if llm is not None else get_default_client()
+        # 要約を登録する全文検索インデックス
+        self.index = index
+        # tokenizer は初めてトークン数を数えるときに読み込む
+        self.encoding = None
+        self.encoding_loaded = False
+
+    def summarize(self, file_name: str, prompt: str = "以下の内容を短く要約して下さい。",
+                  listener: Optional[Listener] = None):
+        """
+        map でチャンクごとに要約し, reduce で 1 つの要約にまとめる
 
-    def summarize(self, file_name: str, prompt: str = "以下の内容を短く要約して下さい。"):
+        listener を指定すると, 段階の開始 ("stage"), 生成中のトークン ("token"), チャンクごとの結果 ("result") を渡す.
+        map と collapse のトークンは複数のチャンクのものが混ざって届くので, index で区別する.
+        """
         with open(os.path.join(self.data_path, self.target_dir, file_name), 'r') as f:
             d = json.load(f)
             text = d["text"]
 
-        map_prompt_template = """以下の文章の概要をまとめて下さい。
-        ------
-        {text}
-        ------
+        map_prompt = MAP_PROMPT_TEMPLATE
+        combine_prompt = prompt + COMBINE_PROMPT_TEMPLATE
+
+        # map の結果はチャンクのハッシュでキャッシュし, 新しいチャンクだけを要約する
+        cache = self.load_cache()
+        chunks = self.split_chunks(text)
+        with stage("summarize_map"):
+            summaries = self.cached_predict_all(cache, self.map_model,
+                                                [map_prompt.format(text=chunk) for chunk in chunks],
+                                                listener=listener, stage_name="summarize_map")
+
+        # reduce: token_max に収まるまで collapse してから最終的な要約を作る
+        while len(summaries) > 1 and self.count_tokens("\n".join(summaries)) > self.token_max:
+            groups = self.group_summaries(summaries)
+            if len(groups) == len(summaries):
+                # これ以上まとめられない場合はそのまま reduce する
+                break
+            with stage("summarize_collapse"):
+                summaries = self.cached_predict_all(cache, self.reduce_model,
+                                                    [combine_prompt.format(text=group) for group in groups],
+                                                    listener=listener, stage_name="summarize_collapse")
+        with stage("summarize_reduce"):
+            self.summarized_text = self.cached_predict_all(cache, self.reduce_model,
+                                                           [combine_prompt.format(text="\n".join(summaries))],
+                                                           listener=listener, stage_name="summarize_reduce")[0]
+
+        self.prune_cache(cache)
+        return self.summarized_text
+
+    def prepare(self, text: str, cancelled: Optional[threading.Event] = None) -> List[str]:
         """
+        録音中に map を先に実行しておく. 最後のチャンクはまだ伸びるので飛ばす
 
-        map_combine_template = prompt + """
-        ------
-        {text}
-        ------
+        結果はキャッシュに残るので, summarize では最後のチャンクの map と reduce だけを行えばよい.
+        cancelled がセットされると, まだ投げていないチャンクを飛ばして CancelledError を送出する.
+
+        :param text: str  校正済みのテキスト (Reviser.prepare の結果)
+        :param cancelled: threading.Event | None
+        :return: List[str]  チャンクごとの要約
         """
+        chunks = self.split_chunks(text)[:-1]
+        if not chunks:
+            return []
+        with stage("summarize_prepare"):
+            return self.cached_predict_all(self.load_cache(), self.map_model,
+                                           [MAP_PROMPT_TEMPLATE.format(text=chunk) for chunk in chunks],
+                                           cancelled=cancelled)
 
-        map_first_prompt = PromptTemplate(template=map_prompt_template, input_variables=["text"])
-        map_combine_prompt = PromptTemplate(template=map_combine_template, input_variables=["text"])
-
-        map_chain = load_summarize_chain(
-            llm=ChatOpenAI(temperature=0, model_name="gpt-3.5-turbo"),
-            reduce_llm=ChatOpenAI(temperature=0, model_name="gpt-4"),
-            collapse_llm=ChatOpenAI(temperature=0, model_name="gpt-4"),
-            chain_type="map_reduce",
-            map_prompt=map_first_prompt,
-            combine_prompt=map_combine_prompt,
-            collapse_prompt=map_combine_prompt,
-            token_max=5000,
-            verbose=True
-        )
-
-        text_splitter = CharacterTextSplitter.from_tiktoken_encoder(
-            chunk_size=1000, chunk_overlap=0, separator="\n"
-        )
-        texts = text_splitter.split_text(text)
-
-        docs = [Document(page_content=t) for t in texts]
-        result = map_chain({"input_documents": docs}, return_only_outputs=True)
-        self.summarized_text = result["output_text"]
+    def count_tokens(self, text: str) -> int:
+        if not self.encoding_loaded:
+            try:
+                import tiktoken
+                self.encoding = tiktoken.get_encoding("cl100k_base")
+            except Exception:
+                # オフライン環境で BPE ファイルを取得できない場合は文字数で近似する
+                self.encoding = None
+            self.encoding_loaded = True
+        if self.encoding is None:
+            return len(text)
+        return len(self.encoding.encode(text))
 
-        return self.summarized_text
+    def split_chunks(self, text: str) -> List[str]:
+        """
+        改行ごとに chunk_size トークン以内のチャンクへ先頭から詰める.
+        テキストが末尾に追記されても, 最後以外のチャンクの境界は変わらない.
+        """
+        chunks = []
+        lines = []
+        tokens = 0
+        for line in text.split("\n"):
+            if not line.strip():
+                continue
+            line_tokens = self.count_tokens(line)
+            if lines and tokens + line_tokens > self.chunk_size:
+                chunks.append("\n".join(lines))
+                lines = []
+                tokens = 0
+            lines.append(line)
+            tokens += line_tokens
+        if lines:
+            chunks.append("\n".join(lines))
+        return chunks
+
+    def group_summaries(self, summaries: List[str]) -> List[str]:
+        groups = []
+        group = []
+        tokens = 0
+        for summary in summaries:
+            summary_tokens = self.count_tokens(summary)
+            if group and tokens + summary_tokens > self.token_max:
+                groups.append("\n".join(group))
+                group = []
+                tokens = 0
+            group.append(summary)
+            tokens += summary_tokens
+        if group:
+            groups.append("\n".join(group))
+        return groups
+
+    def cached_predict_all(self, cache: dict, model_name: str, prompts: List[str],
+                           listener: Optional[Listener] = None, stage_name: str = "",
+                           cancelled: Optional[threading.Event] = None) -> List[str]:
+        """
+        キャッシュに無いプロンプトだけを並列に投げ, prompts と同じ順で結果を返す
+
+        listener を指定すると応答をストリーミングで受け取り, トークンと結果を prompts の index 付きで渡す.
+        cancelled がセットされると, まだ投げていないプロンプトは CancelledError で失敗させる.
+        """
+        keys = [hashlib.sha256((model_name + "\0" + prompt).encode("utf-8")).hexdigest() for prompt in prompts]
+        missing = {key: prompt for key, prompt in zip(keys, prompts) if key not in cache["entries"]}
+        for key in keys:
+            record_cache("summarize", key not in missing)
+        if listener is not None:
+            listener("stage", {"stage": stage_name, "count": len(prompts)})
+            for i, key in enumerate(keys):
+                if key not in missing:
+                    listener("result", {"stage": stage_name, "index": i, "text": cache["entries"][key]})
+        if missing:
+            with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(missing))) as executor:
+                # リクエストのトレースをワーカースレッドに引き継ぐ
+                futures = {key: executor.submit(bind_context(self.predict_with_retry), model_name, prompt,
+                                                 self.stream_listener(listener, stage_name, keys.index(key)),
+                                                 cancelled)
+                           for key, prompt in missing.items()}
+            errors = []
+            for key, future in futures.items():
+                if future.exception() is not None:
+                    errors.append(future.exception())
+                else:
+                    cache["entries"][key] = future.result()
+            # 一部が失敗しても成功した結果は次回に再利用する
+            self.save_cache(cache)
+            if errors:
+                raise errors[0]
+        cache["used"].update(keys)
+        return [cache["entries"][key] for key in keys]
+
+    def predict_with_retry(self, model_name: str, prompt: str,
+                           on_delta: Optional[Callable[[Optional[str], Optional[str]], None]] = None,
+                           cancelled: Optional[threading.Event] = None) -> str:
+        """
+        on_delta を指定すると応答をストリーミングで受け取り, 断片ごとに on_delta(delta, None) を,
+        最後に on_delta(None, 応答全体) を呼ぶ. 断片を渡し始めた後に失敗した場合は再試行しない
+
+        再試行はここでだけ行い, OpenAI の SDK には再試行させない (回数が掛け算にならないようにする)
+        """
+        for attempt in range(self.max_retries + 1):
+            if cancelled is not None and cancelled.is_set():
+                raise CancelledError()
+            deltas = []
+            try:
+                if on_delta is None:
+                    return self.llm.complete(prompt, model=model_name, temperature=0, max_retries=0)
+                for delta in self.llm.stream(prompt, model=model_name, temperature=0, max_retries=0):
+                    deltas.append(delta)
+                    on_delta(delta, None)
+                response = "".join(deltas)
+                on_delta(None, response)
+                return response
+            except Exception:
+                if attempt == self.max_retries or deltas:
+                    raise
+                time.sleep(2 ** attempt)
+
+    @staticmethod
+    def stream_listener(listener: Optional[Listener], stage_name: str, index: int):
+        """
+        predict_with_retry の on_delta を listener の "token", "result" に変換する
+        """
+        if listener is None:
+            return None
+
+        def on_delta(delta: Optional[str], text: Optional[str]) -> None:
+            if delta is not None:
+                listener("token", {"stage": stage_name, "index": index, "delta": delta})
+            else:
+                listener("result", {"stage": stage_name, "index": index, "text": text})
+        return on_delta
+
+    def load_cache(self) -> dict:
+        cache_path = os.path.join(self.save_path, self.target_dir, CACHE_FILE_NAME)
+        entries = {}
+        if os.path.exists(cache_path):
+            with open(cache_path, "r") as f:
+                entries = json.load(f)
+        return {"entries": entries, "used": set()}
+
+    def save_cache(self, cache: dict):
+        os.makedirs(os.path.join(self.save_path, self.target_dir), exist_ok=True)
+        cache_path = os.path.join(self.save_path, self.target_dir, CACHE_FILE_NAME)
+        with open(cache_path + ".tmp", "w") as f:
+            json.dump(cache["entries"], f, ensure_ascii=False)
+        os.replace(cache_path + ".tmp", cache_path)
+
+    def prune_cache(self, cache: dict):
+        # 今回使わなかった結果 (伸びる前の最後のチャンクなど) は捨てる
+        if cache["used"] != set(cache["entries"]):
+            cache["entries"] = {key: cache["entries"][key] for key in cache["used"]}
+            self.save_cache(cache)
 
     def save_text(self, file_name: str):
         if not os.path.exists(os.path.join(self.save_path, self.target_dir)):
@@ -64,6 +268,9 @@ class Summarizer:
         result = {"text": self.summarized_text}
         with open(os.path.join(self.save_path, self.target_dir, file_name), "w") as f:
             json.dump(result, f, ensure_ascii=False)
+        if self.index is not None:
+            self.index.replace("summary", self.target_dir,
+                               [(file_name, datetime.now().isoformat(), self.summarized_text)])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,248 @@
+import fcntl
+import functools
+import io
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from src.transcribe.audio import SAMPLE_RATE, load_audio_bytes
+
+# data_path/target_dir に置く, 発話ごとの音声を追記していくファイル
+ARCHIVE_FILE_NAME = "segments.archive"
+# レコードの先頭: マジック, ヘッダー (JSON) のバイト数, 音声のバイト数
+RECORD_MAGIC = b"SEG1"
+RECORD_PREFIX = struct.Struct("!4sIQ")
+
+logger = logging.getLogger(__name__)
+
+
+@functools.lru_cache(maxsize=None)
+def get_codec() -> str:
+    """
+    使える中で最も圧縮率の高いコーデックを返す. FLAC には soundfile が必要
+
+    soundfile は依存関係に含まれているが, 読み込めない環境では非圧縮の PCM 16bit で保存して警告を出す.
+
+    :return: str  "flac" | "pcm16"
+    """
+    try:
+        import soundfile  # noqa: F401
+        return "flac"
+    except (ImportError, OSError) as e:
+        # soundfile は libsndfile が無いと OSError になる
+        logger.warning(f"soundfile is not available ({e}); segment archives are stored as uncompressed PCM16")
+        return "pcm16"
+
+
+def encode_audio(audio: np.ndarray, codec: str) -> bytes:
+    """
+    :param audio: np.ndarray  16 kHz の float32
+    :param codec: str  "flac" | "pcm16"
+    :return: bytes
+    """
+    pcm = (np.clip(audio, -1.0, 1.0) * 32767).astype("<i2")
+    if codec == "pcm16":
+        return pcm.tobytes()
+    import soundfile
+
+    buffer = io.BytesIO()
+    soundfile.write(buffer, pcm, SAMPLE_RATE, format="FLAC", subtype="PCM_16")
+    return buffer.getvalue()
+
+
+def decode_audio(payload: memoryview, header: dict) -> np.ndarray:
+    """
+    :param payload: memoryview  レコードの音声部分
+    :param header: dict  レコードのヘッダー
+    :return: np.ndarray  16 kHz の float32
+    """
+    codec = header["codec"]
+    if codec == "pcm16":
+        return np.frombuffer(payload, dtype="<i2").astype(np.float32) / 32768.0
+    if codec == "flac":
+        import soundfile
+
+        audio, _ = soundfile.read(io.BytesIO(payload), dtype="float32")
+        return audio
+    # アップロードされたままの m4a, mp3 など
+    return load_audio_bytes(bytes(payload), header["name"])
+
+
+class SegmentArchive:
+    """
+    1 セッション分の発話の音声を 1 つのファイルに追記していくアーカイブ
+
+    レコードは [prefix][ヘッダー (JSON)][音声] の順に並び, ヘッダーに名前とコーデックを持つ.
+    開いたときにヘッダーだけを読んで名前 -> オフセットの索引を作り, 音声は mmap で必要な分だけ読む.
+    セッションの音声をまとめて消すときはファイルを 1 つ消すだけでよい.
+    別のプロセスが追記したレコードは, 索引に無い名前を読むときに読み足す.
+    追記と不完全なレコードの切り詰めはファイルの排他ロック (flock) を取って行う.
+    """
+
+    def __init__(self, path: str) -> None:
+        """
+        :param path: str  アーカイブのファイルのパス
+        """
+        self.path = path
+        self.codec = get_codec()
+        # 名前 -> (音声のオフセット, 音声のバイト数, ヘッダー)
+        self.index: Dict[str, Tuple[int, int, dict]] = {}
+        self.names: List[str] = []
+        self.end = 0
+        self._mmap: Optional[mmap.mmap] = None
+        self._lock = threading.Lock()
+        with self._lock:
+            self._scan()
+            if os.path.exists(path) and os.path.getsize(path) > self.end:
+                self._recover()
+
+    def append(self, name: str, audio: Optional[np.ndarray] = None, data: Optional[bytes] = None) -> None:
+        """
+        発話を追記する
+
+        :param name: str  発話のファイル名
+        :param audio: np.ndarray | None  デコード済みの音声. codec で圧縮して保存する
+        :param data: bytes | None  audio が無い場合に, そのまま保存する音声ファイルの中身
+        :return: None
+        """
+        if audio is not None:
+            header = {"name": name, "codec": self.codec, "samples": len(audio)}
+            payload = encode_audio(audio, self.codec)
+        else:
+            header = {"name": name, "codec": "file"}
+            payload = data
+        header["created_at"] = time.time()
+        body = json.dumps(header, ensure_ascii=False).encode("utf-8")
+        record = RECORD_PREFIX.pack(RECORD_MAGIC, len(body), len(payload)) + body + payload
+
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            # O_APPEND の 1 回の write で書き, 他のプロセスの追記と混ざらないようにする
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                # 書き込み中のレコードを別のプロセスに切り詰められないようにする
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                self._truncate_torn_tail(fd)
+                os.write(fd, record)
+            finally:
+                os.close(fd)
+            self._scan()
+
+    def read(self, name: str) -> np.ndarray:
+        """
+        :param name: str
+        :return: np.ndarray | raise KeyError
+        """
+        with self._lock:
+            if name not in self.index:
+                self._scan()
+            offset, size, header = self.index[name]
+            if self._mmap is None or len(self._mmap) < offset + size:
+                self._remap()
+            payload = memoryview(self._mmap)[offset:offset + size]
+            try:
+                return decode_audio(payload, header)
+            finally:
+                payload.release()
+
+    def __contains__(self, name: str) -> bool:
+        with self._lock:
+            if name not in self.index:
+                self._scan()
+            return name in self.index
+
+    def list_names(self) -> List[str]:
+        """
+        :return: List[str]  追記された順の発話の名前
+        """
+        with self._lock:
+            self._scan()
+            return list(self.names)
+
+    def delete(self) -> None:
+        """
+        アーカイブのファイルを削除する
+
+        :return: None
+        """
+        with self._lock:
+            self._close_mmap()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            self.index = {}
+            self.names = []
+            self.end = 0
+
+    def close(self) -> None:
+        """
+        mmap を閉じる. 閉じた後に read すると開き直す
+
+        :return: None
+        """
+        with self._lock:
+            self._close_mmap()
+
+    def _scan(self) -> None:
+        # 前回読んだ位置から後ろに追記されたレコードのヘッダーを読む. 呼び出し側で _lock を取っていること
+        if not os.path.exists(self.path):
+            if self.end:
+                # 他のプロセスに削除された
+                self._close_mmap()
+                self.index, self.names, self.end = {}, [], 0
+            return
+        size = os.path.getsize(self.path)
+        if size < self.end:
+            self._close_mmap()
+            self.index, self.names, self.end = {}, [], 0
+        with open(self.path, "rb") as f:
+            f.seek(self.end)
+            while self.end + RECORD_PREFIX.size <= size:
+                magic, header_size, payload_size = RECORD_PREFIX.unpack(f.read(RECORD_PREFIX.size))
+                if magic != RECORD_MAGIC:
+                    raise ValueError(f"Corrupted segment archive: {self.path} at {self.end}")
+                payload_offset = self.end + RECORD_PREFIX.size + header_size
+                if payload_offset + payload_size > size:
+                    # 書き込み途中のレコードは次回に読む
+                    break
+                header = json.loads(f.read(header_size))
+                if header["name"] not in self.index:
+                    self.names.append(header["name"])
+                self.index[header["name"]] = (payload_offset, payload_size, header)
+                f.seek(payload_size, os.SEEK_CUR)
+                self.end = payload_offset + payload_size
+
+    def _recover(self) -> None:
+        # 呼び出し側で _lock を取っていること
+        try:
+            fd = os.open(self.path, os.O_WRONLY)
+        except FileNotFoundError:
+            return
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            self._truncate_torn_tail(fd)
+        finally:
+            os.close(fd)
+
+    def _truncate_torn_tail(self, fd: int) -> None:
+        # 追記の途中で落ちた場合の不完全なレコードを捨てる. 呼び出し側で _lock と fd の flock を取っていること
+        # 追記は flock を取って行うので, ロックを取った後にも残っている不完全なレコードは書き込んだプロセスが落ちたもの
+        self._scan()
+        if os.fstat(fd).st_size > self.end:
+            os.ftruncate(fd, self.end)
+
+    def _remap(self) -> None:
+        self._close_mmap()
+        with open(self.path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _close_mmap(self) -> None:
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
@@ -0,0 +1,111 @@
+import os
+import struct
+import tempfile
+from typing import Optional
+
+import numpy as np
+
+# whisper.audio と同じ値. whisper (torch) を import せずに使えるようにここで定義する
+SAMPLE_RATE = 16000
+CHUNK_LENGTH = 30
+N_SAMPLES = CHUNK_LENGTH * SAMPLE_RATE
+
+WAVE_FORMAT_PCM = 1
+WAVE_FORMAT_IEEE_FLOAT = 3
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+
+def decode_wav(data: bytes) -> Optional[np.ndarray]:
+    """
+    16 kHz モノラルの WAV (PCM 16bit / float 32bit) をそのまま float32 の配列にする
+
+    float 32bit の場合はバッファをコピーせずに参照する (読み取り専用の配列になる).
+
+    :param data: bytes  WAV ファイルの中身
+    :return: np.ndarray | None  高速パスで扱えない形式の場合は None
+    """
+    if len(data) < 12 or data[0:4] != b"RIFF" or data[8:12] != b"WAVE":
+        return None
+
+    audio_format = channels = sample_rate = bits_per_sample = None
+    offset = 12
+    while offset + 8 <= len(data):
+        chunk_id = data[offset:offset + 4]
+        chunk_size = struct.unpack_from("<I", data, offset + 4)[0]
+        body = offset + 8
+        if chunk_id == b"fmt ":
+            audio_format, channels, sample_rate, _, _, bits_per_sample = struct.unpack_from("<HHIIHH", data, body)
+            if audio_format == WAVE_FORMAT_EXTENSIBLE and chunk_size >= 26:
+                # SubFormat GUID の先頭 2 バイトが実際のフォーマット
+                audio_format = struct.unpack_from("<H", data, body + 24)[0]
+        elif chunk_id == b"data":
+            if channels != 1 or sample_rate != SAMPLE_RATE:
+                return None
+            # ストリーミングで書かれた WAV はサイズが不正なことがあるので実データ長で切る
+            size = min(chunk_size, len(data) - body)
+            if audio_format == WAVE_FORMAT_IEEE_FLOAT and bits_per_sample == 32:
+                return np.frombuffer(data, dtype="<f4", count=size // 4, offset=body)
+            if audio_format == WAVE_FORMAT_PCM and bits_per_sample == 16:
+                pcm = np.frombuffer(data, dtype="<i2", count=size // 2, offset=body)
+                return pcm.astype(np.float32) / 32768.0
+            return None
+        # チャンクは 2 バイト境界に揃えられている
+        offset = body + chunk_size + (chunk_size & 1)
+    return None
+
+
+def load_audio_bytes(data: bytes, file_name: str) -> np.ndarray:
+    """
+    音声ファイルの中身を whisper に渡せる 16 kHz モノラルの float32 配列にする
+
+    WAV は decode_wav で直接変換し, それ以外 (m4a, mp3 など) の場合のみ ffmpeg を使う.
+
+    :param data: bytes  音声ファイルの中身
+    :param file_name: str  拡張子の判定に使うファイル名
+    :return: np.ndarray
+    """
+    audio = decode_wav(data)
+    if audio is not None:
+        return audio
+    import whisper
+
+    suffix = os.path.splitext(file_name)[1]
+    with tempfile.NamedTemporaryFile(suffix=suffix) as f:
+        f.write(data)
+        f.flush()
+        return whisper.load_audio(f.name)
+
+
+def load_audio_file(file_path: str) -> np.ndarray:
+    """
+    音声ファイルを読み込んで 16 kHz モノラルの float32 配列にする
+
+    :param file_path: str
+    :return: np.ndarray
+    """
+    import whisper
+
+    if file_path.rsplit('.', 1)[-1].lower() == "wav":
+        with open(file_path, "rb") as f:
+            audio = decode_wav(f.read())
+        if audio is not None:
+            return audio
+    return whisper.load_audio(file_path)
+
+
+def encode_wav(audio: np.ndarray) -> bytes:
+    """
+    16 kHz モノラルの float32 配列を float 32bit の WAV にする
+
+    :param audio: np.ndarray
+    :return: bytes  WAV ファイルの中身
+    """
+    pcm = np.asarray(audio, dtype="<f4").tobytes()
+    header = struct.pack(
+        "<4sI4s4sIHHIIHH4sI",
+        b"RIFF", 36 + len(pcm), b"WAVE",
+        b"fmt ", 16, WAVE_FORMAT_IEEE_FLOAT, 1, SAMPLE_RATE,
+        SAMPLE_RATE * 4, 4, 32,
+        b"data", len(pcm),
+    )
+    return header + pcm
@@ -0,0 +1,358 @@
+import dataclasses
+import socket
+import threading
+import time
+from typing import List, Optional
+
+import numpy as np
+
+from src.metrics.metrics import ENCODER_INPUT_SECONDS
+from src.transcribe.audio import CHUNK_LENGTH, N_SAMPLES, SAMPLE_RATE
+from src.transcribe.ipc import recv_message, send_message
+from src.transcribe.packing import pack_utterances, parse_timestamp_tokens, split_segments, trimmed_length
+
+# バッチデコードの結果がこの基準を満たさない場合は温度フォールバック付きの transcribe でやり直す
+COMPRESSION_RATIO_THRESHOLD = 2.4
+LOGPROB_THRESHOLD = -1.0
+
+
+class WhisperBackend:
+    """
+    openai-whisper (PyTorch) のバックエンド
+
+    config:
+        model_name: str
+        device: str  "cuda:0" | "cpu" など
+        cpu_threads: int  CPU で推論するときのスレッド数. 0 なら PyTorch のデフォルト
+        language: str | None  None の場合は自動判定
+        batch_mode: str  transcribe_batch でのエンコーダへの入れ方
+            "pad" (デフォルト): 発話ごとに 30 秒に揃える
+            "pack": 複数の発話を 1 つの 30 秒の窓に詰め, タイムスタンプで元の発話に振り分ける
+            "trim": 30 秒に揃えずに, バッチで最も長い発話の長さまでだけエンコーダに入れる
+        pack_gap: float  pack で発話の間に挟む無音の秒数
+        trim_granularity: float  trim でエンコーダに入れる長さの単位 (秒)
+    """
+
+    name = "whisper"
+    # 起動時の warm up で時間を計測する import
+    modules = ["torch", "whisper"]
+
+    def __init__(self, config: dict) -> None:
+        """
+        :param config: dict  Transcriber の config
+        """
+        self.config = config
+        self.model = None
+
+    def load(self) -> None:
+        import torch
+        import whisper
+
+        if self.config.get("cpu_threads"):
+            torch.set_num_threads(self.config["cpu_threads"])
+        self.model = whisper.load_model(self.config["model_name"], device=self.config.get("device", "cpu"))
+
+    def transcribe(self, audio: np.ndarray, initial_prompt: Optional[str] = None) -> dict:
+        return self.model.transcribe(audio, initial_prompt=initial_prompt, language=self.config.get("language"))
+
+    def transcribe_batch(self, audios: List[np.ndarray]) -> List[Optional[dict]]:
+        """
+        30 秒以内の音声をまとめて 1 バッチでエンコーダ・デコーダに流す
+
+        :param audios: List[np.ndarray]  30 秒以内の音声
+        :return: List[dict | None]  品質が基準を満たさなかったものは None
+        """
+        mode = self.config.get("batch_mode", "pad")
+        if mode == "pack":
+            return self.transcribe_packed(audios)
+        import torch
+        import whisper
+
+        length = N_SAMPLES
+        if mode == "trim":
+            length = trimmed_length(max(len(audio) for audio in audios),
+                                    int(self.config.get("trim_granularity", 5.0) * SAMPLE_RATE))
+        mel = torch.stack([
+            whisper.log_mel_spectrogram(whisper.pad_or_trim(audio, length=length), n_mels=self.model.dims.n_mels)
+            for audio in audios
+        ]).to(self.model.device)
+        ENCODER_INPUT_SECONDS.inc(len(audios) * length / SAMPLE_RATE, mode=mode)
+        options = whisper.DecodingOptions(language=self.config.get("language"),
+                                          without_timestamps=True,
+                                          fp16=self.model.device.type != "cpu")
+        if mode == "trim":
+            decoded = whisper.decode(*self.encode_trimmed(mel, options.fp16), options)
+        else:
+            decoded = whisper.decode(self.model, mel, options)
+
+        results: List[Optional[dict]] = []
+        for audio, result in zip(audios, decoded):
+            if not self.acceptable(result):
+                results.append(None)
+                continue
+            results.append({
+                "text": result.text,
+                "segments": [self.segment_dict(result, 0, 0.0, len(audio) / SAMPLE_RATE, result.text, result.tokens)],
+                "language": result.language,
+            })
+        return results
+
+    def transcribe_packed(self, audios: List[np.ndarray]) -> List[Optional[dict]]:
+        """
+        発話を 30 秒の窓に詰めてタイムスタンプ付きでデコードし, セグメントを元の発話に振り分ける
+
+        窓の品質が基準を満たさない場合と, 発話の境界をまたぐセグメントがあった発話は None を返す.
+        """
+        import torch
+        import whisper
+        from whisper.tokenizer import get_tokenizer
+
+        windows = pack_utterances([len(audio) for audio in audios],
+                                  gap=int(self.config.get("pack_gap", 1.0) * SAMPLE_RATE))
+        mel = torch.stack([
+            whisper.log_mel_spectrogram(whisper.pad_or_trim(window.build(audios)), n_mels=self.model.dims.n_mels)
+            for window in windows
+        ]).to(self.model.device)
+        ENCODER_INPUT_SECONDS.inc(len(windows) * CHUNK_LENGTH, mode="pack")
+        options = whisper.DecodingOptions(language=self.config.get("language"),
+                                          without_timestamps=False,
+                                          fp16=self.model.device.type != "cpu")
+        decoded = whisper.decode(self.model, mel, options)
+        tokenizer = get_tokenizer(self.model.is_multilingual, num_languages=self.model.num_languages)
+
+        results: List[Optional[dict]] = [None] * len(audios)
+        for window, result in zip(windows, decoded):
+            if not self.acceptable(result):
+                continue
+            split = split_segments(window, parse_timestamp_tokens(result.tokens, tokenizer.timestamp_begin))
+            for index, segments in zip(window.indices, split):
+                if segments is None:
+                    continue
+                segment_dicts = [self.segment_dict(result, i, start, end, tokenizer.decode(tokens), tokens)
+                                 for i, (start, end, tokens) in enumerate(segments)]
+                results[index] = {
+                    "text": "".join(segment["text"] for segment in segment_dicts),
+                    "segments": segment_dicts,
+                    "language": result.language,
+                }
+        return results
+
+    def encode_trimmed(self, mel, fp16: bool) -> tuple:
+        """
+        位置埋め込みを mel の長さまでに切り詰めてエンコーダを実行する
+
+        whisper の AudioEncoder は 30 秒の入力しか受け付けないので, 同じ処理をここで行う.
+        whisper.decode にはエンコード済みの特徴量と, 特徴量の長さを n_audio_ctx とするモデルを渡す.
+
+        :return: (TrimmedModel, torch.Tensor)  whisper.decode の model と mel
+        """
+        import torch
+        import torch.nn.functional as F
+
+        encoder = self.model.encoder
+        with torch.no_grad():
+            x = mel.half() if fp16 else mel
+            x = F.gelu(encoder.conv1(x))
+            x = F.gelu(encoder.conv2(x))
+            x = x.permute(0, 2, 1)
+            x = (x + encoder.positional_embedding[:x.shape[1]]).to(x.dtype)
+            for block in encoder.blocks:
+                x = block(x)
+            features = encoder.ln_post(x)
+        return TrimmedModel(self.model, features.shape[1]), features
+
+    @staticmethod
+    def acceptable(result) -> bool:
+        return (result.compression_ratio <= COMPRESSION_RATIO_THRESHOLD
+                and result.avg_logprob >= LOGPROB_THRESHOLD)
+
+    @staticmethod
+    def segment_dict(result, segment_id: int, start: float, end: float, text: str, tokens: List[int]) -> dict:
+        # openai-whisper の transcribe のセグメントと同じ形式. 確率などはデコード全体の値
+        return {
+            "id": segment_id,
+            "seek": 0,
+            "start": start,
+            "end": end,
+            "text": text,
+            "tokens": tokens,
+            "temperature": result.temperature,
+            "avg_logprob": result.avg_logprob,
+            "compression_ratio": result.compression_ratio,
+            "no_speech_prob": result.no_speech_prob,
+        }
+
+
+class TrimmedModel:
+    """
+    エンコード済みの特徴量の長さを n_audio_ctx とする whisper のモデル
+
+    whisper.decode は mel の形が (n_audio_ctx, n_audio_state) であればエンコード済みとみなすので,
+    dims だけを差し替え, それ以外は元のモデルに委ねる.
+    """
+
+    def __init__(self, model, n_audio_ctx: int) -> None:
+        self.model = model
+        self.dims = dataclasses.replace(model.dims, n_audio_ctx=n_audio_ctx)
+
+    def __getattr__(self, name: str):
+        return getattr(self.model, name)
+
+    def detect_language(self, mel, tokenizer=None):
+        # 元のモデルの detect_language は元の dims で判定してしまう
+        from whisper.decoding import detect_language
+
+        return detect_language(self, mel, tokenizer)
+
+
+class FasterWhisperBackend:
+    """
+    faster-whisper (CTranslate2) のバックエンド. CPU では int8 量子化したモデルで推論できる
+
+    config:
+        model_name: str
+        device: str  "cpu" | "cuda"
+        compute_type: str  "int8" (デフォルト) | "int8_float16" | "float16" | "float32"
+        cpu_threads: int  推論に使うスレッド数. 0 なら CTranslate2 のデフォルト
+        beam_size: int
+        language: str | None  None の場合は自動判定
+    """
+
+    name = "faster-whisper"
+    modules = ["faster_whisper"]
+
+    def __init__(self, config: dict) -> None:
+        """
+        :param config: dict  Transcriber の config
+        """
+        self.config = config
+        self.model = None
+
+    def load(self) -> None:
+        try:
+            from faster_whisper import WhisperModel
+        except ImportError as e:
+            raise ImportError("faster-whisper is not installed. Install it with: poetry install -E faster-whisper") from e
+
+        device = self.config.get("device", "cpu")
+        self.model = WhisperModel(self.config["model_name"],
+                                  # faster-whisper は "cuda:0" ではなく device と device_index で指定する
+                                  device=device.split(":")[0],
+                                  device_index=int(device.split(":")[1]) if ":" in device else 0,
+                                  compute_type=self.config.get("compute_type", "int8"),
+                                  cpu_threads=self.config.get("cpu_threads", 0))
+
+    def transcribe(self, audio: np.ndarray, initial_prompt: Optional[str] = None) -> dict:
+        segments, info = self.model.transcribe(audio,
+                                               language=self.config.get("language"),
+                                               beam_size=self.config.get("beam_size", 5),
+                                               initial_prompt=initial_prompt)
+        # openai-whisper の transcribe と同じ形式にそろえる
+        segment_dicts = [{
+            "id": segment.id,
+            "seek": segment.seek,
+            "start": segment.start,
+            "end": segment.end,
+            "text": segment.text,
+            "tokens": segment.tokens,
+            "temperature": segment.temperature,
+            "avg_logprob": segment.avg_logprob,
+            "compression_ratio": segment.compression_ratio,
+            "no_speech_prob": segment.no_speech_prob,
+        } for segment in segments]
+        return {
+            "text": "".join(segment["text"] for segment in segment_dicts),
+            "segments": segment_dicts,
+            "language": info.language,
+        }
+
+    def transcribe_batch(self, audios: List[np.ndarray]) -> List[Optional[dict]]:
+        # バッチ推論には対応していないので, Transcriber に 1 件ずつ処理させる
+        return [None] * len(audios)
+
+
+class RemoteBackend:
+    """
+    別プロセスのモデルサーバー (src/transcribe/model_server.py) に Unix ソケットで推論を依頼するバックエンド
+
+    API サーバーのプロセスはモデルを読み込まず, 推論はモデルサーバーのプロセスで行う.
+
+    config:
+        socket_path: str  モデルサーバーの Unix ソケットのパス
+        connect_timeout: float  モデルサーバーがモデルを読み込み終わるまで待つ秒数
+    """
+
+    name = "remote"
+    # API サーバー側では重いライブラリを import しない
+    modules: List[str] = []
+
+    def __init__(self, config: dict) -> None:
+        """
+        :param config: dict  Transcriber の config
+        """
+        self.config = config
+        self.sock: Optional[socket.socket] = None
+        self._lock = threading.Lock()
+
+    def load(self) -> None:
+        # モデルサーバーはモデルを読み込んでからソケットを開くので, 接続できるまで待つ
+        deadline = time.monotonic() + self.config.get("connect_timeout", 300)
+        while True:
+            try:
+                self._call({"op": "ping"})
+                return
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(1)
+
+    def transcribe(self, audio: np.ndarray, initial_prompt: Optional[str] = None) -> dict:
+        return self._call({"op": "transcribe", "initial_prompt": initial_prompt, "lengths": [len(audio)]},
+                          [audio])
+
+    def transcribe_batch(self, audios: List[np.ndarray]) -> List[Optional[dict]]:
+        return self._call({"op": "transcribe_batch", "lengths": [len(audio) for audio in audios]}, audios)
+
+    def _call(self, header: dict, audios: List[np.ndarray] = ()):
+        with self._lock:
+            # モデルサーバーが再起動した場合に備えて, 切れた接続は 1 度だけつなぎ直す
+            for attempt in range(2):
+                try:
+                    if self.sock is None:
+                        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                        self.sock.connect(self.config["socket_path"])
+                    send_message(self.sock, header, audios)
+                    message = recv_message(self.sock)
+                    if message is None:
+                        raise ConnectionError("Model server closed the connection")
+                    break
+                except OSError:
+                    if self.sock is not None:
+                        self.sock.close()
+                        self.sock = None
+                    if attempt == 1:
+                        raise
+        response, _ = message
+        if not response["ok"]:
+            raise RuntimeError("ModelServerError: " + response["message"])
+        return response["result"]
+
+
+BACKENDS = {
+    WhisperBackend.name: WhisperBackend,
+    FasterWhisperBackend.name: FasterWhisperBackend,
+    RemoteBackend.name: RemoteBackend,
+}
+
+
+def get_backend_class(config: dict):
+    """
+    config["backend"] に対応するバックエンドのクラスを返す. 指定が無い場合は whisper
+
+    :param config: dict
+    :return: type | raise NameError
+    """
+    name = config.get("backend", WhisperBackend.name)
+    if name not in BACKENDS:
+        raise NameError("BackendNotFound: " + name)
+    return BACKENDS[name]
@@ -0,0 +1,74 @@
+import json
+import socket
+import struct
+from typing import Optional, Sequence, Tuple
+
+import numpy as np
+
+# メッセージの先頭: ヘッダー (JSON) のバイト数とペイロード (生の音声) のバイト数
+PREFIX = struct.Struct("!II")
+
+
+def send_message(sock: socket.socket, header: dict, buffers: Sequence[np.ndarray] = ()) -> None:
+    """
+    JSON のヘッダーに続けて, 音声のバッファをそのまま送る
+
+    音声は pickle や JSON にせず, float32 (little endian) のメモリをコピーせずに書き込む.
+
+    :param sock: socket.socket
+    :param header: dict
+    :param buffers: Sequence[np.ndarray]  float32 の音声
+    :return: None
+    """
+    views = [memoryview(np.ascontiguousarray(buffer, dtype="<f4")).cast("B") for buffer in buffers]
+    # 推論結果に含まれる numpy の数値は Python の数値にする
+    body = json.dumps(header, ensure_ascii=False, default=lambda value: value.tolist()).encode("utf-8")
+    sock.sendall(PREFIX.pack(len(body), sum(view.nbytes for view in views)) + body)
+    for view in views:
+        sock.sendall(view)
+
+
+def recv_message(sock: socket.socket) -> Optional[Tuple[dict, bytearray]]:
+    """
+    send_message で送られたメッセージを受け取る
+
+    :param sock: socket.socket
+    :return: (dict, bytearray) | None  相手が接続を閉じた場合は None
+    """
+    prefix = _recv_exact(sock, PREFIX.size, allow_eof=True)
+    if prefix is None:
+        return None
+    header_size, payload_size = PREFIX.unpack(prefix)
+    header = json.loads(_recv_exact(sock, header_size).decode("utf-8"))
+    return header, _recv_exact(sock, payload_size)
+
+
+def split_audios(payload: bytearray, lengths: Sequence[int]) -> list:
+    """
+    ペイロードを音声ごとの np.ndarray に分ける. 配列は payload のメモリを共有する
+
+    :param payload: bytearray
+    :param lengths: Sequence[int]  音声ごとのサンプル数
+    :return: List[np.ndarray]
+    """
+    samples = np.frombuffer(payload, dtype="<f4")
+    audios = []
+    offset = 0
+    for length in lengths:
+        audios.append(samples[offset:offset + length])
+        offset += length
+    return audios
+
+
+def _recv_exact(sock: socket.socket, size: int, allow_eof: bool = False) -> Optional[bytearray]:
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:])
+        if n == 0:
+            if allow_eof and received == 0:
+                return None
+            raise ConnectionError("Connection closed while receiving a message")
+        received += n
+    return buffer
@@ -0,0 +1,261 @@
+import logging
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future
+from datetime import datetime
+from typing import List, Optional
+
+from src.metrics.metrics import STAGE_SECONDS, stage
+from src.transcribe.audio import load_audio_bytes
+from src.transcribe.transcribe import Transcriber
+
+
+class QueueFullError(Exception):
+    """
+    ジョブキューが上限に達しているときに送出される
+    """
+
+
+class TranscriptionJob:
+    """
+    書きおこしジョブ 1 件分の状態
+    """
+
+    def __init__(self, file_name: str, target_dir: str, data: Optional[bytes] = None) -> None:
+        """
+        :param file_name: str  data_path/target_dir 以下の音声ファイル名
+        :param target_dir: str  投入時点のディレクトリ
+        :param data: bytes | None  アップロードされた音声. None の場合はファイルから読み込む
+        """
+        self.job_id = uuid.uuid4().hex
+        self.file_name = file_name
+        self.target_dir = target_dir
+        self.data = data
+        self.status = "queued"
+        self.created_at = datetime.now().isoformat()
+        self.submitted_at = time.monotonic()
+        self.future: Future = Future()
+
+    def to_dict(self) -> dict:
+        """
+        API のレスポンス用に状態を dict にする
+
+        :return: dict
+        """
+        content = {
+            "job_id": self.job_id,
+            "file_name": self.file_name,
+            "status": self.status,
+            "created_at": self.created_at,
+        }
+        if self.future.done():
+            if self.future.exception() is not None:
+                content["message"] = str(self.future.exception())
+            else:
+                content["text"] = self.future.result()
+        return content
+
+
+class TranscriptionQueue:
+    """
+    Transcriber の前段に置くジョブキュー
+
+    アップロードは submit で即座にジョブ ID を返し, 書きおこしはワーカースレッドで行う.
+    キューが max_queue_size に達している場合は QueueFullError を送出してバックプレッシャーをかける.
+    ワーカーは max_batch_wait 秒以内に届いたジョブを最大 max_batch_size 件まとめて 1 バッチで推論する.
+    """
+
+    def __init__(
+            self,
+            transcriber: Transcriber,
+            num_workers: int = 1,
+            max_queue_size: int = 32,
+            max_finished_jobs: int = 1024,
+            max_batch_size: int = 8,
+            max_batch_wait: float = 0.05,
+    ) -> None:
+        """
+        :param transcriber: Transcriber
+        :param num_workers: int  ワーカースレッド数
+        :param max_queue_size: int  未処理ジョブの上限
+        :param max_finished_jobs: int  結果を保持しておく完了済みジョブの上限
+        :param max_batch_size: int  1 バッチにまとめるジョブ数の上限. 1 ならバッチ化しない
+        :param max_batch_wait: float  最初のジョブを受け取ってから後続のジョブを待つ秒数
+        """
+        self.transcriber = transcriber
+        self.num_workers = num_workers
+        self.max_queue_size = max_queue_size
+        self.max_finished_jobs = max_finished_jobs
+        self.max_batch_size = max_batch_size
+        self.max_batch_wait = max_batch_wait
+
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue_size)
+        self._jobs: "OrderedDict[str, TranscriptionJob]" = OrderedDict()
+        self._jobs_lock = threading.Lock()
+        self._workers: List[threading.Thread] = []
+
+        self.logger = logging.getLogger('TranscriptionQueue')
+        self.logger.addHandler(logging.StreamHandler())
+
+    def start(self) -> None:
+        """
+        ワーカースレッドを起動する
+
+        :return: None
+        """
+        if self._workers:
+            return
+        for i in range(self.num_workers):
+            worker = threading.Thread(target=self._run, name=f"transcribe-worker-{i}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+        self.logger.info(f"Started {self.num_workers} transcription workers")
+
+    def stop(self) -> None:
+        """
+        キューに積まれたジョブを処理し終えてからワーカースレッドを停止する
+
+        :return: None
+        """
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+    def qsize(self) -> int:
+        """
+        未処理のジョブ数を返す
+
+        :return: int
+        """
+        return self._queue.qsize()
+
+    def submit(self, file_name: str, target_dir: Optional[str] = None,
+               data: Optional[bytes] = None) -> TranscriptionJob:
+        """
+        書きおこしジョブを投入する
+
+        :param file_name: str
+        :param target_dir: str | None  指定しない場合は transcriber.target_dir
+        :param data: bytes | None  音声ファイルの中身. 指定した場合はディスクを経由せずにデコードする
+        :return: TranscriptionJob | raise QueueFullError
+        """
+        if target_dir is None:
+            target_dir = self.transcriber.target_dir
+        job = TranscriptionJob(file_name, target_dir, data=data)
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            raise QueueFullError(f"Transcription queue is full ({self.max_queue_size} jobs)")
+        with self._jobs_lock:
+            self._jobs[job.job_id] = job
+            self._evict_finished_jobs()
+        return job
+
+    def get(self, job_id: str) -> Optional[TranscriptionJob]:
+        """
+        ジョブ ID からジョブを返す
+
+        :param job_id: str
+        :return: TranscriptionJob | None
+        """
+        with self._jobs_lock:
+            return self._jobs.get(job_id)
+
+    def _evict_finished_jobs(self) -> None:
+        # 古い完了済みジョブから捨てる. 呼び出し側で _jobs_lock を取っていること
+        finished = [job_id for job_id, job in self._jobs.items() if job.future.done()]
+        for job_id in finished[:max(0, len(self._jobs) - self.max_finished_jobs)]:
+            del self._jobs[job_id]
+
+    def _next_batch(self) -> List[Optional[TranscriptionJob]]:
+        # 最初のジョブはブロックして待ち, 後続は max_batch_wait 秒の間だけ集める
+        batch = [self._queue.get()]
+        if batch[0] is None:
+            return batch
+        deadline = time.monotonic() + self.max_batch_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                job = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(job)
+            if job is None:
+                break
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._next_batch()
+            stop = batch[-1] is None
+            jobs = [job for job in batch if job is not None]
+            if jobs:
+                self._process(jobs)
+            for _ in batch:
+                self._queue.task_done()
+            if stop:
+                break
+
+    def _process(self, jobs: List[TranscriptionJob]) -> None:
+        now = time.monotonic()
+        for job in jobs:
+            job.status = "running"
+            STAGE_SECONDS.observe(now - job.submitted_at, stage="transcribe_queue_wait")
+        # デコードに失敗したジョブだけを失敗させ, 残りでバッチを組む
+        decoded = []
+        audios = []
+        with stage("decode_audio"):
+            for job in jobs:
+                try:
+                    audios.append(load_audio_bytes(job.data, job.file_name) if job.data is not None else None)
+                except Exception as e:
+                    self._fail(job, e)
+                    continue
+                decoded.append(job)
+        if not decoded:
+            return
+        try:
+            texts = self._transcribe(decoded, audios)
+        except Exception as e:
+            if len(decoded) == 1:
+                self._fail(decoded[0], e)
+                return
+            # 別のセッションのジョブを巻き込まないように, 1 件ずつ書きおこし直す
+            self.logger.error(f"Batch of {len(decoded)} jobs failed, retrying one by one: {e}")
+            for job, audio in zip(decoded, audios):
+                try:
+                    text = self._transcribe([job], [audio])[0]
+                except Exception as e:
+                    self._fail(job, e)
+                    continue
+                self._finish(job, text)
+            return
+        for job, text in zip(decoded, texts):
+            self._finish(job, text)
+
+    def _transcribe(self, jobs: List[TranscriptionJob], audios: list) -> List[str]:
+        with stage("transcribe"):
+            if len(jobs) == 1:
+                return [self.transcriber.save_text(jobs[0].file_name, target_dir=jobs[0].target_dir,
+                                                   audio=audios[0])]
+            return self.transcriber.save_text_batch([job.file_name for job in jobs],
+                                                    [job.target_dir for job in jobs],
+                                                    audios=audios)
+
+    def _finish(self, job: TranscriptionJob, text: str) -> None:
+        job.data = None
+        job.status = "done"
+        job.future.set_result(text)
+
+    def _fail(self, job: TranscriptionJob, e: Exception) -> None:
+        self.logger.error(f"{job.file_name}: {e}")
+        job.data = None
+        job.status = "failed"
+        job.future.set_exception(e)
@@ -0,0 +1,127 @@
+"""
+書きおこしのモデルを持つ推論専用のプロセス
+
+API サーバー (server.py) を TRANSCRIBE_BACKEND=remote で起動すると, 推論はこのプロセスに Unix ソケットで依頼される.
+API サーバーはモデルを読み込まずにすぐ起動でき, モデルの推論が API サーバーのイベントループや GIL を止めない.
+API サーバーはセッションやジョブをプロセスのメモリに持つので, ワーカーは 1 つで動かす.
+
+    TRANSCRIBE_MODEL_SERVER_BACKEND=whisper python -m src.transcribe.model_server
+    TRANSCRIBE_BACKEND=remote python server.py
+"""
+import logging
+import os
+import socketserver
+import threading
+
+from src.transcribe.backends import RemoteBackend, get_backend_class
+from src.transcribe.ipc import recv_message, send_message, split_audios
+from src.transcribe.transcribe import MODEL_NAMES
+
+DEFAULT_SOCKET_PATH = "./data/model_server.sock"
+
+
+class ModelServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Unix ソケットで受け取った音声を書きおこして結果を返すサーバー
+
+    接続ごとにスレッドで受け付け, モデルでの推論は 1 つずつ行う.
+    1 つの接続で複数のリクエストを順に処理する.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, config: dict) -> None:
+        """
+        :param socket_path: str  待ち受ける Unix ソケットのパス
+        :param config: dict  Transcriber の config. backend に remote は指定できない
+        """
+        if config.get("backend") == RemoteBackend.name:
+            raise ValueError("Model server cannot use the remote backend")
+        if config["model_name"] not in MODEL_NAMES:
+            raise NameError("ModelNotFound")
+        self.config = config
+        self.socket_path = socket_path
+        self.backend = get_backend_class(config)(config)
+        self.model_lock = threading.Lock()
+
+        self.logger = logging.getLogger('ModelServer')
+        self.logger.addHandler(logging.StreamHandler())
+
+        # モデルを読み込んでからソケットを開く. クライアントは接続できるまで待つ
+        self.logger.info("Loading model: " + config["model_name"])
+        self.backend.load()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        if os.path.dirname(socket_path):
+            os.makedirs(os.path.dirname(socket_path), exist_ok=True)
+        super().__init__(socket_path, ModelRequestHandler)
+        self.logger.info("Model server listening on " + socket_path)
+
+    def handle_message(self, header: dict, payload: bytearray):
+        """
+        :param header: dict  {"op": "ping" | "transcribe" | "transcribe_batch", ...}
+        :param payload: bytearray  header["lengths"] のサンプル数ずつ並んだ float32 の音声
+        :return: 結果 (JSON にできるもの)
+        """
+        op = header["op"]
+        if op == "ping":
+            return {"backend": self.backend.name, "model_name": self.config["model_name"]}
+        audios = split_audios(payload, header["lengths"])
+        with self.model_lock:
+            if op == "transcribe":
+                return self.backend.transcribe(audios[0], initial_prompt=header.get("initial_prompt"))
+            if op == "transcribe_batch":
+                return self.backend.transcribe_batch(audios)
+        raise ValueError("Unknown op: " + op)
+
+    def server_close(self) -> None:
+        super().server_close()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+class ModelRequestHandler(socketserver.BaseRequestHandler):
+    server: ModelServer
+
+    def handle(self) -> None:
+        while True:
+            message = recv_message(self.request)
+            if message is None:
+                return
+            header, payload = message
+            try:
+                response = {"ok": True, "result": self.server.handle_message(header, payload)}
+            except Exception as e:
+                self.server.logger.error(e)
+                response = {"ok": False, "message": str(e)}
+            send_message(self.request, response)
+
+
+def config_from_env() -> dict:
+    """
+    server.py と同じ環境変数からモデルの設定を作る. バックエンドは TRANSCRIBE_MODEL_SERVER_BACKEND で指定する
+
+    :return: dict
+    """
+    return {"backend": os.environ.get("TRANSCRIBE_MODEL_SERVER_BACKEND", "whisper"),
+            "model_name": os.environ.get("TRANSCRIBE_MODEL", "small"),
+            "device": os.environ.get("TRANSCRIBE_DEVICE", "cuda:0"),
+            "compute_type": os.environ.get("TRANSCRIBE_COMPUTE_TYPE", "int8"),
+            "cpu_threads": int(os.environ.get("TRANSCRIBE_CPU_THREADS", 0)),
+            "batch_mode": os.environ.get("TRANSCRIBE_BATCH_MODE", "pad")}
+
+
+def main() -> None:
+    # src.transcribe.transcribe の import で basicConfig がファイル出力に設定されているので置き換える
+    logging.basicConfig(level=logging.INFO, force=True)
+    server = ModelServer(os.environ.get("TRANSCRIBE_SOCKET", DEFAULT_SOCKET_PATH), config_from_env())
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+"""
+短い発話を 1 つの 30 秒の窓に詰めて書きおこすための, モデルに依存しない処理
+
+whisper は入力を常に 30 秒に揃えるので, 数秒の発話を 1 件ずつ推論するとエンコーダの計算の大半が無音の部分に使われる.
+pack_utterances で複数の発話を間に無音を挟んで 1 つの窓に並べ, タイムスタンプ付きでデコードした結果を
+split_segments で元の発話に振り分ける.
+"""
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from src.transcribe.audio import N_SAMPLES, SAMPLE_RATE
+
+# whisper のタイムスタンプトークン 1 つあたりの秒数
+TIME_PRECISION = 0.02
+# 発話の境界をまたぐセグメントとみなす, 隣の発話に入り込んだ秒数
+MAX_OVERLAP = 0.3
+
+
+class PackedWindow:
+    """
+    1 つの窓に詰めた発話の並び
+    """
+
+    def __init__(self, indices: List[int], offsets: List[int], lengths: List[int], gap: int) -> None:
+        """
+        :param indices: List[int]  元の発話の index
+        :param offsets: List[int]  窓の中での各発話の開始位置 (サンプル数)
+        :param lengths: List[int]  各発話の長さ (サンプル数)
+        :param gap: int  発話の間に挟む無音の長さ (サンプル数)
+        """
+        self.indices = indices
+        self.offsets = offsets
+        self.lengths = lengths
+        self.gap = gap
+
+    @property
+    def length(self) -> int:
+        return self.offsets[-1] + self.lengths[-1]
+
+    def build(self, audios: List[np.ndarray]) -> np.ndarray:
+        """
+        :param audios: List[np.ndarray]  元の発話すべて
+        :return: np.ndarray  発話を並べた音声
+        """
+        window = np.zeros(self.length, dtype=np.float32)
+        for index, offset, length in zip(self.indices, self.offsets, self.lengths):
+            window[offset:offset + length] = audios[index]
+        return window
+
+    def bounds(self) -> List[Tuple[float, float]]:
+        """
+        各発話が受け持つ区間 (秒). 発話の間の無音は半分ずつ両側の発話に含める
+
+        :return: List[(float, float)]
+        """
+        half_gap = self.gap / 2
+        return [((offset - half_gap) / SAMPLE_RATE, (offset + length + half_gap) / SAMPLE_RATE)
+                for offset, length in zip(self.offsets, self.lengths)]
+
+
+def pack_utterances(lengths: List[int], gap: int, max_samples: int = N_SAMPLES) -> List[PackedWindow]:
+    """
+    発話を先頭から順に, 無音を挟んで max_samples に収まるだけ 1 つの窓に詰める
+
+    :param lengths: List[int]  発話の長さ (サンプル数). どれも max_samples 以下であること
+    :param gap: int  発話の間に挟む無音の長さ (サンプル数)
+    :param max_samples: int  窓の長さ
+    :return: List[PackedWindow]
+    """
+    windows = []
+    indices: List[int] = []
+    offsets: List[int] = []
+    position = 0
+    for index, length in enumerate(lengths):
+        offset = position + gap if indices else 0
+        if indices and offset + length > max_samples:
+            windows.append(PackedWindow(indices, offsets, [lengths[i] for i in indices], gap))
+            indices, offsets, offset = [], [], 0
+        indices.append(index)
+        offsets.append(offset)
+        position = offset + length
+    if indices:
+        windows.append(PackedWindow(indices, offsets, [lengths[i] for i in indices], gap))
+    return windows
+
+
+def parse_timestamp_tokens(tokens: List[int], timestamp_begin: int) -> List[Tuple[float, Optional[float], List[int]]]:
+    """
+    タイムスタンプ付きでデコードしたトークン列を <|start|> text <|end|> ごとのセグメントに分ける
+
+    :param tokens: List[int]  特殊トークンを除いたデコード結果
+    :param timestamp_begin: int  <|0.00|> のトークン ID
+    :return: List[(float, float | None, List[int])]  開始秒, 終了秒 (最後が閉じていなければ None), テキストのトークン
+    """
+    segments = []
+    start: Optional[float] = None
+    text_tokens: List[int] = []
+    last_time = 0.0
+    for token in tokens:
+        if token < timestamp_begin:
+            if start is None:
+                start = last_time
+            text_tokens.append(token)
+            continue
+        last_time = (token - timestamp_begin) * TIME_PRECISION
+        if start is not None and text_tokens:
+            segments.append((start, last_time, text_tokens))
+            start, text_tokens = None, []
+        else:
+            # <|end|><|start|> と続く場合は後ろのものが次のセグメントの開始
+            start = last_time
+    if text_tokens:
+        segments.append((start, None, text_tokens))
+    return segments
+
+
+def split_segments(window: PackedWindow,
+                   segments: List[Tuple[float, Optional[float], List[int]]]) -> List[Optional[list]]:
+    """
+    窓全体のセグメントを, 区間が重なる発話に振り分ける
+
+    :param window: PackedWindow
+    :param segments: parse_timestamp_tokens の結果
+    :return: List[list | None]  window.indices と同じ順の, 発話ごとの (発話の中での開始秒, 終了秒, トークン) のリスト.
+    境界をまたぐセグメントや閉じていないセグメントがあった発話と, セグメントが 1 つも無い発話は None (個別に書きおこし直す)
+    """
+    bounds = window.bounds()
+    assigned: List[Optional[list]] = [[] for _ in bounds]
+    failed = set()
+    window_end = window.length / SAMPLE_RATE
+    for start, end, tokens in segments:
+        # 閉じていないセグメントはデコードが sample_len で打ち切られたもので, 途中までしか書きおこされていない
+        unclosed = end is None
+        end = window_end if unclosed else end
+        overlaps = [i for i, (lower, upper) in enumerate(bounds)
+                    if min(end, upper) - max(start, lower) > MAX_OVERLAP]
+        if not overlaps:
+            # 無音の部分だけにかかる短いセグメントは中央の位置で振り分ける
+            middle = (start + end) / 2
+            overlaps = [min(range(len(bounds)), key=lambda i: abs((bounds[i][0] + bounds[i][1]) / 2 - middle))]
+        if len(overlaps) > 1 or unclosed:
+            failed.update(overlaps)
+            continue
+        i = overlaps[0]
+        offset = window.offsets[i] / SAMPLE_RATE
+        duration = window.lengths[i] / SAMPLE_RATE
+        assigned[i].append((max(0.0, start - offset), min(duration, max(0.0, end - offset)), tokens))
+    return [None if i in failed or not segments_of_utterance else segments_of_utterance
+            for i, segments_of_utterance in enumerate(assigned)]
+
+
+def trimmed_length(length: int, granularity: int) -> int:
+    """
+    エンコーダに入れる長さ. 同じバッチの長さを揃えやすいよう granularity の倍数に切り上げる
+
+    :param length: int  音声の長さ (サンプル数)
+    :param granularity: int  サンプル数
+    :return: int  N_SAMPLES 以下
+    """
+    return min(N_SAMPLES, max(granularity, -(-length // granularity) * granularity))
@@ -0,0 +1,158 @@
+import base64
+import json
+import os
+import sqlite3
+import threading
+import zlib
+from typing import List, Optional, Tuple
+
+# save_path/target_dir に置く, セッションの書きおこし結果の sqlite ファイル
+STORE_FILE_NAME = "transcript.sqlite3"
+# segments に持たせる結果の項目. それ以外 (segments の tokens, avg_logprob など) は details に圧縮して置く
+COMPACT_KEYS = {"text", "timestamp"}
+
+
+def compact_timings(result: dict) -> Tuple[list, Optional[list]]:
+    """
+    whisper の結果からセグメントと単語の時刻だけを取り出す
+
+    :param result: dict  whisper の transcribe の結果
+    :return: (list, list | None)  [[start, end, text], ...] と, 単語の時刻があれば [[start, end, word], ...]
+    """
+    spans = []
+    words = []
+    for segment in result.get("segments", []):
+        spans.append([round(segment.get("start", 0.0), 2), round(segment.get("end", 0.0), 2), segment.get("text", "")])
+        for word in segment.get("words") or []:
+            words.append([round(word["start"], 2), round(word["end"], 2), word["word"]])
+    return spans, words or None
+
+
+def encode_cursor(timestamp: str, row_id: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps([timestamp, row_id]).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> Tuple[str, int]:
+    """
+    :param cursor: str
+    :return: (str, int) | raise ValueError
+    """
+    try:
+        timestamp, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return str(timestamp), int(row_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+
+class TranscriptStore:
+    """
+    1 セッション分の書きおこし結果を保存する sqlite
+
+    segments にはテキスト, タイムスタンプ, セグメントと単語の時刻だけを持ち, 一覧やページングはこれだけで返す.
+    whisper の結果の残り (tokens, avg_logprob など) は details に zlib で圧縮して置き, detail で必要なときだけ読む.
+    同じ発話 (拡張子を除いたファイル名) を書きおこし直した場合は上書きし, seq を振り直す.
+    """
+
+    def __init__(self, path: str) -> None:
+        """
+        :param path: str  sqlite ファイルのパス
+        """
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS segments ("
+            "id INTEGER PRIMARY KEY, segment TEXT NOT NULL UNIQUE, file_name TEXT NOT NULL, "
+            "timestamp TEXT NOT NULL, text TEXT NOT NULL, spans TEXT NOT NULL, words TEXT, seq INTEGER NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS segments_order ON segments (timestamp, id);"
+            "CREATE INDEX IF NOT EXISTS segments_seq ON segments (seq);"
+            "CREATE TABLE IF NOT EXISTS details (id INTEGER PRIMARY KEY, data BLOB NOT NULL);"
+        )
+        self._conn.commit()
+
+    def add(self, file_name: str, result: dict) -> int:
+        """
+        書きおこし結果を保存する
+
+        :param file_name: str  発話のファイル名
+        :param result: dict  whisper の結果に timestamp を加えたもの
+        :return: int  この変更の seq
+        """
+        spans, words = compact_timings(result)
+        details = {key: value for key, value in result.items() if key not in COMPACT_KEYS}
+        data = zlib.compress(json.dumps(details, ensure_ascii=False).encode("utf-8"))
+        segment = file_name.rsplit('.', 1)[0]
+        with self._lock, self._conn:
+            seq = self._conn.execute("SELECT COALESCE(MAX(seq), 0) + 1 FROM segments").fetchone()[0]
+            self._conn.execute(
+                "INSERT INTO segments (segment, file_name, timestamp, text, spans, words, seq) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(segment) DO UPDATE SET file_name = excluded.file_name, timestamp = excluded.timestamp, "
+                "text = excluded.text, spans = excluded.spans, words = excluded.words, seq = excluded.seq",
+                (segment, file_name, result["timestamp"], result["text"],
+                 json.dumps(spans, ensure_ascii=False), json.dumps(words, ensure_ascii=False) if words else None,
+                 seq))
+            row_id = self._conn.execute("SELECT id FROM segments WHERE segment = ?", (segment,)).fetchone()[0]
+            self._conn.execute("INSERT OR REPLACE INTO details (id, data) VALUES (?, ?)", (row_id, data))
+        return seq
+
+    def changes_since(self, seq: int) -> List[dict]:
+        """
+        seq より後に追加・更新された発話を返す
+
+        :param seq: int
+        :return: List[dict]  {"seq", "file_name", "timestamp", "text"} の seq 順のリスト
+        """
+        with self._lock:
+            rows = self._conn.execute("SELECT seq, file_name, timestamp, text FROM segments WHERE seq > ? "
+                                      "ORDER BY seq", (seq,)).fetchall()
+        return [{"seq": row[0], "file_name": row[1], "timestamp": row[2], "text": row[3]} for row in rows]
+
+    def page(self, cursor: Optional[str] = None, limit: int = 100) -> Tuple[List[dict], Optional[str]]:
+        """
+        タイムスタンプ順に limit 件ずつ発話を返す
+
+        :param cursor: str | None  前のページの next_cursor. None なら先頭から
+        :param limit: int
+        :return: (List[dict], str | None)  発話のリストと次のページの cursor. 最後のページなら None
+        """
+        query = "SELECT id, file_name, timestamp, text, spans, words FROM segments "
+        params: tuple = ()
+        if cursor is not None:
+            timestamp, row_id = decode_cursor(cursor)
+            query += "WHERE (timestamp, id) > (?, ?) "
+            params = (timestamp, row_id)
+        query += "ORDER BY timestamp, id LIMIT ?"
+        with self._lock:
+            rows = self._conn.execute(query, params + (limit + 1,)).fetchall()
+        items = [{"file_name": row[1], "timestamp": row[2], "text": row[3], "spans": json.loads(row[4]),
+                  "words": json.loads(row[5]) if row[5] else None} for row in rows[:limit]]
+        next_cursor = encode_cursor(rows[limit - 1][2], rows[limit - 1][0]) if len(rows) > limit else None
+        return items, next_cursor
+
+    def detail(self, file_name: str) -> Optional[dict]:
+        """
+        発話の whisper の結果をすべて返す
+
+        :param file_name: str
+        :return: dict | None
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT s.text, s.timestamp, d.data FROM segments s JOIN details d ON s.id = d.id "
+                                     "WHERE s.segment = ?", (file_name.rsplit('.', 1)[0],)).fetchone()
+        if row is None:
+            return None
+        result = json.loads(zlib.decompress(row[2]))
+        result.update({"text": row[0], "timestamp": row[1]})
+        return result
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM segments").fetchone()[0]
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,137 @@
+import logging
+import time
+from typing import List
+
+import numpy as np
+
+from src.transcribe.audio import CHUNK_LENGTH, SAMPLE_RATE
+from src.transcribe.transcribe import Transcriber
+
+# 直前の確定テキストのうちプロンプトとして渡す最大文字数
+MAX_PROMPT_CHARS = 200
+
+
+class StreamingSession:
+    """
+    WebSocket で受け取った連続した PCM ストリームを逐次書きおこすセッション
+
+    step_seconds ごとに未確定の音声全体をデコードして途中結果 (partial) を返す.
+    未確定の音声が window_seconds を超えたら最後のセグメント以外を確定 (final) し, 書きおこし結果として保存する.
+    デコード時には直前に確定したテキストをプロンプトとして渡す.
+    """
+
+    def __init__(
+            self,
+            transcriber: Transcriber,
+            target_dir: str,
+            step_seconds: float = 1.0,
+            window_seconds: float = 10.0,
+            archive: bool = True,
+    ) -> None:
+        """
+        :param transcriber: Transcriber  モデルを読み込み済みのもの
+        :param target_dir: str  確定した書きおこし結果を保存するディレクトリ
+        :param step_seconds: float  途中結果を更新する間隔 (音声の秒数)
+        :param window_seconds: float  確定させるまでに溜める音声の秒数
+        :param archive: bool  確定した音声を data_path/target_dir のアーカイブに保存するか
+        """
+        self.transcriber = transcriber
+        self.target_dir = target_dir
+        self.step_samples = int(step_seconds * SAMPLE_RATE)
+        self.window_samples = int(min(window_seconds, CHUNK_LENGTH) * SAMPLE_RATE)
+        self.archive = archive
+
+        self.buffer = np.zeros(0, dtype=np.float32)
+        # 前回の feed の末尾の, 1 サンプル (4 バイト) に満たないバイト列
+        self.pending = b""
+        self.undecoded_samples = 0
+        self.prompt = ""
+
+        self.logger = logging.getLogger('StreamingSession')
+        self.logger.addHandler(logging.StreamHandler())
+
+    def feed(self, data: bytes) -> None:
+        """
+        16 kHz モノラル float32 (little endian) の PCM を追加する
+
+        フレームの区切りはサンプルの区切りと揃っていなくてもよい. 末尾の端数のバイトは次の feed の先頭に繋げる.
+
+        :param data: bytes
+        :return: None
+        """
+        if self.pending:
+            data = self.pending + data
+        usable = len(data) - len(data) % 4
+        self.pending = bytes(data[usable:])
+        samples = np.frombuffer(data, dtype="<f4", count=usable // 4)
+        self.buffer = np.concatenate([self.buffer, samples])
+        self.undecoded_samples += len(samples)
+
+    def ready(self) -> bool:
+        """
+        前回のデコードから step_seconds 以上の音声が溜まっているかを返す
+
+        :return: bool
+        """
+        return self.undecoded_samples >= self.step_samples
+
+    def process(self) -> List[dict]:
+        """
+        未確定の音声をデコードし, 途中結果と確定結果のイベントを返す
+
+        :return: List[dict]  {"type": "partial" | "final", "text": str, ...} のリスト
+        """
+        if len(self.buffer) == 0:
+            return []
+        self.undecoded_samples = 0
+        result = self._decode(self.buffer)
+        segments = result["segments"]
+
+        events = []
+        if len(self.buffer) >= self.window_samples:
+            if len(segments) >= 2:
+                # 最後のセグメントは途中で切れている可能性があるので次のウィンドウに回す
+                cut = int(segments[-1]["start"] * SAMPLE_RATE)
+                events.append(self._finalize(result, segments[:-1], cut))
+                segments = segments[-1:]
+            else:
+                events.append(self._finalize(result, segments, len(self.buffer)))
+                segments = []
+        events.append({"type": "partial", "text": "".join(segment["text"] for segment in segments)})
+        return events
+
+    def flush(self) -> List[dict]:
+        """
+        残っている音声をすべて確定させる
+
+        :return: List[dict]  確定結果のイベントのリスト
+        """
+        if len(self.buffer) == 0:
+            return []
+        result = self._decode(self.buffer)
+        return [self._finalize(result, result["segments"], len(self.buffer))]
+
+    def _decode(self, audio: np.ndarray) -> dict:
+        return self.transcriber.transcribe("stream", target_dir=self.target_dir, audio=audio,
+                                           initial_prompt=self.prompt[-MAX_PROMPT_CHARS:] or None)
+
+    def _finalize(self, result: dict, segments: List[dict], cut: int) -> dict:
+        # buffer[:cut] を確定させ, 書きおこし結果として保存する
+        audio = self.buffer[:cut]
+        self.buffer = self.buffer[cut:]
+        text = "".join(segment["text"] for segment in segments)
+        if not text.strip():
+            return {"type": "final", "text": ""}
+
+        file_name = f"stream{int(time.time() * 1000)}.wav"
+        result_dict = {
+            "text": text,
+            "segments": segments,
+            "language": result.get("language"),
+            "timestamp": result["timestamp"],
+        }
+        self.transcriber.write_result(file_name, self.target_dir, result_dict)
+        if self.archive:
+            self.transcriber.archive(self.target_dir).append(file_name, audio=audio)
+        self.prompt += text
+        return {"type": "final", "text": text, "file_name": file_name, "timestamp": result["timestamp"]}
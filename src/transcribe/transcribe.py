@@ -1,14 +1,32 @@
+import bisect
 import json
 import logging
 import os
+import shutil
+import threading
 from datetime import datetime
-from typing import List
+from typing import List, Optional
 
-import whisper
-from tqdm import tqdm
+import numpy as np
+
+from src.index.index import TextIndex
+from src.metrics.metrics import AUDIO_SECONDS, INFERENCE_SECONDS, stage
+from src.transcribe.archive import ARCHIVE_FILE_NAME, SegmentArchive
+from src.transcribe.audio import N_SAMPLES, SAMPLE_RATE, load_audio_file
+from src.transcribe.backends import get_backend_class
+from src.transcribe.store import STORE_FILE_NAME, TranscriptStore
 
 logging.basicConfig(filename='transcriber.log', level=logging.INFO)
 
+MODEL_NAMES = ["tiny", "base", "small", "medium", "large", "large-v2"]
+
+# save_path/target_dir に置く, 統合した書きおこし結果 (Reviser の入力)
+INTEGRATED_FILE_NAME = "integrated.json"
+# store に移した, 発話ごとの JSON で保存されていた書きおこし結果を置くディレクトリ
+LEGACY_DIR_NAME = "legacy"
+# store 導入前に発話ごとの JSON と一緒に書いていた, 追記専用の一覧
+LEGACY_MANIFEST_FILE_NAME = "manifest.jsonl"
+
 
 class Transcriber:
     """
@@ -20,12 +38,15 @@ class Transcriber:
             data_path: str,
             save_path: str,
             target_dir: str,
-            config=None
+            config=None,
+            index: Optional[TextIndex] = None
     ) -> None:
         """
         :param data_path: str
         :param save_path: str
-        :param config: dict
+        :param config: dict  {"backend": "whisper" | "faster-whisper", "model_name": str, "device": str, ...}
+        バックエンドごとの設定は src/transcribe/backends.py を参照
+        :param index: TextIndex | None  書きおこし結果を登録する全文検索インデックス
         """
         if config is None:
             config = {"model_name": "small", "device": "cuda:0"}
@@ -34,19 +55,96 @@ class Transcriber:
         self.target_dir = target_dir
         self.model = None
         self.config = config
+        self.backend_class = get_backend_class(config)
+        self.index = index
+        # whisper のモデルはスレッドセーフではないため推論は排他的に行う
+        self.model_lock = threading.Lock()
+        # 統合結果のキャッシュを守る
+        self.integration_lock = threading.Lock()
+        # target_dir -> 統合済みの書きおこし結果の状態
+        self.integrated = {}
+        # target_dir -> 音声のアーカイブ, 書きおこし結果の store
+        self.archives = {}
+        self.stores = {}
+        self.archives_lock = threading.Lock()
 
         self.logger = logging.getLogger('Transcriber')
         self.logger.addHandler(logging.StreamHandler())
 
     def get_file_name_list(self) -> List[str]:
         """
-        data_path/target_dir にあるファイル名のリストを返す
+        data_path/target_dir に保存されている音声のファイル名のリストを返す
 
-        :return: List[str]
+        :return: List[str]  アーカイブの発話と, アーカイブ導入前に保存された音声ファイル
         """
-        file_list = os.listdir(os.path.join(self.data_path, self.target_dir))
+        file_list = self.archive().list_names()
+        record_dir = os.path.join(self.data_path, self.target_dir)
+        if os.path.exists(record_dir):
+            file_list += [file_name for file_name in os.listdir(record_dir)
+                          if file_name != ARCHIVE_FILE_NAME and file_name not in file_list]
         return file_list
 
+    def archive(self, target_dir: Optional[str] = None) -> SegmentArchive:
+        """
+        target_dir の音声のアーカイブを返す
+
+        :param target_dir: str | None  指定しない場合は self.target_dir
+        :return: SegmentArchive
+        """
+        if target_dir is None:
+            target_dir = self.target_dir
+        with self.archives_lock:
+            if target_dir not in self.archives:
+                self.archives[target_dir] = SegmentArchive(
+                    os.path.join(self.data_path, target_dir, ARCHIVE_FILE_NAME))
+            return self.archives[target_dir]
+
+    def close_archive(self, target_dir: Optional[str] = None) -> None:
+        """
+        target_dir の音声のアーカイブを閉じる. 次に archive を呼んだときに開き直す
+
+        :param target_dir: str | None  指定しない場合は self.target_dir
+        :return: None
+        """
+        if target_dir is None:
+            target_dir = self.target_dir
+        with self.archives_lock:
+            archive = self.archives.pop(target_dir, None)
+        if archive is not None:
+            archive.close()
+
+    def load_audio(self, file_name: str, target_dir: str) -> np.ndarray:
+        """
+        保存されている音声を読み込む. アーカイブに無い場合は data_path/target_dir のファイルから読む
+
+        :param file_name: str
+        :param target_dir: str
+        :return: np.ndarray
+        """
+        archive = self.archive(target_dir)
+        if file_name in archive:
+            return archive.read(file_name)
+        return load_audio_file(os.path.join(self.data_path, target_dir, file_name))
+
+    def delete_audio(self, target_dir: Optional[str] = None) -> None:
+        """
+        target_dir に保存されている音声をすべて削除する
+
+        :param target_dir: str | None  指定しない場合は self.target_dir
+        :return: None
+        """
+        if target_dir is None:
+            target_dir = self.target_dir
+        with self.archives_lock:
+            archive = self.archives.pop(target_dir, None)
+        if archive is None:
+            archive = SegmentArchive(os.path.join(self.data_path, target_dir, ARCHIVE_FILE_NAME))
+        archive.delete()
+        record_dir = os.path.join(self.data_path, target_dir)
+        if os.path.exists(record_dir):
+            for file_name in os.listdir(record_dir):
+                os.remove(os.path.join(record_dir, file_name))
+
     def make_model(self) -> None:
         """
         model を定義する
@@ -54,29 +152,82 @@ class Transcriber:
         :return: None | raise error
         モデルの定義に失敗した場合はエラーを返す.
         """
-        if self.config["model_name"] in ["small", "medium", "large", "large-v2"]:
-            self.model = whisper.load_model(self.config["model_name"], device=self.config["device"])
+        if self.config["model_name"] in MODEL_NAMES:
+            # バックエンドのライブラリの import は重いので, モデルを読み込むときまで遅らせる
+            backend = self.backend_class(self.config)
+            backend.load()
+            self.model = backend
         else:
             self.logger.error("ModelNotFound")
             raise NameError("ModelNotFound")
 
-    def transcribe(self, file_name: str) -> dict:
+    def transcribe(self, file_name: str, target_dir: Optional[str] = None,
+                   audio: Optional[np.ndarray] = None, initial_prompt: Optional[str] = None) -> dict:
         """
         単一音声ファイルの書きおこしを行う
 
         :param file_name: str
+        :param target_dir: str | None  指定しない場合は self.target_dir
+        :param audio: np.ndarray | None  デコード済みの音声. 指定しない場合は data_path/target_dir から読み込む
+        :param initial_prompt: str | None  直前の書きおこし結果などデコーダに与える文脈
         :return: dict | None
         書きおこし結果の文字列を返す. モデルの定義に失敗した場合はエラーを返す.
         """
+        if target_dir is None:
+            target_dir = self.target_dir
         if self.model is not None:
             self.logger.info("Transcribing: " + file_name)
-            result = self.model.transcribe(os.path.join(self.data_path, self.target_dir, file_name))
+            if audio is None:
+                audio = self.load_audio(file_name, target_dir)
+            with self.model_lock, INFERENCE_SECONDS.time(backend=self.model.name, mode="single"):
+                result = self.model.transcribe(audio, initial_prompt=initial_prompt)
+            AUDIO_SECONDS.inc(len(audio) / SAMPLE_RATE)
             result["timestamp"] = datetime.now().isoformat()
             return result
         else:
             self.logger.error("ModelNotFound")
             raise NameError("ModelNotFound")
 
+    def transcribe_batch(self, file_names: List[str], target_dirs: List[str],
+                         audios: Optional[List[Optional[np.ndarray]]] = None) -> List[dict]:
+        """
+        複数の音声ファイルをまとめて書きおこす
+
+        30 秒以内の音声はバックエンドの transcribe_batch でまとめて推論する.
+        30 秒を超える音声や, バックエンドがバッチで処理できなかった音声は transcribe で個別に処理する.
+
+        :param file_names: List[str]
+        :param target_dirs: List[str]  file_names と同じ長さのディレクトリ名のリスト
+        :param audios: List[np.ndarray | None] | None  デコード済みの音声. None の要素はファイルから読み込む
+        :return: List[dict]  file_names と同じ順の書きおこし結果
+        """
+        if self.model is None:
+            self.logger.error("ModelNotFound")
+            raise NameError("ModelNotFound")
+        self.logger.info("Transcribing batch of " + str(len(file_names)) + " files")
+
+        if audios is None:
+            audios = [None] * len(file_names)
+        audios = [audio if audio is not None
+                  else self.load_audio(file_name, target_dir)
+                  for file_name, target_dir, audio in zip(file_names, target_dirs, audios)]
+        results: List[Optional[dict]] = [None] * len(file_names)
+        batch_indices = [i for i, audio in enumerate(audios) if len(audio) <= N_SAMPLES]
+
+        if batch_indices:
+            with self.model_lock, INFERENCE_SECONDS.time(backend=self.model.name, mode="batch"):
+                decoded = self.model.transcribe_batch([audios[i] for i in batch_indices])
+            for i, result in zip(batch_indices, decoded):
+                if result is not None:
+                    AUDIO_SECONDS.inc(len(audios[i]) / SAMPLE_RATE)
+                    result["timestamp"] = datetime.now().isoformat()
+                    results[i] = result
+
+        for i, result in enumerate(results):
+            if result is None:
+                results[i] = self.transcribe(file_names[i], target_dir=target_dirs[i], audio=audios[i])
+        return results
+
     def transcribe_all(self) -> None:
         """
         data_path/target_dir にある音声ファイルの書きおこしを行う
@@ -87,42 +238,187 @@ class Transcriber:
         for file_name in self.get_file_name_list():
             self.save_text(file_name)
 
-    def save_text(self, file_name: str) -> str:
+    def save_text(self, file_name: str, target_dir: Optional[str] = None,
+                  audio: Optional[np.ndarray] = None) -> str:
         """
         data_path/target_dir にある音声ファイルの書きおこし結果を保存する
 
         :param file_name: str
+        :param target_dir: str | None  指定しない場合は self.target_dir
+        :param audio: np.ndarray | None  デコード済みの音声. 指定しない場合はファイルから読み込む
         :return: str
         """
-        self.logger.info("Saving text of " + self.target_dir + "/" + file_name)
-        record_dir = os.path.join(self.data_path, self.target_dir)
-        transcribe_dir = os.path.join(self.save_path, self.target_dir)
-        if not os.path.exists(transcribe_dir):
-            os.mkdir(transcribe_dir)
-        result_dict = self.transcribe(file_name)
-        with open(os.path.join(transcribe_dir, file_name.rsplit('.', 1)[0] + ".json"), "w") as f:
-            json.dump(result_dict, f, ensure_ascii=False)
+        if target_dir is None:
+            target_dir = self.target_dir
+        self.logger.info("Saving text of " + target_dir + "/" + file_name)
+        result_dict = self.transcribe(file_name, target_dir=target_dir, audio=audio)
+        return self.write_result(file_name, target_dir, result_dict)
+
+    def save_text_batch(self, file_names: List[str], target_dirs: List[str],
+                        audios: Optional[List[Optional[np.ndarray]]] = None) -> List[str]:
+        """
+        複数の音声ファイルをまとめて書きおこし, 結果をそれぞれ保存する
+
+        :param file_names: List[str]
+        :param target_dirs: List[str]  file_names と同じ長さのディレクトリ名のリスト
+        :param audios: List[np.ndarray | None] | None  デコード済みの音声
+        :return: List[str]  file_names と同じ順の書きおこし結果の文字列
+        """
+        result_dicts = self.transcribe_batch(file_names, target_dirs, audios=audios)
+        return [self.write_result(file_name, target_dir, result_dict)
+                for file_name, target_dir, result_dict in zip(file_names, target_dirs, result_dicts)]
+
+    def write_result(self, file_name: str, target_dir: str, result_dict: dict) -> str:
+        """
+        書きおこし結果を save_path/target_dir の store に保存する
+
+        :param file_name: str
+        :param target_dir: str
+        :param result_dict: dict
+        :return: str  書きおこし結果の文字列
+        """
         text = result_dict["text"]
+        self.store(target_dir).add(file_name, result_dict)
+        if self.index is not None:
+            self.index.add("transcript", target_dir, file_name, result_dict["timestamp"], text)
 
         return text
 
+    def store(self, target_dir: Optional[str] = None, create: bool = True) -> Optional[TranscriptStore]:
+        """
+        target_dir の書きおこし結果の store を返す
+
+        :param target_dir: str | None  指定しない場合は self.target_dir
+        :param create: bool  False の場合, 書きおこし結果のディレクトリが無ければ store を作らずに None を返す
+        :return: TranscriptStore | None
+        """
+        if target_dir is None:
+            target_dir = self.target_dir
+        with self.archives_lock:
+            if target_dir not in self.stores:
+                transcribe_dir = os.path.join(self.save_path, target_dir)
+                if not create and not os.path.isdir(transcribe_dir):
+                    return None
+                store = TranscriptStore(os.path.join(transcribe_dir, STORE_FILE_NAME))
+                try:
+                    self._migrate_legacy(transcribe_dir, store)
+                except Exception:
+                    store.close()
+                    raise
+                self.stores[target_dir] = store
+            return self.stores[target_dir]
+
+    def delete_transcripts(self, target_dir: Optional[str] = None) -> None:
+        """
+        target_dir の書きおこし結果をすべて削除する
+
+        Transcriber が書くファイル (store, 統合結果, store に移す前と移した後の発話ごとの JSON) だけを削除する.
+
+        :param target_dir: str | None  指定しない場合は self.target_dir
+        :return: None
+        """
+        if target_dir is None:
+            target_dir = self.target_dir
+        with self.archives_lock:
+            store = self.stores.pop(target_dir, None)
+            if store is not None:
+                store.close()
+        self.reset_integration(target_dir)
+        transcribe_dir = os.path.join(self.save_path, target_dir)
+        if not os.path.isdir(transcribe_dir):
+            return
+        for file_name in os.listdir(transcribe_dir):
+            path = os.path.join(transcribe_dir, file_name)
+            if file_name == LEGACY_DIR_NAME and os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.isfile(path) and self._is_transcript_file(file_name):
+                os.remove(path)
+
+    def reset_integration(self, target_dir: Optional[str] = None) -> None:
+        """
+        target_dir の統合結果のキャッシュを破棄する. 書きおこし結果を削除したときに呼ぶ
+
+        :param target_dir: str | None  指定しない場合は self.target_dir
+        :return: None
+        """
+        if target_dir is None:
+            target_dir = self.target_dir
+        with self.integration_lock:
+            self.integrated.pop(target_dir, None)
+
     def integrate_texts(self) -> None:
         """
-        data_path/target_dir にある音声ファイルの書きおこし結果を統合する
+        save_path/target_dir にある書きおこし結果を統合して integrated.json に保存する
+
+        store のうち前回の統合以降に追加・更新された発話だけを読み, タイムスタンプ順のリストに挿入する.
 
         :return: None
         """
         self.logger.info("Integrating texts in " + self.target_dir)
-        if not os.path.exists(os.path.join(self.save_path, self.target_dir)):
-            os.mkdir(os.path.join(self.save_path, self.target_dir))
-        text = []
-        for file_name in tqdm(self.get_file_name_list()):
-            with open(os.path.join(self.save_path, self.target_dir, file_name.rsplit('.', 1)[0] + ".json"), "r") as f:
-                data = json.load(f)
-                text.append({"timestamp": data["timestamp"], "text": data["text"]})
-        text.sort(key=lambda x: x["timestamp"])
-        with open(os.path.join(self.save_path, self.target_dir, "integrated.json"), "w") as f:
-            json.dump(text, f, ensure_ascii=False)
+        with stage("integrate_texts"):
+            self._integrate_texts()
+
+    def _integrate_texts(self) -> None:
+        integrated_path = os.path.join(self.save_path, self.target_dir, INTEGRATED_FILE_NAME)
+        store = self.store()
+
+        with self.integration_lock:
+            state = self.integrated.get(self.target_dir)
+            if state is None or state["store"] is not store:
+                # store が作り直されている場合は最初から読む
+                state = {"store": store, "seq": 0, "keys": [], "entries": [], "file_names": {}}
+                self.integrated[self.target_dir] = state
+
+            changes = store.changes_since(state["seq"])
+            if not changes and os.path.exists(integrated_path):
+                return
+            for entry in changes:
+                state["seq"] = entry["seq"]
+                self._insert_entry(state, entry)
+
+            with open(integrated_path, "w") as f:
+                json.dump(state["entries"], f, ensure_ascii=False)
+
+    @staticmethod
+    def _insert_entry(state: dict, entry: dict) -> None:
+        # 同じファイルが書きおこし直された場合は古い結果を置き換える
+        name = entry["file_name"].rsplit('.', 1)[0]
+        key = (entry["timestamp"], name)
+        old_key = state["file_names"].get(name)
+        if old_key is not None:
+            index = bisect.bisect_left(state["keys"], old_key)
+            del state["keys"][index]
+            del state["entries"][index]
+        index = bisect.bisect_right(state["keys"], key)
+        state["keys"].insert(index, key)
+        state["entries"].insert(index, {"timestamp": entry["timestamp"], "text": entry["text"]})
+        state["file_names"][name] = key
+
+    @staticmethod
+    def _is_transcript_file(file_name: str) -> bool:
+        # store (sqlite の -wal, -shm も含む), 統合結果, store 導入前の発話ごとの JSON と manifest
+        return (file_name == STORE_FILE_NAME or file_name.startswith(STORE_FILE_NAME + "-")
+                or file_name.endswith(".json") or file_name == LEGACY_MANIFEST_FILE_NAME)
+
+    @staticmethod
+    def _migrate_legacy(transcribe_dir: str, store: TranscriptStore) -> None:
+        # store 導入前に発話ごとの JSON で保存されたディレクトリを store に移す.
+        # すべて store から読めることを確かめてから元のファイルを legacy/ に移す. 途中で失敗した場合は次に開いたときにやり直す
+        file_names = [file_name for file_name in os.listdir(transcribe_dir)
+                      if file_name.endswith(".json") and file_name != INTEGRATED_FILE_NAME]
+        if not file_names:
+            return
+        for file_name in file_names:
+            with open(os.path.join(transcribe_dir, file_name), "r") as f:
+                store.add(file_name, json.load(f))
+        missing = [file_name for file_name in file_names if store.detail(file_name) is None]
+        if missing:
+            raise RuntimeError(f"Failed to migrate {len(missing)} transcripts in {transcribe_dir}")
+        legacy_dir = os.path.join(transcribe_dir, LEGACY_DIR_NAME)
+        os.makedirs(legacy_dir, exist_ok=True)
+        for file_name in file_names + [LEGACY_MANIFEST_FILE_NAME]:
+            if os.path.exists(os.path.join(transcribe_dir, file_name)):
+                os.replace(os.path.join(transcribe_dir, file_name), os.path.join(legacy_dir, file_name))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,28 @@
+import io
+import wave
+
+import numpy as np
+import pytest
+
+
+def make_wav(num_samples: int = 1600, sample_rate: int = 16000, value: int = 0) -> bytes:
+    """
+    すべてのサンプルが value の 16bit モノラル WAV を返す
+
+    :param num_samples: int
+    :param sample_rate: int
+    :param value: int  16bit のサンプル値. 0 なら無音
+    :return: bytes
+    """
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(np.full(num_samples, value, dtype="<i2").tobytes())
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def wav_bytes():
+    return make_wav
@@ -0,0 +1,119 @@
+import json
+import logging
+import os
+import sys
+
+import numpy as np
+import pytest
+
+from src.transcribe import archive as archive_module
+from src.transcribe.archive import RECORD_MAGIC, RECORD_PREFIX, SegmentArchive, get_codec
+
+
+@pytest.fixture(autouse=True)
+def pcm16(monkeypatch):
+    # soundfile の有無によらず同じ形式で保存する
+    monkeypatch.setattr(archive_module, "get_codec", lambda: "pcm16")
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "session" / "segments.archive")
+
+
+def tone(samples: int, value: float = 0.5) -> np.ndarray:
+    return np.full(samples, value, dtype=np.float32)
+
+
+def torn_record(name: str) -> bytes:
+    body = json.dumps({"name": name, "codec": "pcm16"}).encode("utf-8")
+    payload = b"\0\0" * 100
+    return (RECORD_PREFIX.pack(RECORD_MAGIC, len(body), len(payload)) + body + payload)[:40]
+
+
+def test_append_and_read(path):
+    archive = SegmentArchive(path)
+    archive.append("a.wav", audio=tone(1600, 0.5))
+    archive.append("b.wav", audio=tone(800, -0.25))
+    assert archive.list_names() == ["a.wav", "b.wav"]
+    assert "a.wav" in archive and "c.wav" not in archive
+    np.testing.assert_allclose(archive.read("a.wav"), tone(1600, 0.5), atol=1e-4)
+    np.testing.assert_allclose(archive.read("b.wav"), tone(800, -0.25), atol=1e-4)
+    with pytest.raises(KeyError):
+        archive.read("c.wav")
+
+
+def test_append_raw_file(path, wav_bytes):
+    archive = SegmentArchive(path)
+    archive.append("a.wav", data=wav_bytes(160, value=1000))
+    np.testing.assert_allclose(archive.read("a.wav"), np.full(160, 1000 / 32768, dtype=np.float32))
+
+
+def test_reappended_name_reads_latest(path):
+    archive = SegmentArchive(path)
+    archive.append("a.wav", audio=tone(10, 0.1))
+    archive.append("a.wav", audio=tone(20, 0.2))
+    assert archive.list_names() == ["a.wav"]
+    assert len(archive.read("a.wav")) == 20
+
+
+def test_scan_picks_up_other_instances(path):
+    writer = SegmentArchive(path)
+    reader = SegmentArchive(path)
+    writer.append("a.wav", audio=tone(10))
+    assert "a.wav" in reader
+    assert len(reader.read("a.wav")) == 10
+    assert SegmentArchive(path).list_names() == ["a.wav"]
+
+
+def test_open_truncates_torn_tail(path):
+    SegmentArchive(path).append("a.wav", audio=tone(10))
+    size = os.path.getsize(path)
+    with open(path, "ab") as f:
+        f.write(torn_record("b.wav"))
+    archive = SegmentArchive(path)
+    assert archive.list_names() == ["a.wav"]
+    assert os.path.getsize(path) == size
+
+
+def test_append_after_torn_tail(path):
+    archive = SegmentArchive(path)
+    archive.append("a.wav", audio=tone(10))
+    with open(path, "ab") as f:
+        f.write(torn_record("b.wav"))
+    archive.append("c.wav", audio=tone(10))
+    assert SegmentArchive(path).list_names() == ["a.wav", "c.wav"]
+
+
+def test_corrupted_archive(path):
+    SegmentArchive(path).append("a.wav", audio=tone(10))
+    with open(path, "ab") as f:
+        f.write(b"XXXX" + b"\0" * RECORD_PREFIX.size)
+    with pytest.raises(ValueError):
+        SegmentArchive(path)
+
+
+def test_delete(path):
+    archive = SegmentArchive(path)
+    archive.append("a.wav", audio=tone(10))
+    other = SegmentArchive(path)
+    archive.delete()
+    assert not os.path.exists(path)
+    assert archive.list_names() == []
+    assert other.list_names() == []
+
+
+def test_codec_falls_back_with_warning(monkeypatch, caplog):
+    # import soundfile を ImportError にする
+    monkeypatch.setitem(sys.modules, "soundfile", None)
+    with caplog.at_level(logging.WARNING):
+        assert get_codec.__wrapped__() == "pcm16"
+    assert "soundfile is not available" in caplog.text
+
+
+def test_close_and_read_again(path):
+    archive = SegmentArchive(path)
+    archive.append("a.wav", audio=tone(10))
+    archive.read("a.wav")
+    archive.close()
+    assert len(archive.read("a.wav")) == 10
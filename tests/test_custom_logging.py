@@ -0,0 +1,67 @@
+import json
+import logging
+
+import pytest
+
+from src.custom_logging import CustomHandler, JsonFormatter
+
+
+def record(message: str, **extra) -> logging.LogRecord:
+    log_record = logging.LogRecord("test", logging.INFO, __file__, 0, message, (), None)
+    log_record.__dict__.update(extra)
+    return log_record
+
+
+def read_lines(path) -> list:
+    return path.read_text(encoding="utf-8").splitlines() if path.exists() else []
+
+
+@pytest.fixture
+def log_path(tmp_path):
+    return tmp_path / "api.log"
+
+
+def test_rotates_after_max_lines(log_path):
+    handler = CustomHandler(str(log_path), max_lines=3)
+    for i in range(7):
+        handler.emit(record(f"line {i}"))
+    handler.close()
+    assert read_lines(log_path) == ["line 6"]
+    assert read_lines(log_path.with_name("api.log.1")) == ["line 3", "line 4", "line 5"]
+
+
+def test_counts_existing_lines(log_path):
+    log_path.write_text("a\nb\n", encoding="utf-8")
+    handler = CustomHandler(str(log_path), max_lines=3)
+    assert handler.line_count == 2
+    handler.emit(record("c"))
+    handler.emit(record("d"))
+    handler.close()
+    assert read_lines(log_path) == ["d"]
+    assert read_lines(log_path.with_name("api.log.1")) == ["a", "b", "c"]
+
+
+def test_multiline_record_counts_all_lines(log_path):
+    handler = CustomHandler(str(log_path), max_lines=3)
+    handler.emit(record("a\nb\nc"))
+    handler.emit(record("d"))
+    handler.close()
+    assert read_lines(log_path) == ["d"]
+
+
+def test_handlers_sharing_a_file_keep_latest_lines(log_path):
+    # 同じファイルに書き込む別のプロセスのハンドラーの代わり
+    handlers = [CustomHandler(str(log_path), max_lines=10) for _ in range(2)]
+    for i in range(95):
+        handlers[i % 2].emit(record(f"line {i}"))
+    for handler in handlers:
+        handler.close()
+    assert read_lines(log_path) == [f"line {i}" for i in range(90, 95)]
+    assert read_lines(log_path.with_name("api.log.1")) == [f"line {i}" for i in range(80, 90)]
+
+
+def test_json_formatter_includes_extra():
+    entry = json.loads(JsonFormatter().format(record("hello", request_id="abc")))
+    assert entry["message"] == "hello"
+    assert entry["level"] == "INFO"
+    assert entry["request_id"] == "abc"
@@ -0,0 +1,57 @@
+import math
+
+import pytest
+
+from src.search.df_index import DocumentFrequencyIndex
+
+
+@pytest.fixture
+def index(tmp_path):
+    return DocumentFrequencyIndex(str(tmp_path / "df_index.sqlite3"))
+
+
+def smooth_idf(num_docs: int, df: int) -> float:
+    return math.log((1 + num_docs) / (1 + df)) + 1
+
+
+def test_idf_counts_sessions(index):
+    index.update("a", ["meeting", "budget"])
+    index.update("b", ["meeting"])
+    idf = index.idf(["meeting", "budget", "unknown"])
+    assert index.num_docs() == 2
+    assert idf["meeting"] == pytest.approx(smooth_idf(2, 2))
+    assert idf["budget"] == pytest.approx(smooth_idf(2, 1))
+    assert idf["unknown"] == pytest.approx(smooth_idf(2, 0))
+
+
+def test_update_replaces_session_terms(index):
+    index.update("a", ["meeting", "budget"])
+    index.update("b", ["budget"])
+    index.update("a", ["meeting", "schedule"])
+    idf = index.idf(["meeting", "budget", "schedule"])
+    assert index.num_docs() == 2
+    assert idf["budget"] == pytest.approx(smooth_idf(2, 1))
+    assert idf["schedule"] == pytest.approx(smooth_idf(2, 1))
+
+
+def test_update_is_idempotent(index):
+    index.update("a", ["meeting", "meeting"])
+    index.update("a", ["meeting"])
+    assert index.num_docs() == 1
+    assert index.idf(["meeting"])["meeting"] == pytest.approx(smooth_idf(1, 1))
+
+
+def test_persists_across_instances(tmp_path):
+    path = str(tmp_path / "df_index.sqlite3")
+    DocumentFrequencyIndex(path).update("a", ["meeting"])
+    reopened = DocumentFrequencyIndex(path)
+    assert reopened.num_docs() == 1
+    assert reopened.idf(["meeting"])["meeting"] == pytest.approx(smooth_idf(1, 1))
+
+
+def test_idf_many_terms(index):
+    terms = [f"term{i}" for i in range(1200)]
+    index.update("a", terms)
+    idf = index.idf(terms)
+    assert len(idf) == 1200
+    assert list(idf.values()) == pytest.approx([smooth_idf(1, 1)] * 1200)
@@ -0,0 +1,106 @@
+import sqlite3
+
+import pytest
+
+from src.index import index as index_module
+from src.index.index import PHRASE_BONUS, TextIndex, bigrams, normalize
+
+
+@pytest.fixture
+def index(tmp_path):
+    return TextIndex(str(tmp_path / "index.sqlite3"))
+
+
+def segments(hits):
+    return [hit["segment"] for hit in hits]
+
+
+def test_bigrams():
+    assert bigrams("会議室") == {"会議": 1, "議室": 1}
+    assert bigrams("会 議") == {"会議": 1}
+    assert bigrams("会") == {"会": 1}
+    assert bigrams("") == {}
+
+
+def test_normalize():
+    assert normalize("ＡＢＣ１２３") == "abc123"
+
+
+def test_search_requires_all_bigrams(index):
+    index.add("transcript", "s1", "1", "t1", "来週の会議で予算を確認します")
+    index.add("transcript", "s1", "2", "t2", "会議室を予約しました")
+    index.add("transcript", "s2", "3", "t3", "予算の話")
+    assert sorted(segments(index.search("会議"))) == ["1", "2"]
+    assert segments(index.search("予算を確認")) == ["1"]
+    assert index.search("会議の予算") == []
+    assert index.search("存在しない") == []
+
+
+def test_search_returns_location(index):
+    index.add("summary", "s1", "0", "2024-01-01T00:00:00", "予算の確認")
+    hit = index.search("予算")[0]
+    assert (hit["kind"], hit["session"], hit["segment"], hit["timestamp"]) == \
+           ("summary", "s1", "0", "2024-01-01T00:00:00")
+    assert hit["text"] == "予算の確認"
+
+
+def test_phrase_ranks_above_scattered_bigrams(index):
+    index.add("transcript", "s1", "scattered", None, "予算案と算定の確認")
+    index.add("transcript", "s1", "phrase", None, "予算定例")
+    hits = index.search("予算定")
+    assert segments(hits)[0] == "phrase"
+    assert hits[0]["score"] - hits[1]["score"] > PHRASE_BONUS / 2
+
+
+def test_search_normalizes_query(index):
+    index.add("transcript", "s1", "1", None, "ABC社との打ち合わせ")
+    assert segments(index.search("ａｂｃ社")) == ["1"]
+
+
+def test_one_character_query(index):
+    index.add("transcript", "s1", "1", None, "会議です")
+    index.add("transcript", "s1", "2", None, "す")
+    index.add("transcript", "s1", "3", None, "会議")
+    assert sorted(segments(index.search("す"))) == ["1", "2"]
+    assert sorted(segments(index.search("議"))) == ["1", "3"]
+
+
+def test_add_replaces_same_segment(index):
+    index.add("transcript", "s1", "1", None, "会議")
+    index.add("transcript", "s1", "1", None, "予算")
+    assert index.search("会議") == []
+    assert segments(index.search("予算")) == ["1"]
+
+
+def test_replace_and_delete(index):
+    index.replace("revised", "s1", [("0", None, "会議の内容"), ("1", None, "予算の内容")])
+    index.replace("revised", "s1", [("0", None, "予算の内容")])
+    assert index.search("会議") == []
+    index.add("summary", "s1", "0", None, "予算")
+    index.delete("s1", kind="revised")
+    assert [hit["kind"] for hit in index.search("予算")] == ["summary"]
+    index.delete("s1")
+    assert index.search("予算") == []
+
+
+def test_limit_and_candidates(index, monkeypatch):
+    for i in range(10):
+        index.add("transcript", "s1", str(i), None, "会議")
+    assert len(index.search("会議", limit=3)) == 3
+    monkeypatch.setattr(index_module, "MAX_CANDIDATES", 4)
+    # 候補が多すぎる場合は新しい文書から数える
+    assert sorted(segments(index.search("会議", limit=10))) == ["6", "7", "8", "9"]
+
+
+def test_rebuilds_old_format(tmp_path):
+    path = str(tmp_path / "index.sqlite3")
+    index = TextIndex(path)
+    index.add("transcript", "s1", "1", None, "会議です")
+    # 末尾の文字を持たない古い形式に戻す
+    index._conn.execute("DELETE FROM postings WHERE gram = ?", ("す" + index_module.TERMINATOR,))
+    index._conn.execute("PRAGMA user_version = 0")
+    index._conn.commit()
+    index._conn.close()
+    reopened = TextIndex(path)
+    assert segments(reopened.search("す")) == ["1"]
+    assert sqlite3.connect(path).execute("PRAGMA user_version").fetchone()[0] == index_module.INDEX_VERSION
@@ -0,0 +1,72 @@
+from src.transcribe.job_queue import TranscriptionQueue
+
+
+class FakeTranscriber:
+    target_dir = "session"
+
+    def __init__(self, fail_batch: bool = False, fail_files=()) -> None:
+        self.fail_batch = fail_batch
+        self.fail_files = set(fail_files)
+        self.calls = []
+        self.audios = []
+
+    def save_text(self, file_name, target_dir, audio):
+        self.calls.append([file_name])
+        self.audios.append(audio)
+        if file_name in self.fail_files:
+            raise RuntimeError("decode failed")
+        return file_name.upper()
+
+    def save_text_batch(self, file_names, target_dirs, audios):
+        self.calls.append(file_names)
+        self.audios.extend(audios)
+        if self.fail_batch:
+            raise RuntimeError("batch failed")
+        return [file_name.upper() for file_name in file_names]
+
+
+def run_jobs(transcriber, uploads, max_batch_size=8):
+    # ワーカーを起動する前に投入して, すべてのジョブを 1 つのバッチにまとめる
+    queue = TranscriptionQueue(transcriber, max_batch_size=max_batch_size, max_batch_wait=0.5)
+    jobs = [queue.submit(file_name, data=data) for file_name, data in uploads]
+    queue.start()
+    queue.stop()
+    return [job.to_dict() for job in jobs]
+
+
+def test_batch_success(wav_bytes):
+    transcriber = FakeTranscriber()
+    results = run_jobs(transcriber, [("a.wav", wav_bytes()), ("b.wav", wav_bytes())])
+    assert [result["text"] for result in results] == ["A.WAV", "B.WAV"]
+    assert transcriber.calls == [["a.wav", "b.wav"]]
+
+
+def test_batch_is_capped_at_max_batch_size(wav_bytes):
+    transcriber = FakeTranscriber()
+    results = run_jobs(transcriber, [("a.wav", wav_bytes()), ("b.wav", wav_bytes()), ("c.wav", wav_bytes())],
+                       max_batch_size=2)
+    assert [result["status"] for result in results] == ["done", "done", "done"]
+    assert transcriber.calls == [["a.wav", "b.wav"], ["c.wav"]]
+
+
+def test_uploads_are_decoded_in_memory(wav_bytes):
+    transcriber = FakeTranscriber()
+    run_jobs(transcriber, [("a.wav", wav_bytes(num_samples=3200)), ("b.wav", None)])
+    assert transcriber.audios[0].shape == (3200,)
+    assert transcriber.audios[1] is None
+
+
+def test_corrupt_upload_fails_only_its_job(wav_bytes):
+    transcriber = FakeTranscriber()
+    results = run_jobs(transcriber, [("a.wav", wav_bytes()), ("bad.wav", b"RIFF"), ("c.wav", wav_bytes())])
+    assert [result["status"] for result in results] == ["done", "failed", "done"]
+    assert transcriber.calls == [["a.wav", "c.wav"]]
+
+
+def test_failed_batch_is_retried_one_by_one(wav_bytes):
+    transcriber = FakeTranscriber(fail_batch=True, fail_files={"b.wav"})
+    results = run_jobs(transcriber, [("a.wav", wav_bytes()), ("b.wav", wav_bytes()), ("c.wav", wav_bytes())])
+    assert [result["status"] for result in results] == ["done", "failed", "done"]
+    assert results[1]["message"] == "decode failed"
+    assert [results[0]["text"], results[2]["text"]] == ["A.WAV", "C.WAV"]
+    assert transcriber.calls == [["a.wav", "b.wav", "c.wav"], ["a.wav"], ["b.wav"], ["c.wav"]]
@@ -0,0 +1,34 @@
+import pytest
+
+from src.llm.llm import LLMClient, OpenAIBackend, StubBackend
+
+
+class RecordingBackend(StubBackend):
+    def __init__(self) -> None:
+        super().__init__()
+        self.max_retries = []
+
+    def complete(self, prompt, model, temperature=0, max_retries=None):
+        self.max_retries.append(max_retries)
+        return super().complete(prompt, model, temperature=temperature)
+
+
+def test_client_passes_max_retries_to_backend():
+    backend = RecordingBackend()
+    client = LLMClient(backend)
+    client.complete("prompt", model="model", max_retries=0)
+    client.complete("prompt", model="model")
+    assert backend.max_retries == [0, None]
+
+
+def test_openai_backend_overrides_sdk_retries(monkeypatch):
+    pytest.importorskip("openai")
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    backend = OpenAIBackend(max_retries=3)
+    assert backend.get_client().max_retries == 3
+    assert backend.get_client(3) is backend.get_client()
+    without_retries = backend.get_client(0)
+    assert without_retries.max_retries == 0
+    assert backend.get_client(0) is without_retries
+    # コネクションプールは共有する
+    assert without_retries._client is backend.get_client()._client
@@ -0,0 +1,23 @@
+import pytest
+
+from src.metrics.metrics import Counter, Metric
+
+
+def test_metric_requires_samples():
+    class Incomplete(Metric):
+        type_name = "untyped"
+
+    with pytest.raises(TypeError):
+        Incomplete("incomplete", "missing samples")
+
+
+def test_counter_renders_samples():
+    counter = Counter("requests_total", "Requests", ["path"])
+    counter.inc(path="/a")
+    counter.inc(2, path="/b")
+    assert counter.render().splitlines() == [
+        "# HELP requests_total Requests",
+        "# TYPE requests_total counter",
+        'requests_total{path="/a"} 1',
+        'requests_total{path="/b"} 2',
+    ]
@@ -0,0 +1,113 @@
+import numpy as np
+import pytest
+
+from src.transcribe.audio import N_SAMPLES, SAMPLE_RATE
+from src.transcribe.packing import (
+    TIME_PRECISION,
+    PackedWindow,
+    pack_utterances,
+    parse_timestamp_tokens,
+    split_segments,
+    trimmed_length,
+)
+
+TIMESTAMP_BEGIN = 50364
+GAP = SAMPLE_RATE
+
+
+def ts(seconds: float) -> int:
+    return TIMESTAMP_BEGIN + round(seconds / TIME_PRECISION)
+
+
+def test_pack_utterances_fills_window_exactly():
+    half = (N_SAMPLES - GAP) // 2
+    windows = pack_utterances([half, half], GAP)
+    assert len(windows) == 1
+    assert windows[0].offsets == [0, half + GAP]
+    assert windows[0].length == N_SAMPLES
+
+
+def test_pack_utterances_starts_new_window_past_boundary():
+    half = (N_SAMPLES - GAP) // 2
+    windows = pack_utterances([half, half + 1, 10], GAP)
+    assert [window.indices for window in windows] == [[0], [1, 2]]
+    assert windows[1].offsets == [0, half + 1 + GAP]
+
+
+def test_pack_utterances_full_length_utterance_gets_own_window():
+    windows = pack_utterances([N_SAMPLES, 100, N_SAMPLES], GAP)
+    assert [window.indices for window in windows] == [[0], [1], [2]]
+
+
+def test_packed_window_build_and_bounds():
+    audios = [np.ones(2 * SAMPLE_RATE, dtype=np.float32), np.full(SAMPLE_RATE, 2, dtype=np.float32)]
+    window = pack_utterances([len(audio) for audio in audios], GAP)[0]
+    built = window.build(audios)
+    assert len(built) == 4 * SAMPLE_RATE
+    assert (built[:2 * SAMPLE_RATE] == 1).all()
+    assert (built[2 * SAMPLE_RATE:3 * SAMPLE_RATE] == 0).all()
+    assert (built[3 * SAMPLE_RATE:] == 2).all()
+    assert window.bounds() == [(-0.5, 2.5), (2.5, 4.5)]
+
+
+def test_parse_timestamp_pairs():
+    tokens = [ts(0.0), 1, 2, ts(1.0), ts(1.0), 3, ts(2.0), ts(2.5), 4, ts(3.0)]
+    assert parse_timestamp_tokens(tokens, TIMESTAMP_BEGIN) == [
+        (0.0, 1.0, [1, 2]),
+        (1.0, 2.0, [3]),
+        (2.5, 3.0, [4]),
+    ]
+
+
+def test_parse_timestamp_unclosed_final_segment():
+    tokens = [ts(0.0), 1, ts(1.0), ts(1.2), 2, 3]
+    segments = parse_timestamp_tokens(tokens, TIMESTAMP_BEGIN)
+    assert segments[0] == (0.0, 1.0, [1])
+    assert segments[1][0] == pytest.approx(1.2)
+    assert segments[1][1:] == (None, [2, 3])
+
+
+def test_parse_timestamp_without_leading_timestamp():
+    assert parse_timestamp_tokens([1, ts(1.0), ts(1.0)], TIMESTAMP_BEGIN) == [(0.0, 1.0, [1])]
+
+
+def two_utterance_window() -> PackedWindow:
+    # 2 秒の発話 2 つ. 窓の中では 0-2 秒と 3-5 秒
+    return pack_utterances([2 * SAMPLE_RATE, 2 * SAMPLE_RATE], GAP)[0]
+
+
+def test_split_segments_assigns_relative_times():
+    split = split_segments(two_utterance_window(), [(0.0, 1.0, [1]), (1.0, 2.0, [2]), (3.2, 5.0, [3])])
+    assert split[0] == [(0.0, 1.0, [1]), (1.0, 2.0, [2])]
+    assert split[1][0][0] == pytest.approx(0.2)
+    assert split[1][0][1:] == (2.0, [3])
+
+
+def test_split_segments_boundary_spanning_segment_falls_back():
+    split = split_segments(two_utterance_window(), [(0.0, 1.0, [1]), (1.5, 4.0, [2])])
+    assert split == [None, None]
+
+
+def test_split_segments_unclosed_segment_falls_back():
+    split = split_segments(two_utterance_window(), [(0.0, 2.0, [1]), (3.0, None, [2])])
+    assert split[0] == [(0.0, 2.0, [1])]
+    assert split[1] is None
+
+
+def test_split_segments_utterance_without_segment_falls_back():
+    split = split_segments(two_utterance_window(), [(0.0, 2.0, [1])])
+    assert split == [[(0.0, 2.0, [1])], None]
+
+
+def test_split_segments_short_segment_in_gap_goes_to_nearest():
+    split = split_segments(two_utterance_window(), [(0.0, 2.0, [1]), (2.6, 2.8, [2]), (3.0, 5.0, [3])])
+    assert split[0] == [(0.0, 2.0, [1])]
+    assert [tokens for _, _, tokens in split[1]] == [[2], [3]]
+
+
+def test_trimmed_length():
+    granularity = 5 * SAMPLE_RATE
+    assert trimmed_length(1, granularity) == granularity
+    assert trimmed_length(granularity, granularity) == granularity
+    assert trimmed_length(granularity + 1, granularity) == 2 * granularity
+    assert trimmed_length(N_SAMPLES + 1, granularity) == N_SAMPLES
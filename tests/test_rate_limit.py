@@ -0,0 +1,71 @@
+import pytest
+
+from src.llm import rate_limit
+from src.llm.rate_limit import TokenBucketLimiter
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 0.0
+        self.sleeps = []
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(rate_limit, "time", clock)
+    return clock
+
+
+def test_requests_burst_then_wait(clock):
+    limiter = TokenBucketLimiter(requests_per_minute=60)
+    for _ in range(60):
+        limiter.acquire()
+    assert clock.sleeps == []
+    limiter.acquire()
+    assert sum(clock.sleeps) == pytest.approx(1.0)
+
+
+def test_requests_refill_over_time(clock):
+    limiter = TokenBucketLimiter(requests_per_minute=6)
+    for _ in range(6):
+        limiter.acquire()
+    clock.now += 30
+    for _ in range(3):
+        limiter.acquire()
+    assert clock.sleeps == []
+
+
+def test_tokens_wait_for_deficit(clock):
+    limiter = TokenBucketLimiter(tokens_per_minute=600)
+    limiter.acquire(tokens=500)
+    limiter.acquire(tokens=200)
+    assert sum(clock.sleeps) == pytest.approx(10.0)
+
+
+def test_oversized_request_waits_for_full_bucket(clock):
+    limiter = TokenBucketLimiter(tokens_per_minute=600)
+    limiter.acquire(tokens=600)
+    limiter.acquire(tokens=10000)
+    assert sum(clock.sleeps) == pytest.approx(60.0)
+
+
+def test_both_limits_use_the_longer_wait(clock):
+    limiter = TokenBucketLimiter(requests_per_minute=60, tokens_per_minute=60)
+    limiter.acquire(tokens=60)
+    limiter.acquire(tokens=30)
+    assert sum(clock.sleeps) == pytest.approx(30.0)
+
+
+def test_unlimited_never_waits(clock):
+    limiter = TokenBucketLimiter()
+    for _ in range(1000):
+        limiter.acquire(tokens=10 ** 6)
+    assert clock.sleeps == []
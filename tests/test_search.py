@@ -0,0 +1,39 @@
+import threading
+
+import pytest
+
+from src.metrics.tracing import start_trace
+from src.search.search import KEYWORD_COUNT, TextAnalyzer
+
+
+@pytest.fixture
+def analyzer(tmp_path, monkeypatch):
+    monkeypatch.setenv("GOOGLE_API_KEY", "key")
+    monkeypatch.setenv("CUSTOM_SEARCH_ENGINE_ID", "cx")
+    analyzer = TextAnalyzer(str(tmp_path / "summarized"), str(tmp_path / "searched"), "session")
+    # spaCy を読み込まずに, 文書の単語をそのまま名詞句として扱う
+    analyzer.extract_nouns_cached = lambda texts, lang: [text.split() for text in texts]
+    return analyzer
+
+
+def test_prefetch_searches_keywords_concurrently(analyzer):
+    barrier = threading.Barrier(KEYWORD_COUNT)
+    searched = []
+
+    def get_search_results(keyword, number=3):
+        # すべてのキーワードの検索が同時に走っていることを確かめる
+        barrier.wait(timeout=5)
+        searched.append(keyword)
+        return []
+
+    analyzer.get_search_results = get_search_results
+    with start_trace("prefetch"):
+        keywords = analyzer.prefetch(["budget meeting", "budget review", "meeting agenda"], "en")
+    assert len(keywords) == KEYWORD_COUNT
+    assert sorted(searched) == sorted(keywords)
+
+
+def test_prefetch_does_not_update_document_frequency(analyzer):
+    analyzer.get_search_results = lambda keyword, number=3: []
+    analyzer.prefetch(["budget meeting"], "en")
+    assert analyzer.df_index.num_docs() == 0
@@ -0,0 +1,48 @@
+import pytest
+
+from src.session.session import Session, SessionManager, check_dir_name
+
+
+class Pipeline:
+    target_dir = None
+
+    def __init__(self) -> None:
+        self.closed = []
+
+    def close_archive(self, target_dir=None):
+        self.closed.append(target_dir)
+
+
+@pytest.mark.parametrize("dir_name", ["dummy", "2024-01-01_meeting", "会議 1", "v1.2"])
+def test_valid_dir_names(dir_name):
+    assert check_dir_name(dir_name) == dir_name
+
+
+@pytest.mark.parametrize("dir_name", ["", ".", "..", ".hidden", "../data", "a/b", "a\\b", "a\x00b", "x" * 129])
+def test_invalid_dir_names(dir_name):
+    with pytest.raises(ValueError):
+        check_dir_name(dir_name)
+
+
+def test_set_dir_rejects_invalid_name():
+    session = Session("s1", "s1", Pipeline(), Pipeline(), Pipeline(), Pipeline())
+    with pytest.raises(ValueError):
+        session.set_dir("../recorded")
+    assert session.target_dir == "s1"
+    assert session.transcriber.target_dir == "s1"
+    session.set_dir("meeting")
+    assert [pipeline.target_dir for pipeline in
+            [session.transcriber, session.reviser, session.summarizer, session.searcher]] == ["meeting"] * 4
+
+
+def test_evicted_session_closes_unused_archive():
+    transcriber = Pipeline()
+    manager = SessionManager(transcriber, Pipeline(), Pipeline(), Pipeline(), max_sessions=2)
+    manager.get("s1")
+    second, _ = manager.get("s2")
+    second.set_dir("s1")
+    # s1 は s2 が使っているので, s1 を破棄してもアーカイブは閉じない
+    manager.get("s3")
+    assert transcriber.closed == []
+    manager.get("s4")
+    assert transcriber.closed == ["s1"]
@@ -0,0 +1,102 @@
+import pytest
+
+from src.transcribe.store import TranscriptStore, compact_timings, decode_cursor, encode_cursor
+
+
+@pytest.fixture
+def store(tmp_path):
+    return TranscriptStore(str(tmp_path / "transcript.sqlite3"))
+
+
+def result(text: str, timestamp: str, **extra) -> dict:
+    return dict({"text": text, "timestamp": timestamp, "segments": [], "language": "ja"}, **extra)
+
+
+def read_all(store, limit):
+    items, cursor, pages = [], None, 0
+    while True:
+        page, cursor = store.page(cursor, limit=limit)
+        items += page
+        pages += 1
+        if cursor is None:
+            return items, pages
+
+
+def test_compact_timings():
+    spans, words = compact_timings({"segments": [
+        {"start": 0.0, "end": 1.234, "text": "会議", "tokens": [1, 2],
+         "words": [{"start": 0.0, "end": 0.5, "word": "会"}, {"start": 0.5, "end": 1.234, "word": "議"}]},
+    ]})
+    assert spans == [[0.0, 1.23, "会議"]]
+    assert words == [[0.0, 0.5, "会"], [0.5, 1.23, "議"]]
+    assert compact_timings({"segments": [{"start": 0.0, "end": 1.0, "text": "a"}]})[1] is None
+
+
+def test_cursor_round_trip():
+    assert decode_cursor(encode_cursor("2024-01-01T00:00:00", 42)) == ("2024-01-01T00:00:00", 42)
+    with pytest.raises(ValueError):
+        decode_cursor("not a cursor")
+
+
+def test_page_orders_by_timestamp(store):
+    store.add("2.wav", result("two", "2024-01-01T00:00:02"))
+    store.add("1.wav", result("one", "2024-01-01T00:00:01"))
+    store.add("3.wav", result("three", "2024-01-01T00:00:03"))
+    items, cursor = store.page(limit=10)
+    assert [item["text"] for item in items] == ["one", "two", "three"]
+    assert cursor is None
+
+
+@pytest.mark.parametrize("limit", [1, 2, 3, 5, 6])
+def test_pages_cover_all_segments_once(store, limit):
+    # 同じタイムスタンプの発話も id で順序が決まる
+    for i in range(6):
+        store.add(f"{i}.wav", result(str(i), f"2024-01-01T00:00:0{i // 2}"))
+    items, pages = read_all(store, limit)
+    assert [item["text"] for item in items] == [str(i) for i in range(6)]
+    assert pages == -(-6 // limit)
+
+
+def test_page_sees_segments_added_after_cursor(store):
+    store.add("1.wav", result("one", "2024-01-01T00:00:01"))
+    store.add("2.wav", result("two", "2024-01-01T00:00:02"))
+    page, cursor = store.page(limit=1)
+    store.add("3.wav", result("three", "2024-01-01T00:00:03"))
+    rest, _ = store.page(cursor, limit=10)
+    assert [item["text"] for item in page + rest] == ["one", "two", "three"]
+
+
+def test_empty_store(store):
+    assert store.page(limit=10) == ([], None)
+    assert store.count() == 0
+    assert store.detail("1.wav") is None
+
+
+def test_add_overwrites_same_segment(store):
+    first = store.add("1.wav", result("old", "2024-01-01T00:00:01"))
+    second = store.add("1.m4a", result("new", "2024-01-01T00:00:01"))
+    assert second > first
+    assert store.count() == 1
+    items, _ = store.page(limit=10)
+    assert [(item["file_name"], item["text"]) for item in items] == [("1.m4a", "new")]
+
+
+def test_changes_since(store):
+    store.add("1.wav", result("one", "2024-01-01T00:00:01"))
+    seq = store.add("2.wav", result("two", "2024-01-01T00:00:02"))
+    store.add("1.wav", result("one again", "2024-01-01T00:00:01"))
+    changes = store.changes_since(seq)
+    assert [change["text"] for change in changes] == ["one again"]
+    assert len(store.changes_since(0)) == 2
+
+
+def test_detail_keeps_whisper_result(store):
+    segments = [{"start": 0.0, "end": 1.0, "text": "one", "tokens": [1, 2, 3], "avg_logprob": -0.1}]
+    store.add("1.wav", result("one", "2024-01-01T00:00:01", segments=segments))
+    detail = store.detail("1.wav")
+    assert detail["text"] == "one"
+    assert detail["language"] == "ja"
+    assert detail["segments"] == segments
+    items, _ = store.page(limit=10)
+    assert "tokens" not in items[0]
+    assert items[0]["spans"] == [[0.0, 1.0, "one"]]
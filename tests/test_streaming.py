@@ -0,0 +1,25 @@
+import numpy as np
+
+from src.transcribe.streaming import StreamingSession
+
+
+def test_feed_keeps_partial_samples():
+    audio = np.linspace(-1.0, 1.0, 1000, dtype="<f4")
+    data = audio.tobytes()
+    session = StreamingSession(transcriber=None, target_dir="session", step_seconds=0.01)
+    # サンプルの途中で区切られたフレーム
+    for start, end in [(0, 7), (7, 1001), (1001, 1002), (1002, len(data))]:
+        session.feed(data[start:end])
+    np.testing.assert_array_equal(session.buffer, audio)
+    assert session.pending == b""
+    assert session.undecoded_samples == len(audio)
+
+
+def test_feed_holds_remainder_until_next_frame():
+    data = np.arange(4, dtype="<f4").tobytes()
+    session = StreamingSession(transcriber=None, target_dir="session")
+    session.feed(data[:5])
+    assert len(session.buffer) == 1
+    assert session.pending == data[4:5]
+    session.feed(data[5:])
+    np.testing.assert_array_equal(session.buffer, np.arange(4, dtype=np.float32))
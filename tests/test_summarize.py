@@ -0,0 +1,57 @@
+import pytest
+
+from src.summarize import summarize
+from src.summarize.summarize import Summarizer
+
+
+class FlakyLLM:
+    """最初の failures 回だけ失敗し, 呼び出しごとの max_retries を記録する"""
+
+    def __init__(self, failures: int) -> None:
+        self.failures = failures
+        self.max_retries = []
+
+    def complete(self, prompt, model, temperature=0, max_retries=None):
+        self.max_retries.append(max_retries)
+        if len(self.max_retries) <= self.failures:
+            raise RuntimeError("temporary error")
+        return "ok"
+
+    def stream(self, prompt, model, temperature=0, max_retries=None):
+        yield self.complete(prompt, model, temperature=temperature, max_retries=max_retries)
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(summarize.time, "sleep", sleeps.append)
+    return sleeps
+
+
+def make_summarizer(tmp_path, llm, max_retries=3):
+    return Summarizer(str(tmp_path), str(tmp_path), "session", llm=llm, max_retries=max_retries)
+
+
+def test_retries_without_sdk_retries(tmp_path, sleeps):
+    llm = FlakyLLM(failures=2)
+    assert make_summarizer(tmp_path, llm).predict_with_retry("model", "prompt") == "ok"
+    # SDK の再試行は切って, 再試行の回数は predict_with_retry の分だけになる
+    assert llm.max_retries == [0, 0, 0]
+    assert sleeps == [1, 2]
+
+
+def test_gives_up_after_max_retries(tmp_path, sleeps):
+    llm = FlakyLLM(failures=10)
+    with pytest.raises(RuntimeError):
+        make_summarizer(tmp_path, llm, max_retries=2).predict_with_retry("model", "prompt")
+    assert llm.max_retries == [0, 0, 0]
+
+
+def test_streaming_disables_sdk_retries(tmp_path, sleeps):
+    llm = FlakyLLM(failures=1)
+    deltas = []
+    response = make_summarizer(tmp_path, llm).predict_with_retry(
+        "model", "prompt", on_delta=lambda delta, text: deltas.append((delta, text)))
+    assert response == "ok"
+    assert deltas == [("ok", None), (None, "ok")]
+    assert llm.max_retries == [0, 0]
@@ -0,0 +1,37 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from src.metrics.tracing import bind_context, span, start_trace
+
+
+def test_span_records_parent():
+    with start_trace("request") as trace:
+        with span("outer"):
+            with span("inner"):
+                pass
+    spans = {s["name"]: s for s in trace.to_dict()["spans"]}
+    assert spans["outer"]["parent"] is None
+    assert spans["inner"]["parent"] == "outer"
+    assert sorted(entry.split(";")[0] for entry in trace.server_timing().split(", ")) == ["inner", "outer"]
+
+
+def test_span_outside_trace_is_noop():
+    with span("ignored"):
+        pass
+
+
+def test_bound_function_runs_concurrently_in_a_pool():
+    barrier = threading.Barrier(4)
+
+    def work(i):
+        with span("work"):
+            # すべてのスレッドが同時に span の中にいる状態を作る
+            barrier.wait(timeout=5)
+        return i
+
+    with start_trace("request") as trace:
+        bound = bind_context(work)
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(bound, range(4)))
+    assert results == [0, 1, 2, 3]
+    assert [s["name"] for s in trace.to_dict()["spans"]] == ["work"] * 4
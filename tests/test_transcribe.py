@@ -0,0 +1,88 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+from src.transcribe.transcribe import LEGACY_DIR_NAME, Transcriber
+
+
+@pytest.fixture
+def transcriber(tmp_path):
+    return Transcriber(str(tmp_path / "recorded"), str(tmp_path / "transcribed"), "session",
+                       config={"backend": "whisper", "model_name": "small", "device": "cpu"})
+
+
+def write_legacy(directory, count: int) -> None:
+    os.makedirs(directory, exist_ok=True)
+    for i in range(count):
+        with open(os.path.join(directory, f"{i}.json"), "w") as f:
+            json.dump({"text": str(i), "timestamp": f"2024-01-01T00:00:0{i}", "segments": []}, f)
+    with open(os.path.join(directory, "integrated.json"), "w") as f:
+        json.dump([], f)
+
+
+def test_store_is_not_created_on_read(transcriber, tmp_path):
+    assert transcriber.store(create=False) is None
+    assert not (tmp_path / "transcribed" / "session").exists()
+    assert transcriber.store().count() == 0
+    assert transcriber.store(create=False) is not None
+
+
+def test_legacy_transcripts_are_moved_aside(transcriber, tmp_path):
+    directory = tmp_path / "transcribed" / "session"
+    write_legacy(directory, 3)
+    store = transcriber.store(create=False)
+    assert [item["text"] for item in store.page(limit=10)[0]] == ["0", "1", "2"]
+    assert sorted(os.listdir(directory / LEGACY_DIR_NAME)) == ["0.json", "1.json", "2.json"]
+    assert not (directory / "0.json").exists()
+    assert (directory / "integrated.json").exists()
+
+
+def test_failed_migration_keeps_files(transcriber, tmp_path):
+    directory = tmp_path / "transcribed" / "session"
+    write_legacy(directory, 2)
+    (directory / "broken.json").write_text("{", encoding="utf-8")
+    with pytest.raises(ValueError):
+        transcriber.store()
+    assert (directory / "0.json").exists()
+    # 壊れたファイルを直せば次に開いたときにやり直す
+    (directory / "broken.json").unlink()
+    assert transcriber.store().count() == 2
+    assert not (directory / "0.json").exists()
+
+
+def test_delete_transcripts_removes_legacy(transcriber, tmp_path):
+    directory = tmp_path / "transcribed" / "session"
+    write_legacy(directory, 1)
+    transcriber.store()
+    transcriber.delete_transcripts()
+    assert os.listdir(directory) == []
+
+
+def test_delete_transcripts_keeps_other_files(transcriber, tmp_path):
+    directory = tmp_path / "transcribed" / "session"
+    write_legacy(directory, 1)
+    transcriber.store()
+    (directory / "notes.txt").write_text("memo", encoding="utf-8")
+    (directory / "other").mkdir()
+    (directory / "other" / "0.json").write_text("{}", encoding="utf-8")
+    transcriber.delete_transcripts()
+    assert sorted(os.listdir(directory)) == ["notes.txt", "other"]
+    assert os.listdir(directory / "other") == ["0.json"]
+
+
+def test_delete_audio_drops_the_archive(transcriber, tmp_path):
+    archive = transcriber.archive("session")
+    archive.append("a.wav", audio=np.zeros(10, dtype=np.float32))
+    transcriber.delete_audio("session")
+    assert "session" not in transcriber.archives
+    assert os.listdir(tmp_path / "recorded" / "session") == []
+    assert transcriber.archive("session").list_names() == []
+
+
+def test_close_archive(transcriber):
+    transcriber.archive("session").append("a.wav", audio=np.zeros(10, dtype=np.float32))
+    transcriber.close_archive("session")
+    assert "session" not in transcriber.archives
+    assert transcriber.archive("session").list_names() == ["a.wav"]